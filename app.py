@@ -1,21 +1,40 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import gspread
+import numpy as np
+import hashlib
+import hmac
+import html
+import asyncio
+import bisect
+import contextlib
+import functools
 import json
+import collections
+import multiprocessing
 import os
+import pickle
+import random
 import re
-
-from openai import OpenAI
-from oauth2client.service_account import ServiceAccountCredentials
+import signal
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from docx import Document
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from google.oauth2.service_account import Credentials
-from PyPDF2 import PdfReader
+from drive_extract import extract_worker, register_worker
+from visa_rules import (
+    VISA_ALIAS_TO_PORT, VISA_HOME_COUNTRY, build_rule_index, docx_text, find_visa_rules,
+    fold_vietnamese, is_inbound_destination, match_aliases, nationality_keys, visa_exemptions
+)
 import io
-import re
+
+# openai, gspread, googleapiclient, plotly, PyPDF2, python-docx, pyarrow được
+# import trong hàm dùng đến: mỗi trang chỉ nạp thư viện nó cần, khởi động nhanh hơn
+
 # =====================================================
 # CONFIG
 # =====================================================
@@ -28,6 +47,93 @@ DEFAULT_GUIDE_SHEET = "https://docs.google.com/spreadsheets/d/1b7z00QcNuYjK54ikc
 DRIVE_FOLDER_ID = ""   # folder chứa file tour trên Google Drive
 LOGO_URL = "https://travel.com.vn/Content/images/logo.png"
 
+SHEET_CACHE_TTL = 300          # giây — dữ liệu sheet dùng chung cho mọi session
+SHEET_CACHE_MAX_ENTRIES = 64
+SNAPSHOT_DIR = "sheet_snapshots"   # bản chụp Arrow có kiểu của sheet Orders / Tours
+ORDER_SNAPSHOT_SCHEMA = {"Ngày": "date", "Giá": "price", "Tour": "category", "Kênh": "category", "Sale": "category"}
+TOUR_SNAPSHOT_SCHEMA = {"Giá": "price"}
+SNAPSHOT_FORMAT = 2                # tăng khi đổi cách typed_frame chuyển kiểu → chụp lại
+PRICE_VALUE_SUFFIX = " (VND)"      # cột "Giá" giữ chuỗi gốc, "Giá (VND)" là số để cộng doanh thu
+
+SHEET_SCOPE = (
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/drive",
+)
+DRIVE_SCOPE = ("https://www.googleapis.com/auth/drive.readonly",)
+HANDLE_CACHE_TTL = 3600        # giây — giữ Spreadsheet/Worksheet đã mở
+TOKEN_REFRESH_MARGIN = 300     # làm mới token trước khi hết hạn 5 phút
+
+DRIVE_CACHE_DB = "drive_cache.db"   # text đã trích xuất từ file tour Drive
+DRIVE_SYNC_INTERVAL = 60       # giây — không list lại folder nếu vừa sync
+DRIVE_STORE_VERSION = 3        # tăng khi đổi schema → store được build lại
+DRIVE_FILE_TYPES = (".pdf", ".docx", ".txt")
+DRIVE_DOWNLOAD_WORKERS = 8     # thread tải file (network-bound)
+DRIVE_EXTRACT_WORKERS = os.cpu_count() or 2   # process đọc PDF/DOCX (CPU-bound)
+DRIVE_MAX_IN_FLIGHT = 16       # số file tối đa đang tải + đang đọc cùng lúc
+DRIVE_FILE_TIMEOUT = 120       # giây cho mỗi bước tải / đọc một file
+DRIVE_CHUNK_SIZE = 1500        # ký tự mỗi đoạn trong index tìm kiếm
+DRIVE_CHUNK_OVERLAP = 200
+DRIVE_SEARCH_TOP_K = 10        # số đoạn gửi cho AI
+SUGGEST_TOP_K = 20             # số tour gợi ý tối đa cho mỗi tin nhắn
+SUGGEST_CACHE_SIZE = 1024      # số bộ keyword giữ kết quả gợi ý cho mỗi version tour sheet
+
+KB_INDEX_DIR = "kb_index"      # vector index của dữ liệu công ty (visa + tour)
+KB_EMBED_DIM = 1024            # số chiều cho backend "hashing"
+KB_TOP_K = 8                   # số đoạn gửi cho AI
+
+CHAT_MODEL = "gpt-4o-mini"
+SYSTEM_PROMPT = "Bạn là chuyên gia du lịch."
+PROMPT_TOKEN_BUDGET = 8000     # token tối đa cho prompt (system + dữ liệu + câu hỏi)
+QUESTION_TOKEN_BUDGET = 500    # token tối đa cho mỗi phần khách / sale nhập
+
+LLM_CACHE_DB = "llm_cache.db"  # cache câu trả lời AI
+LLM_CACHE_TTL = 7 * 24 * 3600  # giây
+LLM_CACHE_MAX_ENTRIES = 5000
+LLM_TIMEOUT = 60               # giây cho mỗi lần gọi AI chạy song song
+
+# Giới hạn gọi API dùng chung cho cả process (mọi session):
+# rate = số request / giây, burst = số request dồn tối đa, concurrency = số
+# request chạy cùng lúc. Quota Sheets là 60 read / phút / service account.
+RATE_LIMITS = {
+    "sheets": {"rate": 1.0, "burst": 10, "concurrency": 4},
+    "drive": {"rate": 10.0, "burst": 20, "concurrency": 8},
+    "openai": {"rate": 5.0, "burst": 10, "concurrency": 8},
+}
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.5         # giây, nhân đôi sau mỗi lần thử lại
+RETRY_MAX_DELAY = 30
+
+PERF_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)   # giây
+PERF_SAMPLE_SIZE = 1000        # số lần đo gần nhất giữ lại để tính p50/p95/p99
+
+ORDER_JOURNAL_DB = "order_journal.db"   # đơn đã chốt, chờ đẩy lên Google Sheet
+ORDER_FLUSH_INTERVAL = 2.0     # giây giữa các lần đẩy đơn
+ORDER_FLUSH_BATCH = 100        # số đơn tối đa mỗi lần append_rows
+ORDER_FLUSH_LINGER = 0.5       # giây chờ gom thêm đơn sau khi có đơn mới
+ORDER_CLAIM_TIMEOUT = 300      # giây; process nhận đơn rồi chết thì sau đó đơn được nhận lại
+ORDER_ID_COLUMN = "ID"         # cột mã đơn trên sheet Orders
+ORDER_PAGE_SIZES = [25, 50, 100, 200]
+
+ORDER_DB = "orders.db"          # kho đơn local khi chọn lưu bằng SQLite
+ORDER_COLUMNS = ["Ngày", "Tên", "Tour", "Giá", "Note", "Kênh", "Sale"]
+ORDER_SYNC_INTERVAL = 10.0      # giây giữa các lần đồng bộ SQLite → Google Sheet
+ORDER_SYNC_BATCH = 500          # số đơn tối đa mỗi lần đồng bộ
+
+DASHBOARD_AGG_MAX_AGE = 3600   # giây; tính lại tổng hợp dashboard từ sheet (bắt kịp sửa tay trên sheet)
+
+INBOX_DB = "inbox.db"           # hộp thư khách dùng chung cho mọi sale
+INBOX_POLL_INTERVAL = 5         # giây giữa các lần kéo tin mới
+INBOX_FEED_BATCH = 500          # số tin tối đa mỗi lần kéo
+CHAT_WINDOW = 30                # số tin mới nhất hiển thị khi mở cuộc chat
+CHAT_PAGE = 30                  # số tin cũ tải thêm mỗi lần bấm xem
+CHAT_BOX_HEIGHT = 480           # px
+INBOX_SEED_ENV = "SALES_HUB_SEED_INBOX"   # =1: thêm khách mẫu vào hộp thư trống (dev / benchmark)
+INBOX_SEED = [
+    ("Anh Hùng", "Zalo", "Anh muốn đi Nhật tháng 3 ngân sách 40000000"),
+    ("Chị Lan", "Facebook", "Tour Thái Lan bao nhiêu tiền em?"),
+    ("Khách Web", "Online", "Tư vấn giúp tour Đà Nẵng"),
+]
+
 st.set_page_config(
     page_title="Vietravel Sales Hub",
     page_icon="🌍",
@@ -76,18 +182,20 @@ if "guide_sheet_url" not in st.session_state:
 if "drive_folder" not in st.session_state:
     st.session_state.drive_folder = config.get("drive_folder", "")
 
+if "llm_cache_enabled" not in st.session_state:
+    st.session_state.llm_cache_enabled = config.get("llm_cache_enabled", True)
+
 if "selected_customer" not in st.session_state:
     st.session_state.selected_customer = None
 
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 
-if "customer_list" not in st.session_state:
-    st.session_state.customer_list = [
-        {"id": 1, "name": "Anh Hùng", "msg": "Anh muốn đi Nhật tháng 3 ngân sách 40000000", "time": "10:30"},
-        {"id": 2, "name": "Chị Lan", "msg": "Tour Thái Lan bao nhiêu tiền em?", "time": "09:15"},
-        {"id": 3, "name": "Khách Web", "msg": "Tư vấn giúp tour Đà Nẵng", "time": "08:00"},
-    ]
+if "chat_shown" not in st.session_state:
+    st.session_state.chat_shown = CHAT_WINDOW
+
+if "rep_name" not in st.session_state:
+    st.session_state.rep_name = ""
 
 
 # =====================================================
@@ -125,31 +233,6 @@ st.markdown("""
 }
 
 
-/* =========================
-   CHAT BOX
-========================= */
-
-.chat-box {
-    background: #020617;
-    border: 1px solid #1e293b;
-    border-radius: 10px;
-    height: 60vh;
-    display: flex;
-    flex-direction: column;
-}
-
-
-/* =========================
-   CHAT AREA
-========================= */
-
-.chat-area {
-    flex-grow: 1;
-    overflow-y: auto;
-    padding: 15px;
-}
-
-
 /* =========================
    MESSAGE
 ========================= */
@@ -198,629 +281,4076 @@ div[role="option"]:hover {
 """, unsafe_allow_html=True)
 
 # =====================================================
-# CHATGPT FUNCTION
+# PERFORMANCE METRICS
 # =====================================================
+# Đo thời gian từng lần gọi ra ngoài (Sheets / Drive / OpenAI) và từng
+# trang render_*, gom theo tên thao tác: số lần, lỗi, bytes, histogram
+# theo PERF_BUCKETS và PERF_SAMPLE_SIZE mẫu gần nhất để tính p50/p95/p99.
+# Xem ở trang Performance (chỉ admin), xuất Prometheus hoặc JSON lines.
+
+@st.cache_resource
+def _perf_store():
+    # prompts: (token, số đoạn dữ liệu dùng, số đoạn có) của các prompt gần nhất
+    return {
+        "lock": threading.Lock(),
+        "ops": {},
+        "prompts": collections.deque(maxlen=PERF_SAMPLE_SIZE),
+        "since": time.time(),
+        "local": threading.local(),
+    }
 
-def ask_chatgpt(prompt):
-    if not st.session_state.api_key:
-        return "Chưa nhập OpenAI API Key"
 
-    try:
-        client = OpenAI(api_key=st.session_state.api_key)
+def _span_stack():
 
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # Đã sửa từ gpt-4.1-mini thành gpt-4o-mini
-            messages=[
-                {"role": "system", "content": "Bạn là chuyên gia du lịch."},
-                {"role": "user", "content": prompt}
-            ]
-        )
+    local = _perf_store()["local"]
 
-        return response.choices[0].message.content
+    if not hasattr(local, "stack"):
+        local.stack = []
 
-    except Exception as e:
-        return str(e)
-# =====================================================
-# GOOGLE SHEET
-# =====================================================
+    return local.stack
 
-def connect_sheet(url):
 
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive"
-    ]
+def record_span(name, seconds, nbytes=0, error=False):
 
-    creds_dict = st.secrets["gcp_service_account"]
+    store = _perf_store()
 
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(
-        creds_dict,
-        scope
-    )
+    with store["lock"]:
 
-    client = gspread.authorize(creds)
+        op = store["ops"].get(name)
 
-    sheet = client.open_by_url(url).sheet1
+        if op is None:
+            op = store["ops"][name] = {
+                "count": 0,
+                "errors": 0,
+                "bytes": 0,
+                "sum": 0.0,
+                "max": 0.0,
+                "buckets": [0] * (len(PERF_BUCKETS) + 1),
+                "samples": collections.deque(maxlen=PERF_SAMPLE_SIZE),
+            }
 
-    return sheet
+        op["count"] += 1
+        op["errors"] += int(error)
+        op["bytes"] += nbytes
+        op["sum"] += seconds
+        op["max"] = max(op["max"], seconds)
+        op["buckets"][bisect.bisect_left(PERF_BUCKETS, seconds)] += 1
+        op["samples"].append(seconds)
 
 
-def load_sheet():
-    try:
-        sheet = connect_sheet(st.session_state.sheet_url)
-        data = sheet.get_all_records()
-        return pd.DataFrame(data)
-    except:
-        return pd.DataFrame()
+def record_prompt(info):
 
+    store = _perf_store()
 
-def load_tour_sheet():
-    try:
-        sheet = connect_sheet(st.session_state.tour_sheet_url)
-        data = sheet.get_all_records()
-        return pd.DataFrame(data)
-    except:
-        return pd.DataFrame()
+    with store["lock"]:
+        store["prompts"].append((info["tokens"], info["context_used"], info["context_total"]))
 
 
-def load_guide_sheet(worksheet_name=None):
-    try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        creds_dict = st.secrets["gcp_service_account"]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        client = gspread.authorize(creds)
-        spreadsheet = client.open_by_url(st.session_state.guide_sheet_url)
-        
-        # Nếu có tên worksheet thì mở, không thì mở sheet đầu tiên
-        sheet = spreadsheet.worksheet(worksheet_name) if worksheet_name else spreadsheet.sheet1
-        
-        data = sheet.get_all_records()
-        return pd.DataFrame(data)
-    except Exception as e:
-        st.error(f"Lỗi: {e}")
-        return pd.DataFrame()
-def get_guide_worksheets():
-    try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        creds_dict = st.secrets["gcp_service_account"]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        client = gspread.authorize(creds)
-        spreadsheet = client.open_by_url(st.session_state.guide_sheet_url)
-        return [sh.title for sh in spreadsheet.worksheets()]
-    except:
-        return []
-def save_to_sheet(row):
-    try:
-        sheet = connect_sheet(st.session_state.sheet_url)
-        sheet.append_row(row)
-        return True
-    except Exception as e:
-        st.error(e)
-        return False
+@contextlib.contextmanager
+def perf_span(name):
 
+    stack = _span_stack()
+    span = {"bytes": 0}
+    stack.append(span)
+
+    started = time.perf_counter()
+    error = False
 
-def delete_row(row_number):
     try:
-        sheet = connect_sheet(st.session_state.sheet_url)
-        sheet.delete_rows(row_number)
-        return True
-    except:
-        return False
+        yield span
+    except Exception:
+        error = True
+        raise
+    finally:
+        stack.pop()
+        record_span(name, time.perf_counter() - started, span["bytes"], error)
 
-import io
-import streamlit as st
 
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from google.oauth2.service_account import Credentials
+def add_span_bytes(nbytes):
 
-from PyPDF2 import PdfReader
-from docx import Document
+    # cộng bytes vào span đang mở trong thread này (vd. hook response của gspread)
+    stack = _span_stack()
 
+    if stack:
+        stack[-1]["bytes"] += nbytes
 
-# =============================
-# CONFIG
-# =============================
 
+def perf_timed(fn):
 
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with perf_span(f"page.{fn.__name__}"):
+            return fn(*args, **kwargs)
 
+    return wrapper
 
-# =============================
-# CONNECT GOOGLE DRIVE
-# =============================
 
-def connect_drive():
+def _payload_bytes(result):
 
-    scope = ["https://www.googleapis.com/auth/drive.readonly"]
+    if isinstance(result, (bytes, bytearray)):
+        return len(result)
 
-    creds_dict = st.secrets["gcp_service_account"]
+    if isinstance(result, str):
+        return len(result.encode("utf-8"))
 
-    creds = Credentials.from_service_account_info(
-        creds_dict,
-        scopes=scope
-    )
+    # câu trả lời chat của OpenAI
+    choices = getattr(result, "choices", None)
 
-    service = build("drive", "v3", credentials=creds)
+    if isinstance(choices, list):
+        return sum(
+            len((getattr(getattr(c, "message", None), "content", None) or "").encode("utf-8"))
+            for c in choices
+        )
 
-    return service
+    return 0
 
 
-# =============================
-# READ PDF
-# =============================
+def reset_perf_metrics():
 
-def read_pdf_from_bytes(file_bytes):
+    store = _perf_store()
 
-    pdf = PdfReader(file_bytes)
-    text = ""
+    with store["lock"]:
+        store["ops"].clear()
+        store["prompts"].clear()
+        store["since"] = time.time()
 
-    for page in pdf.pages:
-        page_text = page.extract_text()
-        if page_text:
-            text += page_text + "\n"
 
-    return text
+def perf_summary():
 
+    store = _perf_store()
 
-# =============================
-# READ DOCX
-# =============================
+    with store["lock"]:
+        ops = {
+            name: {**op, "samples": np.array(op["samples"]), "buckets": list(op["buckets"])}
+            for name, op in store["ops"].items()
+        }
 
-def read_docx_from_bytes(file_bytes):
+    rows = []
 
-    doc = Document(file_bytes)
+    for name, op in sorted(ops.items()):
 
-    text = []
-    for p in doc.paragraphs:
-        text.append(p.text)
+        p50, p95, p99 = np.percentile(op["samples"], [50, 95, 99]) * 1000
 
-    return "\n".join(text)
+        rows.append({
+            "op": name,
+            "count": op["count"],
+            "errors": op["errors"],
+            "p50_ms": round(p50, 1),
+            "p95_ms": round(p95, 1),
+            "p99_ms": round(p99, 1),
+            "max_ms": round(op["max"] * 1000, 1),
+            "total_s": round(op["sum"], 6),
+            "bytes": op["bytes"],
+            "buckets": op["buckets"],
+        })
 
+    return rows
 
-# =============================
-# LOAD ALL TOUR DATA FROM DRIVE
-# =============================
 
-def extract_drive_id(link):
-    import re
-    match = re.search(r'/folders/([a-zA-Z0-9_-]+)', link)
-    return match.group(1) if match else link
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
 
-def load_drive_tour_data():
+def perf_prometheus(rows=None):
 
-    # ===== LẤY FOLDER ID TỪ SESSION =====
-    drive_link = st.session_state.get("drive_folder", "")
+    rows = perf_summary() if rows is None else rows
 
-    if not drive_link:
-        st.warning("⚠️ Chưa cấu hình Google Drive Folder trong Settings.")
-        return ""
+    lines = [
+        "# HELP app_operation_duration_seconds Thời gian mỗi thao tác (gọi ra ngoài / render trang)",
+        "# TYPE app_operation_duration_seconds histogram",
+    ]
 
-    folder_id = extract_drive_id(drive_link)
+    for row in rows:
 
-    try:
+        label = prometheus_label(row["op"])
+        cumulative = 0
 
-        service = connect_drive()
+        for bound, count in zip([*PERF_BUCKETS, "+Inf"], row["buckets"]):
+            cumulative += count
+            lines.append(f'app_operation_duration_seconds_bucket{{op="{label}",le="{bound}"}} {cumulative}')
 
-        results = service.files().list(
-            q=f"'{folder_id}' in parents and trashed=false",
-            fields="files(id, name, mimeType)",
-            pageSize=100
-        ).execute()
+        lines.append(f'app_operation_duration_seconds_sum{{op="{label}"}} {row["total_s"]}')
+        lines.append(f'app_operation_duration_seconds_count{{op="{label}"}} {row["count"]}')
 
-        files = results.get("files", [])
+    for metric, field, help_text in [
+        ("app_operation_errors_total", "errors", "Số lần thao tác bị lỗi"),
+        ("app_operation_bytes_total", "bytes", "Bytes nhận / gửi của thao tác"),
+    ]:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for row in rows:
+            label = prometheus_label(row["op"])
+            lines.append(f'{metric}{{op="{label}"}} {row[field]}')
 
-        if len(files) == 0:
-            st.warning("⚠️ Folder có nhưng không có file hoặc chưa share quyền.")
-            return ""
+    return "\n".join(lines) + "\n"
 
-        all_text = ""
 
-        for file in files:
+def perf_jsonl(rows=None):
 
-            file_id = file["id"]
-            file_name = file["name"].lower()
+    rows = perf_summary() if rows is None else rows
+    now = datetime.now().isoformat(timespec="seconds")
 
-            try:
+    return "".join(
+        json.dumps({"ts": now, **{k: v for k, v in row.items() if k != "buckets"}}, ensure_ascii=False) + "\n"
+        for row in rows
+    )
 
-                request = service.files().get_media(fileId=file_id)
 
-                fh = io.BytesIO()
-                downloader = MediaIoBaseDownload(fh, request)
+# =====================================================
+# RATE LIMIT / RETRY
+# =====================================================
+# Token bucket + giới hạn số request đồng thời cho từng backend, thử lại
+# lỗi 429 / 5xx / mất kết nối với exponential backoff có jitter.
+# Thời gian chờ và độ dài hàng đợi được ghi lại để xem trong Settings.
+
+@st.cache_resource
+def _rate_limiters():
+
+    limiters = {}
+
+    for backend, limit in RATE_LIMITS.items():
+        limiters[backend] = {
+            "lock": threading.Lock(),
+            "tokens": float(limit["burst"]),
+            "updated": time.monotonic(),
+            "slots": threading.BoundedSemaphore(limit["concurrency"]),
+            "metrics": {
+                "calls": 0,
+                "retries": 0,
+                "errors": 0,
+                "wait_total": 0.0,
+                "wait_max": 0.0,
+                "queue": 0,
+                "queue_peak": 0,
+                "in_flight": 0,
+            },
+        }
+
+    return limiters
+
+
+def _take_token(limiter, backend):
+
+    # trả về 0 nếu lấy được token, ngược lại số giây cần chờ
+    limit = RATE_LIMITS[backend]
+
+    with limiter["lock"]:
+
+        now = time.monotonic()
+        limiter["tokens"] = min(
+            limit["burst"],
+            limiter["tokens"] + (now - limiter["updated"]) * limit["rate"]
+        )
+        limiter["updated"] = now
 
-                done = False
-                while not done:
-                    status, done = downloader.next_chunk()
+        if limiter["tokens"] >= 1:
+            limiter["tokens"] -= 1
+            return 0
 
-                fh.seek(0)
+        return (1 - limiter["tokens"]) / limit["rate"]
 
-                if file_name.endswith(".pdf"):
-                    text = read_pdf_from_bytes(fh)
 
-                elif file_name.endswith(".docx"):
-                    text = read_docx_from_bytes(fh)
+def _update_metrics(limiter, **changes):
 
-                elif file_name.endswith(".txt"):
-                    text = fh.read().decode("utf-8")
+    with limiter["lock"]:
 
-                else:
-                    continue
+        metrics = limiter["metrics"]
 
-                all_text += "\n" + text
+        for name, value in changes.items():
+            metrics[name] += value
 
-            except Exception as e:
-                st.error(f"Lỗi đọc file {file_name}: {e}")
+        metrics["queue_peak"] = max(metrics["queue_peak"], metrics["queue"])
 
-        return all_text
 
-    except Exception as e:
-        st.error(f"Lỗi kết nối Drive: {e}")
-        return ""
+def _record_wait(limiter, waited):
 
-# =============================
-# AI SEARCH TOUR FROM DRIVE DATA
-# =============================
-def search_relevant_text(data, query, window=8000):
+    with limiter["lock"]:
+        limiter["metrics"]["wait_total"] += waited
+        limiter["metrics"]["wait_max"] = max(limiter["metrics"]["wait_max"], waited)
 
-    query = query.lower()
 
-    idx = data.lower().find(query)
+def _error_status(e):
 
-    if idx == -1:
-        return data[:window]
+    # gspread / requests
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
 
-    start = max(0, idx - window)
-    end = idx + window
+    # googleapiclient HttpError
+    if status is None and hasattr(e, "resp"):
+        status = getattr(e.resp, "status", None)
 
-    return data[start:end]
-def ai_search_tour_drive(query):
+    # openai
+    if status is None:
+        status = getattr(e, "status_code", None)
 
-    data = load_drive_tour_data()
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
 
-    if not data:
-        return "❌ Không có dữ liệu Drive. Vui lòng kiểm tra Folder ID hoặc quyền chia sẻ."
 
-    # =============================
-    # TÌM ĐOẠN LIÊN QUAN NHẤT
-    # =============================
-    relevant = search_relevant_text(data, query, window=9000)
+def is_retryable(e):
 
-    # =============================
-    # PROMPT CHUẨN PRO
-    # =============================
-    prompt = f"""
-Bạn là chuyên gia sản phẩm Vietravel.
+    status = _error_status(e)
 
-NHIỆM VỤ:
-Trích xuất CHÍNH XÁC thông tin tour từ dữ liệu được cung cấp.
+    if status is not None:
+        return status == 429 or status >= 500 or (status == 403 and "rate" in str(e).lower())
 
-=============================
-QUY TẮC BẮT BUỘC
-=============================
+    return isinstance(e, (ConnectionError, TimeoutError)) or type(e).__name__ in (
+        "APIConnectionError", "APITimeoutError", "RateLimitError"
+    )
 
-1. CHỈ sử dụng dữ liệu có trong tài liệu
-2. KHÔNG được tự thêm thông tin ngoài dữ liệu
-3. Nếu không thấy thông tin thì ghi: Đang cập nhật
-4. Phải hiển thị ĐẦY ĐỦ tất cả các ngày trong lịch trình
-5. Nếu tour 7 ngày phải có Ngày 1 → Ngày 7
-6. Không được bỏ sót ngày cuối
-7. Không được tóm tắt quá ngắn
-8. Ưu tiên dữ liệu gần từ khóa tìm kiếm: "{query}"
-9. Viết văn phong tư vấn chuyên nghiệp gửi khách hàng
-10. Nội dung phải dài và đầy đủ
 
-=============================
-DỮ LIỆU TOUR
-=============================
+def backoff_delay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
 
-{relevant}
 
-=============================
-KHÁCH HỎI
-=============================
+def _op_name(fn):
+    # vd. Worksheet.get_all_records, Completions.create, MediaIoBaseDownload.next_chunk
+    return getattr(fn, "__qualname__", None) or type(fn).__name__
 
-{query}
 
-=============================
-XUẤT KẾT QUẢ THEO FORMAT
-=============================
+def call_with_limits(backend, fn, *args, retry=True, **kwargs):
 
-📍 Tên tour:
-📍 Mã tour:
-📍 Thời gian:
-📍 Giá:
-📍 Ngày khởi hành:
+    # retry=False cho lệnh ghi theo vị trí / không idempotent: request có thể
+    # đã chạy dù mất response, gửi lại sẽ ghi / xoá nhầm dòng → để nơi gọi tự xử lý
+    limiter = _rate_limiters()[backend]
+    attempt = 0
 
-📍 Điểm nổi bật:
+    while True:
 
-📍 LỊCH TRÌNH CHI TIẾT:
+        # ===== CHỜ TOKEN + SLOT =====
+        started = time.monotonic()
+        _update_metrics(limiter, queue=1)
 
-Ngày 1:
-Ngày 2:
-Ngày 3:
-Ngày 4:
-(Nếu còn ngày phải liệt kê đầy đủ đến ngày cuối)
+        try:
+            delay = _take_token(limiter, backend)
 
-=============================
+            while delay:
+                time.sleep(delay)
+                delay = _take_token(limiter, backend)
 
-Viết nội dung rõ ràng dễ copy gửi Zalo cho khách.
-Không được rút gọn.
-"""
+            limiter["slots"].acquire()
+        finally:
+            _update_metrics(limiter, queue=-1)
 
-    result = ask_chatgpt(prompt)
+        _record_wait(limiter, time.monotonic() - started)
+        _update_metrics(limiter, calls=1, in_flight=1)
 
-    return result
-# =====================================================
-# TOUR SUGGEST
-# =====================================================
+        try:
+            with perf_span(f"{backend}.{_op_name(fn)}") as span:
+                result = fn(*args, **kwargs)
+                span["bytes"] += _payload_bytes(result)
 
-STOP_WORDS = [
-    "tư", "vấn", "giúp", "tour", "muốn", "đi", "em", "anh",
-    "chị", "bao", "nhiêu", "tiền", "tháng", "ngân", "sách"
-]
+            return result
 
+        except Exception as e:
 
-def clean_words(text):
-    words = re.findall(r'\w+', text.lower())
-    return [w for w in words if w not in STOP_WORDS and len(w) > 2]
+            if not retry or attempt + 1 >= RETRY_ATTEMPTS or not is_retryable(e):
+                _update_metrics(limiter, errors=1)
+                raise
 
+        finally:
+            limiter["slots"].release()
+            _update_metrics(limiter, in_flight=-1)
 
-def suggest_tour(message):
+        _update_metrics(limiter, retries=1)
+        time.sleep(backoff_delay(attempt))
+        attempt += 1
 
-    df = load_tour_sheet()
 
-    if df.empty:
-        return pd.DataFrame()
+@st.cache_resource(show_spinner=False)
+def _async_slots(backend):
+    # chỉ dùng trên _llm_event_loop: coroutine xếp hàng ở đây (không poll),
+    # nên số thread chờ slot chung bên dưới không vượt concurrency
+    return asyncio.Semaphore(RATE_LIMITS[backend]["concurrency"])
 
-    msg = message.lower()
 
-    STOP_WORDS = [
-        "anh", "chị", "em", "mình", "tôi",
-        "muốn", "đi", "du", "lịch", "tour",
-        "tháng", "ngày", "bao", "nhiêu",
-        "tiền", "ngân", "sách", "khoảng",
-        "tầm", "giúp", "với", "ạ", "ơi"
-    ]
+async def _acquire_slot(limiter):
 
-    words = re.findall(r'\w+', msg)
+    if limiter["slots"].acquire(blocking=False):
+        return
 
-    keywords = [
-        w for w in words
-        if w not in STOP_WORDS and len(w) > 2 and not w.isdigit()
-    ]
+    # slot đang bị call_with_limits ở thread khác giữ: chờ trong executor
+    waiter = asyncio.get_running_loop().run_in_executor(None, limiter["slots"].acquire)
 
-    if not keywords:
-        return pd.DataFrame()
+    try:
+        await asyncio.shield(waiter)
+    except asyncio.CancelledError:
+        # bị huỷ (timeout) khi đang chờ: lấy được slot thì trả lại ngay
+        waiter.add_done_callback(lambda _: limiter["slots"].release())
+        raise
 
-    results = []
 
-    for _, row in df.iterrows():
+async def acall_with_limits(backend, fn, *args, **kwargs):
 
-        # CHỈ LẤY TÊN TOUR ĐỂ SO SÁNH
-        tour_name = str(row.get("Tour (Tên tour)", "")).lower()
+    # bản async cho event loop của AI: chờ bằng asyncio.sleep / semaphore, không chặn loop
+    limiter = _rate_limiters()[backend]
+    async_slots = _async_slots(backend)
+    attempt = 0
 
-        matched = False
+    while True:
 
-        for kw in keywords:
-            if kw in tour_name:
-                matched = True
-                break
+        started = time.monotonic()
+        _update_metrics(limiter, queue=1)
 
-        if matched:
-            results.append(row)
+        try:
+            delay = _take_token(limiter, backend)
 
-    if not results:
-        return pd.DataFrame()
+            while delay:
+                await asyncio.sleep(delay)
+                delay = _take_token(limiter, backend)
 
-    return pd.DataFrame(results)
+            await async_slots.acquire()
 
+            try:
+                await _acquire_slot(limiter)
+            except BaseException:
+                async_slots.release()
+                raise
+        finally:
+            _update_metrics(limiter, queue=-1)
+
+        _record_wait(limiter, time.monotonic() - started)
+        _update_metrics(limiter, calls=1, in_flight=1)
+
+        # coroutine chạy xen kẽ trên cùng thread nên không dùng perf_span
+        call_started = time.perf_counter()
+        error = True
+
+        try:
+            result = await fn(*args, **kwargs)
+            error = False
+            return result
+
+        except Exception as e:
+
+            if attempt + 1 >= RETRY_ATTEMPTS or not is_retryable(e):
+                _update_metrics(limiter, errors=1)
+                raise
+
+        finally:
+            limiter["slots"].release()
+            async_slots.release()
+            _update_metrics(limiter, in_flight=-1)
+            record_span(
+                f"{backend}.{_op_name(fn)}",
+                time.perf_counter() - call_started,
+                0 if error else _payload_bytes(result),
+                error
+            )
 
-# =====================================================
-# DASHBOARD
-# =====================================================
+        _update_metrics(limiter, retries=1)
+        await asyncio.sleep(backoff_delay(attempt))
+        attempt += 1
 
-def render_dashboard():
 
-    st.title("📊 Dashboard")
+def rate_limit_metrics():
 
-    df = load_sheet()
+    rows = []
 
-    if df.empty:
-        st.warning("Chưa có dữ liệu")
-        return
+    for backend, limiter in _rate_limiters().items():
 
-    # ===== CLEAN DATA =====
-    if "Giá" in df.columns:
-        df["Giá"] = (
-            df["Giá"]
-            .astype(str)
-            .str.replace(",", "", regex=False)
-            .str.replace("đ", "", regex=False)
-        )
-        df["Giá"] = pd.to_numeric(df["Giá"], errors="coerce").fillna(0)
+        with limiter["lock"]:
+            metrics = dict(limiter["metrics"])
 
-    if "Ngày" in df.columns:
-        df["Ngày"] = pd.to_datetime(df["Ngày"], errors="coerce")
+        metrics["wait_avg"] = metrics["wait_total"] / metrics["calls"] if metrics["calls"] else 0.0
+        rows.append({"backend": backend, **metrics})
 
-    # ===== TODAY (GIỜ VIỆT NAM) =====
-    from datetime import datetime, timedelta
+    return rows
 
-    vietnam_now = datetime.utcnow() + timedelta(hours=7)
-    today = vietnam_now.date()
 
-    if "Ngày" in df.columns:
-        today_df = df[df["Ngày"].dt.date == today]
-    else:
-        today_df = pd.DataFrame()
+# =====================================================
+# CHATGPT FUNCTION
+# =====================================================
 
-    # ===== METRICS =====
-    today_customers = len(today_df)
-    today_revenue = today_df["Giá"].sum()
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key):
 
-    total_customers = len(df)
-    total_revenue = df["Giá"].sum()
+    from openai import OpenAI
 
-    col1, col2, col3, col4 = st.columns(4)
+    # retry do call_with_limits đảm nhận
+    return OpenAI(api_key=api_key, max_retries=0)
 
-    col1.metric("Khách hôm nay", today_customers)
-    col2.metric("Doanh thu hôm nay", f"{today_revenue:,.0f} đ")
-    col3.metric("Tổng khách", total_customers)
-    col4.metric("Tổng doanh thu", f"{total_revenue:,.0f} đ")
 
-    st.divider()
+def ask_chatgpt(prompt, use_cache=True):
+    if not st.session_state.api_key:
+        return "Chưa nhập OpenAI API Key"
 
-    # ===== DOANH THU THEO TOUR =====
-    if "Tour" in df.columns:
+    use_cache = use_cache and st.session_state.llm_cache_enabled
+    cache_key = llm_cache_key(CHAT_MODEL, prompt)
 
-        route_df = df.groupby("Tour").agg({
-            "Tên": "count",
-            "Giá": "sum"
-        }).reset_index()
+    if use_cache:
+        cached = llm_cache_get(cache_key)
+        if cached is not None:
+            return cached
 
-        fig1 = px.bar(
-            route_df,
-            x="Tour",
-            y="Giá",
-            color="Tour",
-            title="Doanh thu theo Tour"
+    try:
+        client = get_openai_client(st.session_state.api_key)
+
+        response = call_with_limits(
+            "openai",
+            client.chat.completions.create,
+            model=CHAT_MODEL,  # Đã sửa từ gpt-4.1-mini thành gpt-4o-mini
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
         )
 
-        st.plotly_chart(fig1, use_container_width=True)
+        answer = response.choices[0].message.content
 
-    # ===== DOANH THU THEO NGÀY =====
-    if "Ngày" in df.columns:
+        if use_cache and answer:
+            llm_cache_put(cache_key, CHAT_MODEL, answer)
 
-        daily = df.groupby(df["Ngày"].dt.date)["Giá"].sum().reset_index()
+        return answer
 
-        fig2 = px.line(
-            daily,
-            x="Ngày",
-            y="Giá",
-            markers=True,
-            title="Doanh thu theo ngày"
-        )
+    except Exception as e:
+        return str(e)
 
-        st.plotly_chart(fig2, use_container_width=True)
 
-# =====================================================
-# SALES CENTER
-# =====================================================
+def ask_chatgpt_stream(prompt, use_cache=True, errors=None):
 
-def render_sales_center():
+    # Generator trả từng đoạn text ngay khi OpenAI gửi về (dùng với st.write_stream).
+    # Rerun / bấm Dừng sẽ đóng generator → đóng luôn kết nối stream.
+    # errors (list): nhận thông báo lỗi để nơi gọi phân biệt lỗi với câu trả lời
+    if not st.session_state.api_key:
+        if errors is not None:
+            errors.append("Chưa nhập OpenAI API Key")
+        yield "Chưa nhập OpenAI API Key"
+        return
 
-    col_left, col_mid, col_right = st.columns([1, 2, 1])
+    use_cache = use_cache and st.session_state.llm_cache_enabled
+    cache_key = llm_cache_key(CHAT_MODEL, prompt)
 
-    # ================= LEFT =================
-    with col_left:
+    if use_cache:
+        cached = llm_cache_get(cache_key)
+        if cached is not None:
+            yield cached
+            return
 
-        st.subheader("Khách hàng")
+    parts = []
+    stream = None
+    started = time.perf_counter()
+    error = False
 
-        for cust in st.session_state.customer_list:
-            if st.button(f"{cust['name']} - {cust['time']}", key=cust["id"]):
-                st.session_state.selected_customer = cust
+    try:
+        client = get_openai_client(st.session_state.api_key)
 
-                # reset chat khi chọn khách
-                st.session_state.chat_messages = [
-                    {"role": "customer", "content": cust["msg"]}
+        stream = call_with_limits(
+            "openai",
+            client.chat.completions.create,
+            model=CHAT_MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            stream=True
+        )
+
+        for event in stream:
+            if event.choices and event.choices[0].delta.content:
+                parts.append(event.choices[0].delta.content)
+                yield parts[-1]
+
+    except Exception as e:
+        error = True
+        if errors is not None:
+            errors.append(str(e))
+        yield str(e)
+        return
+
+    finally:
+        if stream is not None:
+            stream.close()
+
+        # cả lượt stream (tới khi xong / bấm Dừng); thời gian tới token đầu
+        # nằm ở openai.Completions.create
+        record_span(
+            "openai.stream",
+            time.perf_counter() - started,
+            sum(len(p.encode("utf-8")) for p in parts),
+            error
+        )
+
+    answer = "".join(parts)
+
+    if use_cache and answer:
+        llm_cache_put(cache_key, CHAT_MODEL, answer)
+
+
+def stream_answer(prompt, errors=None):
+
+    # Hiển thị câu trả lời dạng stream kèm nút Dừng, trả về text đầy đủ
+    st.button("⏹ Dừng", key=f"stop_{hashlib.md5(prompt.encode('utf-8')).hexdigest()[:8]}")
+
+    return st.write_stream(ask_chatgpt_stream(prompt, errors=errors))
+# =====================================================
+# LLM RESPONSE CACHE (SQLITE)
+# =====================================================
+# Key = model + system prompt + prompt đã chuẩn hoá khoảng trắng.
+# Hết hạn sau LLM_CACHE_TTL; vượt LLM_CACHE_MAX_ENTRIES thì xoá các
+# câu ít được dùng gần đây nhất. Lỗi cache không làm hỏng câu trả lời.
+
+def connect_llm_cache():
+
+    conn = sqlite3.connect(LLM_CACHE_DB, timeout=30)
+
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache(last_used_at)"
+    )
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+
+    return conn
+
+
+def normalize_prompt(prompt):
+    return " ".join(unicodedata.normalize("NFC", prompt).split())
+
+
+def llm_cache_key(model, prompt):
+
+    payload = "\0".join([model, SYSTEM_PROMPT, normalize_prompt(prompt)])
+
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _bump_llm_stat(conn, name):
+    conn.execute(
+        """
+        INSERT INTO llm_cache_stats (name, value) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET value = value + 1
+        """,
+        (name,)
+    )
+
+
+def llm_cache_get(key):
+
+    try:
+        conn = connect_llm_cache()
+    except sqlite3.Error:
+        return None
+
+    try:
+        with conn:
+
+            now = time.time()
+            row = conn.execute(
+                "SELECT response, created_at FROM llm_cache WHERE key = ?",
+                (key,)
+            ).fetchone()
+
+            if row is None or now - row[1] > LLM_CACHE_TTL:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                _bump_llm_stat(conn, "misses")
+                return None
+
+            conn.execute(
+                "UPDATE llm_cache SET last_used_at = ?, hits = hits + 1 WHERE key = ?",
+                (now, key)
+            )
+            _bump_llm_stat(conn, "hits")
+
+            return row[0]
+
+    except sqlite3.Error:
+        return None
+
+    finally:
+        conn.close()
+
+
+def llm_cache_put(key, model, response):
+
+    try:
+        conn = connect_llm_cache()
+    except sqlite3.Error:
+        return
+
+    try:
+        with conn:
+
+            now = time.time()
+
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO llm_cache (key, model, response, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (key, model, response, now, now)
+            )
+
+            # TTL rồi LRU
+            conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?",
+                (now - LLM_CACHE_TTL,)
+            )
+            conn.execute(
+                """
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache
+                    ORDER BY last_used_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+                """,
+                (LLM_CACHE_MAX_ENTRIES,)
+            )
+
+    except sqlite3.Error:
+        pass
+
+    finally:
+        conn.close()
+
+
+def llm_cache_stats():
+
+    conn = connect_llm_cache()
+
+    try:
+        stats = dict(conn.execute("SELECT name, value FROM llm_cache_stats"))
+        entries = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+    finally:
+        conn.close()
+
+    return {
+        "hits": stats.get("hits", 0),
+        "misses": stats.get("misses", 0),
+        "entries": entries
+    }
+
+
+def clear_llm_cache():
+
+    conn = connect_llm_cache()
+
+    try:
+        with conn:
+            conn.execute("DELETE FROM llm_cache")
+            conn.execute("DELETE FROM llm_cache_stats")
+    finally:
+        conn.close()
+# =====================================================
+# ASYNC LLM
+# =====================================================
+# Một event loop nền + một AsyncOpenAI client cho mỗi process.
+# ask_chatgpt_many() gửi nhiều prompt cùng lúc và chờ lấy đủ kết quả,
+# mỗi prompt có timeout riêng. Chạy từ script thread của Streamlit.
+
+@st.cache_resource(show_spinner=False)
+def _llm_event_loop():
+
+    loop = asyncio.new_event_loop()
+
+    threading.Thread(
+        target=loop.run_forever,
+        name="llm-event-loop",
+        daemon=True
+    ).start()
+
+    return loop
+
+
+@st.cache_resource(show_spinner=False)
+def get_async_openai_client(api_key):
+
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(api_key=api_key, max_retries=0)
+
+
+async def ask_chatgpt_async(prompt, client, use_cache=True, timeout=LLM_TIMEOUT):
+
+    # cache hit đã được lấy trước ở ask_chatgpt_many; SQLite là I/O chặn
+    # nên ghi cache chạy trong executor, không chặn event loop
+    try:
+        response = await asyncio.wait_for(
+            acall_with_limits(
+                "openai",
+                client.chat.completions.create,
+                model=CHAT_MODEL,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
                 ]
+            ),
+            timeout
+        )
+
+        answer = response.choices[0].message.content
+
+        if use_cache and answer:
+            await asyncio.get_running_loop().run_in_executor(
+                None, llm_cache_put, llm_cache_key(CHAT_MODEL, prompt), CHAT_MODEL, answer
+            )
+
+        return answer, None
+
+    except asyncio.TimeoutError:
+        return None, f"⏱ AI không trả lời trong {timeout}s"
+
+    except Exception as e:
+        return None, str(e)
+
+
+def ask_chatgpt_many(prompts, timeout=LLM_TIMEOUT, use_cache=True):
+
+    # trả về [(câu trả lời, lỗi)] theo thứ tự prompts; lỗi = None nếu thành công
+    if not st.session_state.api_key:
+        return [(None, "Chưa nhập OpenAI API Key")] * len(prompts)
+
+    client = get_async_openai_client(st.session_state.api_key)
+    use_cache = use_cache and st.session_state.llm_cache_enabled
+
+    # tra cache ngay trên script thread, chỉ gửi prompt chưa có sang event loop
+    results = [
+        (llm_cache_get(llm_cache_key(CHAT_MODEL, prompt)) if use_cache else None, None)
+        for prompt in prompts
+    ]
+    missing = [i for i, (answer, _) in enumerate(results) if answer is None]
+
+    async def run_all():
+        return await asyncio.gather(*(
+            ask_chatgpt_async(prompts[i], client, use_cache, timeout)
+            for i in missing
+        ))
+
+    if missing:
+        future = asyncio.run_coroutine_threadsafe(run_all(), _llm_event_loop())
+
+        for i, result in zip(missing, future.result()):
+            results[i] = result
+
+    return results
+
+
+# =====================================================
+# PROMPT BUILDER
+# =====================================================
+# Đếm token và chia ngân sách: system + khung prompt + câu hỏi trước,
+# phần còn lại cho dữ liệu tham khảo. Dữ liệu được truyền theo thứ tự
+# quan trọng giảm dần; đoạn cuối bị cắt bớt hoặc bỏ khi hết ngân sách.
+
+@st.cache_resource(show_spinner=False)
+def _token_encoding():
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(CHAT_MODEL)
+    except Exception:
+        return None
+
+
+def count_tokens(text):
+
+    encoding = _token_encoding()
+
+    if encoding is not None:
+        return len(encoding.encode(text))
+
+    # không có tiktoken: ước lượng ~4 byte UTF-8 / token
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+def truncate_tokens(text, max_tokens):
+
+    if max_tokens <= 0:
+        return ""
+
+    encoding = _token_encoding()
+
+    if encoding is not None:
+        tokens = encoding.encode(text)
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+    data = text.encode("utf-8")
+
+    return text if len(data) <= max_tokens * 4 else data[:max_tokens * 4].decode("utf-8", "ignore")
+
+
+def _context_text(item):
+    return item if isinstance(item, str) else item["text"]
+
+
+def _with_text(item, text):
+    return text if isinstance(item, str) else {**item, "text": text}
+
+
+def build_prompt(template, context=(), render=None, budget=PROMPT_TOKEN_BUDGET, **fields):
+
+    render = render or (lambda items: "\n\n".join(_context_text(i) for i in items))
+
+    fields = {
+        name: truncate_tokens(str(value), QUESTION_TOKEN_BUDGET)
+        for name, value in fields.items()
+    }
+
+    fixed = count_tokens(SYSTEM_PROMPT) + count_tokens(template.format(context="", **fields))
+    remaining = budget - fixed
+
+    selected = []
+    used = 0
+
+    for item in context:
+
+        cost = count_tokens(render([item]))
+
+        if used + cost <= remaining:
+            selected.append(item)
+            used += cost
+            continue
+
+        # đoạn không vừa: cắt bớt cho vừa phần còn lại rồi dừng
+        # (chừa vài token cho dấu nối giữa các đoạn)
+        room = remaining - used - (cost - count_tokens(_context_text(item))) - 8
+        text = truncate_tokens(_context_text(item), room)
+
+        if text:
+            selected.append(_with_text(item, text))
+
+        break
+
+    prompt = template.format(context=render(selected), **fields)
+    tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(prompt)
+
+    # header / dấu nối giữa các đoạn có thể làm vượt nhẹ → bỏ bớt đoạn cuối
+    while selected and tokens > budget:
+        selected.pop()
+        prompt = template.format(context=render(selected), **fields)
+        tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(prompt)
+
+    info = {
+        "tokens": tokens,
+        "budget": budget,
+        "context_used": len(selected),
+        "context_total": len(context),
+    }
+
+    record_prompt(info)
+
+    return prompt, info
+# =====================================================
+# GOOGLE CLIENT POOL
+# =====================================================
+# Authorize một lần cho mỗi process, token được làm mới ở thread nền.
+# gspread dùng chung một AuthorizedSession (requests) cho mọi thread;
+# Drive dùng httplib2 (không thread-safe) nên mỗi thread có Http riêng
+# nhưng vẫn dùng chung credentials.
+
+def _refresh_token_loop(creds):
+
+    from google.auth.transport.requests import Request
+
+    while True:
+        try:
+            expiry = creds.expiry
+            if (
+                not creds.valid
+                or expiry is None
+                or (expiry - datetime.utcnow()).total_seconds() < TOKEN_REFRESH_MARGIN
+            ):
+                with perf_span("google.token_refresh"):
+                    creds.refresh(Request())
+        except Exception:
+            pass
+
+        time.sleep(60)
+
+
+@st.cache_resource(show_spinner=False)
+def get_google_credentials(scopes):
+
+    from google.auth.transport.requests import Request
+    from google.oauth2.service_account import Credentials
+
+    creds = Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"],
+        scopes=list(scopes)
+    )
+
+    with perf_span("google.token_refresh"):
+        creds.refresh(Request())
+
+    threading.Thread(
+        target=_refresh_token_loop,
+        args=(creds,),
+        name="google-token-refresh",
+        daemon=True
+    ).start()
+
+    return creds
+
+
+@st.cache_resource(show_spinner=False)
+def get_gspread_client():
+
+    import gspread
+
+    client = gspread.authorize(get_google_credentials(SHEET_SCOPE))
+
+    # đếm bytes từng response vào span Sheets đang mở
+    session = getattr(getattr(client, "http_client", None), "session", None)
+
+    if session is not None:
+        session.hooks["response"].append(_count_response_bytes)
+
+    return client
+
+
+def _count_response_bytes(response, *args, **kwargs):
+    add_span_bytes(len(response.content))
+
+
+@st.cache_resource(ttl=HANDLE_CACHE_TTL, show_spinner=False)
+def open_spreadsheet(url):
+    return call_with_limits("sheets", get_gspread_client().open_by_url, url)
+
+
+@st.cache_resource(ttl=HANDLE_CACHE_TTL, show_spinner=False)
+def open_worksheet(url, worksheet_name=None):
+
+    spreadsheet = open_spreadsheet(url)
+
+    # Nếu có tên worksheet thì mở, không thì mở sheet đầu tiên
+    if worksheet_name:
+        return call_with_limits("sheets", spreadsheet.worksheet, worksheet_name)
+
+    return spreadsheet.sheet1
+
+
+@st.cache_resource(show_spinner=False)
+def get_drive_service():
+
+    from googleapiclient.discovery import build
+
+    return build(
+        "drive",
+        "v3",
+        credentials=get_google_credentials(DRIVE_SCOPE),
+        cache_discovery=False
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def _drive_thread_local():
+    return threading.local()
+
+
+def drive_http():
+    local = _drive_thread_local()
+
+    if not hasattr(local, "http"):
+
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+
+        local.http = AuthorizedHttp(
+            get_google_credentials(DRIVE_SCOPE),
+            http=httplib2.Http(timeout=DRIVE_FILE_TIMEOUT)
+        )
+
+    return local.http
+
+
+# =====================================================
+# GOOGLE SHEET
+# =====================================================
+
+def connect_sheet(url, worksheet_name=None):
+    return open_worksheet(url, worksheet_name)
+
+
+# =====================================================
+# SHEET CACHE
+# =====================================================
+# Cache dùng chung cho toàn bộ process (mọi session / mọi rep).
+# Mỗi sheet URL có một data version; ghi vào sheet thì tăng version
+# nên lần đọc sau sẽ lấy dữ liệu mới thay vì bản cache cũ.
+
+@st.cache_resource
+def _sheet_versions():
+    return {"lock": threading.Lock(), "versions": {}}
+
+
+def get_data_version(url):
+    store = _sheet_versions()
+    with store["lock"]:
+        return store["versions"].get(url, 0)
+
+
+def bump_data_version(url):
+    store = _sheet_versions()
+    with store["lock"]:
+        store["versions"][url] = store["versions"].get(url, 0) + 1
+        return store["versions"][url]
+
+
+def invalidate_sheet_cache(url=None):
+    if url:
+        bump_data_version(url)
+    else:
+        fetch_sheet_records.clear()
+
+
+@st.cache_data(
+    ttl=SHEET_CACHE_TTL,
+    max_entries=SHEET_CACHE_MAX_ENTRIES,
+    show_spinner=False
+)
+def fetch_sheet_records(url, worksheet_name=None, version=0):
+    # version chỉ dùng làm cache key
+    sheet = connect_sheet(url, worksheet_name)
+    return pd.DataFrame(call_with_limits("sheets", sheet.get_all_records))
+
+
+@st.cache_resource
+def _last_good_sheets():
+    return {}
+
+
+@st.cache_resource
+def _sheet_patches():
+    return {}
+
+
+def patch_cached_sheet(url, df, worksheet_name=None):
+
+    # Sau khi tự ghi lên sheet: tăng version và dùng bản đã sửa tại chỗ
+    # cho version mới, không phải tải lại toàn bộ sheet
+    version = bump_data_version(url)
+
+    _sheet_patches()[(url, worksheet_name)] = {
+        "version": version,
+        "at": time.time(),
+        "df": df.reset_index(drop=True)
+    }
+
+
+def load_cached_sheet(url, worksheet_name=None):
+
+    last_good = _last_good_sheets()
+    patch = _sheet_patches().get((url, worksheet_name))
+
+    if (
+        patch
+        and patch["version"] == get_data_version(url)
+        and time.time() - patch["at"] < SHEET_CACHE_TTL
+    ):
+        return patch["df"].copy()
+
+    try:
+        df = fetch_sheet_records(url, worksheet_name, get_data_version(url))
+    except Exception as e:
+        # Sheets quá tải / lỗi mạng → dùng bản đọc được gần nhất thay vì bảng rỗng
+        if (url, worksheet_name) not in last_good:
+            raise
+
+        loaded_at, df = last_good[(url, worksheet_name)]
+        st.warning(
+            f"⚠️ Google Sheet tạm thời không phản hồi ({e}). "
+            f"Đang hiển thị dữ liệu lúc {datetime.fromtimestamp(loaded_at):%H:%M:%S}."
+        )
+        return df.copy()
+
+    last_good[(url, worksheet_name)] = (time.time(), df.copy(deep=False))
+
+    return df
+
+
+def sheets_load_orders():
+    try:
+        return load_cached_sheet(st.session_state.sheet_url)
+    except Exception as e:
+        if st.session_state.sheet_url:
+            st.error(f"Không tải được Google Sheet: {e}")
+        return pd.DataFrame()
+
+
+def load_tour_sheet():
+    try:
+        return load_cached_sheet(st.session_state.tour_sheet_url)
+    except:
+        return pd.DataFrame()
+
+
+def load_guide_sheet(worksheet_name=None):
+    try:
+        return load_cached_sheet(st.session_state.guide_sheet_url, worksheet_name)
+    except Exception as e:
+        st.error(f"Lỗi: {e}")
+        return pd.DataFrame()
+def get_guide_worksheets():
+    try:
+        spreadsheet = open_spreadsheet(st.session_state.guide_sheet_url)
+        return [sh.title for sh in call_with_limits("sheets", spreadsheet.worksheets)]
+    except:
+        return []
+def sheets_append_order(row):
+    try:
+        journal_order(st.session_state.sheet_url, row)
+        return True
+    except Exception as e:
+        st.error(e)
+        return False
+
+
+# =====================================================
+# TYPED SNAPSHOT
+# =====================================================
+# Bản chụp có kiểu của sheet để tính toán: giá giữ chuỗi gốc để hiển thị,
+# kèm cột số VND (NaN nếu là khoảng giá / chữ), ngày là datetime, cột lặp
+# nhiều (tour, kênh, sale) là categorical. Ghi ra file
+# Arrow IPC và mở lại bằng memory-map, mọi session dùng chung một frame.
+# Màn hình sửa đơn vẫn dùng bản chuỗi gốc vì so sánh với giá trị trên sheet.
+
+@st.cache_resource
+def _typed_snapshots():
+    return {}
+
+
+def typed_frame(df, schema):
+
+    columns = {}
+
+    for column in df.columns:
+
+        values = df[column].reset_index(drop=True)
+        kind = schema.get(column)
+
+        if kind == "price":
+            columns[price_value_column(column)] = parse_price(values)
+            values = values.astype(str)
+        elif kind == "date":
+            values = pd.to_datetime(values, errors="coerce")
+        else:
+            values = values.astype(str)
+            if kind == "category" or values.nunique() <= len(values) // 2:
+                values = values.astype("category")
+
+        columns[column] = values
+
+    return pd.DataFrame(columns, index=pd.RangeIndex(len(df)))
+
+
+def _snapshot_path(url, worksheet_name=None):
+    key = hashlib.sha1(f"{url}|{worksheet_name or ''}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(SNAPSHOT_DIR, f"{key}.arrow")
+
+
+def _frame_hash(df, schema=None):
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{SNAPSHOT_FORMAT}|{sorted((schema or {}).items())}".encode("utf-8"))
+    digest.update("|".join(map(str, df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+
+    return digest.hexdigest()
+
+
+def read_snapshot(path, source_hash):
+
+    import pyarrow as pa
+    import pyarrow.ipc
+
+    try:
+        reader = pa.ipc.open_file(pa.memory_map(path, "r"))
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+    if (reader.schema.metadata or {}).get(b"source_hash") != source_hash.encode():
+        return None
+
+    # split_blocks: cột số trỏ thẳng vào vùng nhớ map từ file, không copy
+    return reader.read_all().to_pandas(split_blocks=True)
+
+
+def write_snapshot(path, df, source_hash):
+
+    import pyarrow as pa
+    import pyarrow.ipc
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        b"source_hash": source_hash.encode()
+    })
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+
+    with pa.OSFile(tmp, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    os.replace(tmp, path)
+
+
+def load_typed_sheet(url, schema, worksheet_name=None):
+
+    snapshots = _typed_snapshots()
+    version = get_data_version(url)
+    entry = snapshots.get((url, worksheet_name))
+
+    if (
+        entry
+        and entry["version"] == version
+        and time.time() - entry["at"] < SHEET_CACHE_TTL
+    ):
+        return entry["df"]
+
+    if url == LOCAL_ORDER_SOURCE:
+        raw = load_local_orders()
+    else:
+        raw = load_cached_sheet(url, worksheet_name)
+
+    source_hash = _frame_hash(raw, schema)
+    path = _snapshot_path(url, worksheet_name)
+
+    # sheet không đổi so với lần chụp trước (kể cả từ process khác) → chỉ map file
+    df = read_snapshot(path, source_hash)
+
+    if df is None:
+        df = typed_frame(raw, schema)
+        try:
+            write_snapshot(path, df, source_hash)
+            mapped = read_snapshot(path, source_hash)
+            if mapped is not None:
+                df = mapped
+        except OSError:
+            pass
+
+    snapshots[(url, worksheet_name)] = {"version": version, "at": time.time(), "df": df}
+
+    return df
+
+
+# =====================================================
+# ORDER JOURNAL (WRITE-BEHIND)
+# =====================================================
+# Đơn chốt được ghi vào SQLite (WAL) và xác nhận ngay cho sale.
+# Thread nền gom đơn và đẩy lên sheet bằng một lần append_rows.
+# Mỗi đơn có mã ở cột ID: lần gửi lại (sau lỗi / restart) sẽ đọc cột ID
+# và bỏ qua đơn đã lên sheet, nên mỗi đơn chỉ được ghi đúng một lần.
+
+def connect_order_journal():
+
+    conn = sqlite3.connect(ORDER_JOURNAL_DB, timeout=30)
+
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS order_journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT NOT NULL UNIQUE,
+            sheet_url TEXT NOT NULL,
+            row_json TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            sent_at REAL,
+            claimed_by TEXT,
+            claimed_at REAL
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_order_journal_pending ON order_journal(sent_at, id)"
+    )
+
+    # journal tạo trước khi có claim
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(order_journal)")}
+
+    if "claimed_by" not in columns:
+        conn.execute("ALTER TABLE order_journal ADD COLUMN claimed_by TEXT")
+        conn.execute("ALTER TABLE order_journal ADD COLUMN claimed_at REAL")
+
+    return conn
+
+
+def new_order_id():
+    # có tiền tố chữ để get_all_records không đọc nhầm thành số
+    return "DH" + uuid.uuid4().hex[:12].upper()
+
+
+def journal_order(sheet_url, row):
+
+    if not sheet_url:
+        raise ValueError("Chưa cấu hình Link Sheet Orders trong Settings.")
+
+    order_id = new_order_id()
+    conn = connect_order_journal()
+
+    try:
+        with conn:
+            conn.execute(
+                """
+                INSERT INTO order_journal (order_id, sheet_url, row_json, created_at)
+                VALUES (?, ?, ?, ?)
+                """,
+                (order_id, sheet_url, json.dumps(row, ensure_ascii=False), time.time())
+            )
+    finally:
+        conn.close()
+
+    get_order_flusher()["wake"].set()
+
+    return order_id
+
+
+def pending_orders(sheet_url=None):
+
+    conn = connect_order_journal()
+
+    try:
+        query = "SELECT order_id, row_json, attempts, last_error FROM order_journal WHERE sent_at IS NULL"
+        params = ()
+
+        if sheet_url:
+            query += " AND sheet_url = ?"
+            params = (sheet_url,)
+
+        return [
+            {"order_id": order_id, "row": json.loads(row_json), "attempts": attempts, "last_error": error}
+            for order_id, row_json, attempts, error in conn.execute(query + " ORDER BY id", params)
+        ]
+    finally:
+        conn.close()
+
+
+def claim_orders(sheet_url, limit):
+
+    # nhận đơn chờ gửi trong một transaction: nhiều process cùng đẩy đơn
+    # thì mỗi đơn chỉ thuộc về một lần flush
+    claim = uuid.uuid4().hex
+    now = time.time()
+    conn = connect_order_journal()
+
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            """
+            UPDATE order_journal SET claimed_by = ?, claimed_at = ?
+            WHERE id IN (
+                SELECT id FROM order_journal
+                WHERE sent_at IS NULL AND sheet_url = ?
+                  AND (claimed_by IS NULL OR claimed_at < ?)
+                ORDER BY id LIMIT ?
+            )
+            """,
+            (claim, now, sheet_url, now - ORDER_CLAIM_TIMEOUT, limit)
+        )
+        rows = conn.execute(
+            "SELECT order_id, row_json, attempts, last_error FROM order_journal WHERE claimed_by = ? ORDER BY id",
+            (claim,)
+        ).fetchall()
+        conn.commit()
+    finally:
+        conn.close()
+
+    return [
+        {"order_id": order_id, "row": json.loads(row_json), "attempts": attempts, "last_error": error}
+        for order_id, row_json, attempts, error in rows
+    ]
+
+
+def ensure_id_header(sheet):
+
+    header = call_with_limits("sheets", sheet.row_values, 1)
+
+    if ORDER_ID_COLUMN in header:
+        return header
+
+    call_with_limits("sheets", sheet.update_cell, 1, len(header) + 1, ORDER_ID_COLUMN)
+
+    return header + [ORDER_ID_COLUMN]
+
+
+def ensure_id_column(sheet):
+    return ensure_id_header(sheet).index(ORDER_ID_COLUMN) + 1
+
+
+def order_sheet_row(header, row, order_id):
+
+    if all(c in header for c in ORDER_COLUMNS):
+        record = {**dict(zip(ORDER_COLUMNS, row)), ORDER_ID_COLUMN: order_id}
+        return [record.get(c, "") for c in header]
+
+    # sheet đặt tên cột khác form: giữ thứ tự cột của form, chèn mã đơn
+    # đúng vị trí cột ID (kể cả khi cột ID nằm giữa / trước dữ liệu)
+    id_index = header.index(ORDER_ID_COLUMN)
+    row = list(row)
+
+    return row[:id_index] + [""] * (id_index - len(row)) + [order_id] + row[id_index:]
+
+
+def flush_orders(sheet_url, batch):
+
+    sheet = connect_sheet(sheet_url)
+    header = ensure_id_header(sheet)
+    id_col = header.index(ORDER_ID_COLUMN) + 1
+
+    conn = connect_order_journal()
+
+    try:
+        # đánh dấu đã thử TRƯỚC khi gửi: nếu app chết giữa chừng, lần sau
+        # sẽ biết batch này có thể đã lên sheet một phần
+        with conn:
+            conn.executemany(
+                "UPDATE order_journal SET attempts = attempts + 1 WHERE order_id = ?",
+                [(order["order_id"],) for order in batch]
+            )
+
+        if any(order["attempts"] > 0 for order in batch):
+            on_sheet = set(call_with_limits("sheets", sheet.col_values, id_col))
+            already = [o for o in batch if o["order_id"] in on_sheet]
+            batch = [o for o in batch if o["order_id"] not in on_sheet]
+
+            with conn:
+                conn.executemany(
+                    "UPDATE order_journal SET sent_at = ?, last_error = NULL WHERE order_id = ?",
+                    [(time.time(), o["order_id"]) for o in already]
+                )
+
+            # không biết lần trước đã cộng vào dashboard chưa → tính lại
+            if already:
+                drop_dashboard_aggregates(sheet_url)
+
+        if batch:
+
+            rows = [order_sheet_row(header, order["row"], order["order_id"]) for order in batch]
+            appended = None
+
+            begin_order_append(sheet_url)
+
+            # không retry trong limiter: lỗi thì journal gửi lại ở vòng sau,
+            # sau khi đối chiếu cột ID (attempts > 0) để không ghi trùng
+            try:
+                call_with_limits("sheets", sheet.append_rows, rows, retry=False)
+                appended = rows
+            finally:
+                add_appended_orders(sheet_url, header, appended)
+
+            with conn:
+                conn.executemany(
+                    "UPDATE order_journal SET sent_at = ?, last_error = NULL WHERE order_id = ?",
+                    [(time.time(), o["order_id"]) for o in batch]
+                )
+
+    finally:
+        conn.close()
+
+
+def _flush_loop(state):
+
+    while True:
+
+        if state["wake"].wait(ORDER_FLUSH_INTERVAL):
+            time.sleep(ORDER_FLUSH_LINGER)
+
+        state["wake"].clear()
+
+        try:
+            conn = connect_order_journal()
+
+            try:
+                urls = [
+                    row[0] for row in conn.execute(
+                        "SELECT DISTINCT sheet_url FROM order_journal WHERE sent_at IS NULL"
+                    )
+                ]
+            finally:
+                conn.close()
+
+            for url in urls:
+
+                batch = claim_orders(url, ORDER_FLUSH_BATCH)
+
+                if not batch:
+                    continue
+
+                try:
+                    flush_orders(url, batch)
+                except Exception as e:
+                    conn = connect_order_journal()
+                    try:
+                        with conn:
+                            conn.executemany(
+                                "UPDATE order_journal SET last_error = ?, claimed_by = NULL WHERE order_id = ?",
+                                [(str(e), o["order_id"]) for o in batch]
+                            )
+                    finally:
+                        conn.close()
+                    continue
+
+                invalidate_sheet_cache(url)
+
+                # còn đơn thì đẩy tiếp ngay, không chờ hết interval
+                if len(batch) == ORDER_FLUSH_BATCH:
+                    state["wake"].set()
+
+        except Exception:
+            pass
+
+
+@st.cache_resource
+def get_order_flusher():
+
+    state = {"wake": threading.Event()}
+
+    threading.Thread(
+        target=_flush_loop,
+        args=(state,),
+        name="order-flusher",
+        daemon=True
+    ).start()
+
+    return state
+
+
+# =====================================================
+# BULK ORDER OPERATIONS
+# =====================================================
+# Thao tác theo mã đơn (cột ID), không theo số dòng: vị trí dòng được đọc
+# lại từ cột ID ngay trước khi ghi. Sửa đơn kiểm tra giá trị hiện tại trên
+# sheet còn đúng như lúc sale nhìn thấy (optimistic check), sai thì dừng.
+# Mỗi thao tác chỉ gửi một request batchUpdate.
+
+def order_positions(sheet, id_col):
+
+    ids = call_with_limits("sheets", sheet.col_values, id_col)
+
+    return {str(order_id): row for row, order_id in enumerate(ids, 1) if row > 1 and order_id}
+
+
+def delete_sheet_rows(sheet, id_col, order_ids):
+
+    # xoá theo mã đơn: mỗi lần thử đọc lại vị trí từ cột ID rồi mới xoá
+    # (không retry lệnh xoá theo số dòng — lần trước có thể đã xoá xong)
+    attempt = 0
+
+    while True:
+
+        positions = order_positions(sheet, id_col)
+        rows = [positions[i] for i in order_ids if i in positions]
+
+        if not rows:
+            return
+
+        try:
+            # xoá từ dưới lên để số dòng phía trên không bị lệch
+            call_with_limits("sheets", sheet.spreadsheet.batch_update, {
+                "requests": [
+                    {
+                        "deleteDimension": {
+                            "range": {
+                                "sheetId": sheet.id,
+                                "dimension": "ROWS",
+                                "startIndex": row - 1,
+                                "endIndex": row
+                            }
+                        }
+                    }
+                    for row in sorted(rows, reverse=True)
+                ]
+            }, retry=False)
+            return
+
+        except Exception as e:
+            if attempt + 1 >= RETRY_ATTEMPTS or not is_retryable(e):
+                raise
+
+        time.sleep(backoff_delay(attempt))
+        attempt += 1
+
+
+def _patch_orders(url, update):
+
+    df = load_cached_sheet(url)
+
+    if ORDER_ID_COLUMN in df.columns:
+        patch_cached_sheet(url, update(df))
+    else:
+        invalidate_sheet_cache(url)
+        drop_dashboard_aggregates(url)
+
+
+def sheets_delete_orders(order_ids):
+
+    url = st.session_state.sheet_url
+
+    try:
+        sheet = connect_sheet(url)
+        id_col = ensure_id_column(sheet)
+        positions = order_positions(sheet, id_col)
+
+        missing = [i for i in order_ids if i not in positions]
+
+        if missing:
+            st.warning(f"Đơn {', '.join(missing)} đã bị xoá / thay đổi bởi người khác. Tải lại trang.")
+            invalidate_sheet_cache(url)
+            return False
+
+        delete_sheet_rows(sheet, id_col, order_ids)
+
+    except Exception as e:
+        st.error(e)
+        invalidate_sheet_cache(url)
+        return False
+
+    ids = set(order_ids)
+
+    def apply(df):
+        deleted = df[ORDER_ID_COLUMN].astype(str).isin(ids)
+        apply_order_delta(url, df[deleted], -1)
+        return df[~deleted]
+
+    _patch_orders(url, apply)
+
+    return True
+
+
+def cell_text(value):
+
+    from gspread.utils import numericise
+
+    # so giá trị ô đọc bằng batch_get (chuỗi đã format) với giá trị từ
+    # get_all_records (đã đổi sang số): "007" == 7, 1200000.0 == "1200000"
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ""
+
+    if isinstance(value, str):
+        value = numericise(value.strip())
+
+    if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+        value = float(value)
+        return str(int(value)) if value.is_integer() else repr(value)
+
+    return str(value)
+
+
+def sheets_update_orders(order_ids, column, value, expected):
+
+    from gspread.utils import rowcol_to_a1
+
+    # expected: {mã đơn: giá trị cột lúc sale nhìn thấy}
+    url = st.session_state.sheet_url
+
+    try:
+        sheet = connect_sheet(url)
+        positions = order_positions(sheet, ensure_id_column(sheet))
+        header = call_with_limits("sheets", sheet.row_values, 1)
+
+        missing = [i for i in order_ids if i not in positions]
+
+        if missing or column not in header:
+            st.warning("Dữ liệu trên sheet đã thay đổi. Tải lại trang rồi thử lại.")
+            invalidate_sheet_cache(url)
+            return False
+
+        col = header.index(column) + 1
+        cells = {i: rowcol_to_a1(positions[i], col) for i in order_ids}
+
+        current = call_with_limits("sheets", sheet.batch_get, list(cells.values()))
+
+        for order_id, values in zip(order_ids, current):
+            now = values[0][0] if values and values[0] else ""
+            if cell_text(now) != cell_text(expected.get(order_id, "")):
+                st.warning(f"Đơn {order_id} vừa được người khác sửa. Tải lại trang rồi thử lại.")
+                invalidate_sheet_cache(url)
+                return False
+
+        call_with_limits("sheets", sheet.batch_update, [
+            {"range": cell, "values": [[value]]}
+            for cell in cells.values()
+        ], retry=False)
+
+    except Exception as e:
+        st.error(e)
+        invalidate_sheet_cache(url)
+        return False
+
+    def apply(df):
+        df = df.copy()
+        changed = df[ORDER_ID_COLUMN].astype(str).isin(set(order_ids))
+        apply_order_delta(url, df[changed], -1)
+        df.loc[changed, column] = value
+        apply_order_delta(url, df[changed], 1)
+        return df
+
+    _patch_orders(url, apply)
+
+    return True
+
+
+def backfill_order_ids():
+
+    from gspread.utils import rowcol_to_a1
+
+    # gán mã cho các đơn cũ (trước khi có cột ID) bằng một lần ghi
+    url = st.session_state.sheet_url
+
+    try:
+        sheet = connect_sheet(url)
+        id_col = ensure_id_column(sheet)
+
+        ids = call_with_limits("sheets", sheet.col_values, id_col)
+        last_row = len(call_with_limits("sheets", sheet.col_values, 1))
+        ids += [""] * (last_row - len(ids))
+
+        updates = [
+            {"range": rowcol_to_a1(row, id_col), "values": [[new_order_id()]]}
+            for row in range(2, last_row + 1)
+            if not ids[row - 1]
+        ]
+
+        if updates:
+            call_with_limits("sheets", sheet.batch_update, updates, retry=False)
+
+    except Exception as e:
+        st.error(e)
+        return False
+
+    finally:
+        invalidate_sheet_cache(url)
+
+    return True
+
+
+# =====================================================
+# ORDER STORAGE
+# =====================================================
+# Nơi lưu đơn chọn qua config "order_storage":
+#   "sheets" — đọc / ghi thẳng Google Sheet (ghi qua journal ở trên)
+#   "sqlite" — đọc / ghi SQLite local (ORDER_DB); nếu có Link Sheet Orders
+#              thì thread nền đồng bộ (mirror) các đơn thay đổi lên sheet.
+# Mỗi đơn trong SQLite có rev / synced_rev: rev > synced_rev là đơn chưa
+# lên sheet. Đồng bộ theo mã đơn nên gửi lại bao nhiêu lần cũng không trùng.
+
+LOCAL_ORDER_SOURCE = "sqlite:" + ORDER_DB
+
+
+def _quoted(columns):
+    return ", ".join(f'"{c}"' for c in columns)
+
+
+def connect_order_store():
+
+    conn = sqlite3.connect(ORDER_DB, timeout=30)
+
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS orders (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT NOT NULL UNIQUE,
+            {", ".join(f'"{c}" TEXT NOT NULL DEFAULT ""' for c in ORDER_COLUMNS)},
+            rev INTEGER NOT NULL DEFAULT 1,
+            synced_rev INTEGER NOT NULL DEFAULT 0,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_day ON orders("Ngày")')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_tour ON orders("Tour")')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_sale ON orders("Sale")')
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_orders_unsynced ON orders(seq) WHERE rev > synced_rev"
+    )
+
+    return conn
+
+
+@st.cache_resource
+def _local_orders():
+    return {}
+
+
+def load_local_orders():
+
+    # mọi lần ghi local đều tăng version → cache theo version là chính xác
+    cache = _local_orders()
+    version = get_data_version(LOCAL_ORDER_SOURCE)
+    entry = cache.get("orders")
+
+    if not entry or entry[0] != version:
+
+        conn = connect_order_store()
+
+        try:
+            df = pd.read_sql_query(
+                f'SELECT {_quoted(ORDER_COLUMNS)}, order_id AS "{ORDER_ID_COLUMN}" '
+                "FROM orders WHERE deleted = 0 ORDER BY seq",
+                conn
+            )
+        finally:
+            conn.close()
+
+        entry = (version, df)
+        cache["orders"] = entry
+
+    return entry[1].copy()
+
+
+def _select_orders(conn, order_ids):
+
+    marks = ", ".join("?" * len(order_ids))
+
+    return pd.read_sql_query(
+        f'SELECT {_quoted(ORDER_COLUMNS)}, order_id AS "{ORDER_ID_COLUMN}" '
+        f"FROM orders WHERE deleted = 0 AND order_id IN ({marks})",
+        conn,
+        params=list(order_ids)
+    )
+
+
+def _local_orders_changed(before=None, after=None):
+
+    if before is not None:
+        apply_order_delta(LOCAL_ORDER_SOURCE, before, -1)
+
+    if after is not None:
+        apply_order_delta(LOCAL_ORDER_SOURCE, after, 1)
+
+    bump_data_version(LOCAL_ORDER_SOURCE)
+    get_order_syncer()["wake"].set()
+
+
+def sqlite_load_orders():
+    try:
+        return load_local_orders()
+    except Exception as e:
+        st.error(f"Không đọc được dữ liệu đơn: {e}")
+        return pd.DataFrame()
+
+
+def sqlite_append_order(row):
+
+    order_id = new_order_id()
+    values = dict(zip(ORDER_COLUMNS, (str(v) for v in row)))
+
+    try:
+        conn = connect_order_store()
+        try:
+            with conn:
+                conn.execute(
+                    f"INSERT INTO orders (order_id, {_quoted(values)}, updated_at) "
+                    f"VALUES (?, {', '.join('?' * len(values))}, ?)",
+                    (order_id, *values.values(), time.time())
+                )
+        finally:
+            conn.close()
+    except Exception as e:
+        st.error(e)
+        return False
+
+    _local_orders_changed(after=pd.DataFrame([{**values, ORDER_ID_COLUMN: order_id}]))
+
+    return True
+
+
+def sqlite_delete_orders(order_ids):
+
+    try:
+        conn = connect_order_store()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+
+            before = _select_orders(conn, order_ids)
+
+            if len(before) != len(set(order_ids)):
+                conn.rollback()
+                st.warning("Một số đơn đã bị xoá bởi người khác. Tải lại trang.")
+                return False
+
+            conn.executemany(
+                "UPDATE orders SET deleted = 1, rev = rev + 1, updated_at = ? WHERE order_id = ?",
+                [(time.time(), order_id) for order_id in order_ids]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        st.error(e)
+        return False
+
+    _local_orders_changed(before=before)
+
+    return True
+
+
+def sqlite_update_orders(order_ids, column, value, expected):
+
+    if column not in ORDER_COLUMNS:
+        st.warning(f"Không sửa được cột {column}.")
+        return False
+
+    try:
+        conn = connect_order_store()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+
+            before = _select_orders(conn, order_ids)
+            current = dict(zip(before[ORDER_ID_COLUMN], before[column]))
+
+            for order_id in order_ids:
+                if order_id not in current or cell_text(current[order_id]) != cell_text(expected.get(order_id, "")):
+                    conn.rollback()
+                    st.warning(f"Đơn {order_id} vừa được người khác sửa. Tải lại trang rồi thử lại.")
+                    return False
+
+            conn.executemany(
+                f'UPDATE orders SET "{column}" = ?, rev = rev + 1, updated_at = ? WHERE order_id = ?',
+                [(str(value), time.time(), order_id) for order_id in order_ids]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        st.error(e)
+        return False
+
+    after = before.copy()
+    after[column] = str(value)
+
+    _local_orders_changed(before=before, after=after)
+
+    return True
+
+
+def import_sheet_orders():
+
+    # lần đầu chuyển sang SQLite: chép các đơn đang có trên sheet về local
+    url = st.session_state.sheet_url
+
+    try:
+        df = load_cached_sheet(url)
+
+        if ORDER_ID_COLUMN not in df.columns or (df[ORDER_ID_COLUMN].astype(str) == "").any():
+            if not backfill_order_ids():
+                return 0
+            df = load_cached_sheet(url)
+
+        now = time.time()
+        rows = [
+            (str(record[ORDER_ID_COLUMN]), *(str(record.get(c, "")) for c in ORDER_COLUMNS), now)
+            for record in df.to_dict("records")
+        ]
+
+        conn = connect_order_store()
+        try:
+            with conn:
+                imported = conn.executemany(
+                    f"INSERT OR IGNORE INTO orders (order_id, {_quoted(ORDER_COLUMNS)}, rev, synced_rev, updated_at) "
+                    f"VALUES (?, {', '.join('?' * len(ORDER_COLUMNS))}, 1, 1, ?)",
+                    rows
+                ).rowcount
+        finally:
+            conn.close()
+
+    except Exception as e:
+        st.error(e)
+        return 0
+
+    bump_data_version(LOCAL_ORDER_SOURCE)
+    drop_dashboard_aggregates(LOCAL_ORDER_SOURCE)
+
+    return imported
+
+
+def unsynced_order_count():
+
+    conn = connect_order_store()
+
+    try:
+        return conn.execute("SELECT COUNT(*) FROM orders WHERE rev > synced_rev").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def sync_orders_to_sheet(sheet_url):
+
+    from gspread.utils import rowcol_to_a1
+
+    conn = connect_order_store()
+
+    try:
+        dirty = conn.execute(
+            f"SELECT order_id, {_quoted(ORDER_COLUMNS)}, rev, deleted "
+            "FROM orders WHERE rev > synced_rev ORDER BY seq LIMIT ?",
+            (ORDER_SYNC_BATCH,)
+        ).fetchall()
+
+        if not dirty:
+            return 0
+
+        sheet = connect_sheet(sheet_url)
+        header = call_with_limits("sheets", sheet.row_values, 1)
+        appends = []
+
+        if not header:
+            header = ORDER_COLUMNS + [ORDER_ID_COLUMN]
+            appends.append(header)
+        elif ORDER_ID_COLUMN not in header:
+            ensure_id_column(sheet)
+            header = header + [ORDER_ID_COLUMN]
+
+        positions = order_positions(sheet, header.index(ORDER_ID_COLUMN) + 1)
+
+        updates = []
+        deletes = []
+
+        for order_id, *values, rev, deleted in dirty:
+
+            record = dict(zip(ORDER_COLUMNS, values))
+            record[ORDER_ID_COLUMN] = order_id
+
+            if deleted:
+                if order_id in positions:
+                    deletes.append(order_id)
+            elif order_id in positions:
+                updates += [
+                    {
+                        "range": rowcol_to_a1(positions[order_id], header.index(c) + 1),
+                        "values": [[record[c]]]
+                    }
+                    for c in ORDER_COLUMNS
+                    if c in header
+                ]
+            else:
+                appends.append([record.get(c, "") for c in header])
+
+        # sửa trước khi xoá để số dòng đọc được vẫn đúng; lỗi thì lần đồng bộ
+        # sau đọc lại vị trí theo mã đơn rồi gửi lại (kể cả append: đơn đã lên
+        # sheet thì lần sau thành cập nhật, không ghi trùng)
+        if updates:
+            call_with_limits("sheets", sheet.batch_update, updates, retry=False)
+
+        if deletes:
+            delete_sheet_rows(sheet, header.index(ORDER_ID_COLUMN) + 1, deletes)
+
+        if appends:
+            call_with_limits("sheets", sheet.append_rows, appends, retry=False)
+
+        with conn:
+            conn.executemany(
+                "UPDATE orders SET synced_rev = ? WHERE order_id = ? AND rev = ?",
+                [(rev, order_id, rev) for order_id, *_, rev, _ in dirty]
+            )
+            conn.execute("DELETE FROM orders WHERE deleted = 1 AND rev = synced_rev")
+
+    finally:
+        conn.close()
+
+    invalidate_sheet_cache(sheet_url)
+
+    return len(dirty)
+
+
+def _sync_loop(state):
+
+    while True:
+
+        state["wake"].wait(ORDER_SYNC_INTERVAL)
+        state["wake"].clear()
+
+        if not state["sheet_url"]:
+            continue
+
+        try:
+            synced = sync_orders_to_sheet(state["sheet_url"])
+            state["last_error"] = None
+        except Exception as e:
+            state["last_error"] = str(e)
+            continue
+
+        if synced == ORDER_SYNC_BATCH:
+            state["wake"].set()
+
+
+@st.cache_resource
+def get_order_syncer():
+
+    state = {"wake": threading.Event(), "sheet_url": "", "last_error": None}
+
+    threading.Thread(
+        target=_sync_loop,
+        args=(state,),
+        name="order-syncer",
+        daemon=True
+    ).start()
+
+    return state
+
+
+ORDER_STORAGE_BACKENDS = {
+    "sheets": {
+        "load": sheets_load_orders,
+        "append": sheets_append_order,
+        "delete": sheets_delete_orders,
+        "update": sheets_update_orders,
+    },
+    "sqlite": {
+        "load": sqlite_load_orders,
+        "append": sqlite_append_order,
+        "delete": sqlite_delete_orders,
+        "update": sqlite_update_orders,
+    },
+}
+
+
+def order_storage():
+    storage = config.get("order_storage", "sheets")
+    return storage if storage in ORDER_STORAGE_BACKENDS else "sheets"
+
+
+def order_source():
+    # key dùng cho data version / dashboard / snapshot của kho đơn đang dùng
+    if order_storage() == "sqlite":
+        return LOCAL_ORDER_SOURCE
+    return st.session_state.sheet_url
+
+
+def load_sheet():
+    return ORDER_STORAGE_BACKENDS[order_storage()]["load"]()
+
+
+def save_to_sheet(row):
+    return ORDER_STORAGE_BACKENDS[order_storage()]["append"](row)
+
+
+def delete_orders(order_ids):
+    return ORDER_STORAGE_BACKENDS[order_storage()]["delete"](order_ids)
+
+
+def update_orders(order_ids, column, value, expected):
+    return ORDER_STORAGE_BACKENDS[order_storage()]["update"](order_ids, column, value, expected)
+
+
+# =============================
+# CONNECT GOOGLE DRIVE
+# =============================
+
+def connect_drive():
+    return get_drive_service()
+
+
+# =============================
+# LOAD ALL TOUR DATA FROM DRIVE
+# =============================
+
+def extract_drive_id(link):
+    import re
+    match = re.search(r'/folders/([a-zA-Z0-9_-]+)', link)
+    return match.group(1) if match else link
+
+
+# =============================
+# TEXT NORMALIZE / CHUNK
+# =============================
+
+def chunk_text(text, size=DRIVE_CHUNK_SIZE, overlap=DRIVE_CHUNK_OVERLAP):
+
+    chunks = []
+    start = 0
+
+    while start < len(text):
+
+        end = min(len(text), start + size)
+
+        # cắt ở khoảng trắng gần nhất để không cắt đôi từ
+        if end < len(text):
+            space = text.rfind(" ", start + size // 2, end)
+            if space != -1:
+                end = space
+
+        chunks.append(text[start:end].strip())
+
+        if end == len(text):
+            break
+
+        start = max(start + 1, end - overlap)
+
+    return [c for c in chunks if c]
+
+
+# =============================
+# DRIVE TEXT STORE (SQLITE)
+# =============================
+# Lưu text đã trích xuất của từng file cùng modifiedTime / md5Checksum.
+# Mỗi lần sync chỉ tải lại file mới hoặc đã thay đổi, dữ liệu còn nguyên
+# sau khi restart app.
+
+def connect_drive_store():
+
+    conn = sqlite3.connect(DRIVE_CACHE_DB, timeout=30)
+
+    conn.execute("PRAGMA journal_mode=WAL")
+
+    if conn.execute("PRAGMA user_version").fetchone()[0] != DRIVE_STORE_VERSION:
+        # store chỉ là cache của Drive → schema cũ thì bỏ đi và sync lại
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS drive_chunks")
+            conn.execute("DROP TABLE IF EXISTS drive_pages")
+            conn.execute("DROP TABLE IF EXISTS drive_files")
+            conn.execute(f"PRAGMA user_version = {DRIVE_STORE_VERSION}")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS drive_files (
+            file_id TEXT PRIMARY KEY,
+            folder_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            modified_time TEXT,
+            md5 TEXT,
+            synced_at TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS drive_pages (
+            file_id TEXT NOT NULL,
+            page INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            PRIMARY KEY (file_id, page)
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_drive_files_folder ON drive_files(folder_id, name)"
+    )
+    # Inverted index BM25 (FTS5) trên text đã bỏ dấu, raw giữ text gốc
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS drive_chunks USING fts5(
+            body,
+            file_id UNINDEXED,
+            page UNINDEXED,
+            chunk UNINDEXED,
+            raw UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """)
+
+    return conn
+
+
+@st.cache_resource
+def _drive_sync_state():
+    # syncing: folder đang đồng bộ — lock chỉ giữ lúc đọc / đổi state, không
+    # giữ suốt lần sync nên tìm kiếm vẫn đọc store cũ trong lúc làm mới
+    return {"lock": threading.Lock(), "last_sync": {}, "syncing": set()}
+
+
+def list_drive_files(service, folder_id):
+
+    files = []
+    page_token = None
+
+    while True:
+
+        request = service.files().list(
+            q=f"'{folder_id}' in parents and trashed=false",
+            fields="nextPageToken, files(id, name, mimeType, modifiedTime, md5Checksum)",
+            pageSize=1000,
+            pageToken=page_token
+        )
+
+        results = call_with_limits("drive", request.execute, http=drive_http())
+
+        files.extend(results.get("files", []))
+        page_token = results.get("nextPageToken")
+
+        if not page_token:
+            return files
+
+
+def download_drive_file(service, file_id):
+
+    request = service.files().get_media(fileId=file_id)
+    request.http = drive_http()
+
+    from googleapiclient.http import MediaIoBaseDownload
+
+    fh = io.BytesIO()
+    downloader = MediaIoBaseDownload(fh, request)
+
+    with perf_span("drive.download_file") as span:
+
+        done = False
+        while not done:
+            status, done = call_with_limits("drive", downloader.next_chunk)
+
+        span["bytes"] = fh.tell()
+
+    fh.seek(0)
+
+    return fh
+
+
+# =============================
+# DRIVE INGEST PIPELINE
+# =============================
+# Tải file bằng thread pool, đọc PDF/DOCX bằng process pool.
+# Tối đa DRIVE_MAX_IN_FLIGHT file được giữ trong bộ nhớ cùng lúc;
+# file nào quá DRIVE_FILE_TIMEOUT ở một bước thì bị bỏ qua và báo lỗi.
+# Process con tạo bằng forkserver / spawn (không fork từ server Streamlit
+# đang chạy nhiều thread → con có thể thừa hưởng lock đang bị giữ) và chạy
+# hàm đọc trong drive_extract.py. File đọc quá giờ thì pool bị dựng lại,
+# process đang treo bị dừng hẳn.
+
+@st.cache_resource
+def get_download_pool():
+    return ThreadPoolExecutor(
+        max_workers=DRIVE_DOWNLOAD_WORKERS,
+        thread_name_prefix="drive-download"
+    )
+
+
+@st.cache_resource
+def get_extract_pool():
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+    # process con tự báo pid khi khởi động → dừng được process treo mà
+    # không phải đọc thuộc tính riêng của ProcessPoolExecutor
+    pids = context.SimpleQueue()
+
+    pool = ProcessPoolExecutor(
+        max_workers=DRIVE_EXTRACT_WORKERS,
+        mp_context=context,
+        initializer=register_worker,
+        initargs=(pids,)
+    )
+
+    return {"pool": pool, "pids": pids}
+
+
+def _download_bytes(service, file_id):
+    return download_drive_file(service, file_id).getvalue()
+
+
+def recycle_extract_pool():
+
+    # future.cancel() không dừng được việc đang chạy → huỷ việc đang chờ,
+    # dừng các process con (kể cả process đang treo) rồi tạo pool mới
+    extract = get_extract_pool()
+    get_extract_pool.clear()
+
+    extract["pool"].shutdown(wait=False, cancel_futures=True)
+
+    while not extract["pids"].empty():
+        try:
+            os.kill(extract["pids"].get(), signal.SIGTERM)
+        except OSError:
+            pass   # process đã tự thoát
+
+
+def _submit_extract(file_name, data):
+    try:
+        return get_extract_pool()["pool"].submit(extract_worker, file_name, data)
+    except BrokenProcessPool:
+        get_extract_pool.clear()
+        return get_download_pool().submit(extract_worker, file_name, data)
+
+
+def ingest_drive_files(service, files):
+
+    pending = {}
+    files = iter(files)
+
+    while True:
+
+        # ===== BACKPRESSURE: chỉ nhận thêm file khi còn chỗ =====
+        while len(pending) < DRIVE_MAX_IN_FLIGHT:
+
+            file = next(files, None)
+
+            if file is None:
+                break
+
+            future = get_download_pool().submit(_download_bytes, service, file["id"])
+            pending[future] = ("download", file, time.monotonic() + DRIVE_FILE_TIMEOUT, None)
+
+        if not pending:
+            return
+
+        nearest = min(deadline for _, _, deadline, _ in pending.values())
+
+        finished, _ = wait(
+            pending,
+            timeout=max(0, nearest - time.monotonic()),
+            return_when=FIRST_COMPLETED
+        )
+
+        for future in finished:
+
+            stage, file, _, data = pending.pop(future)
+
+            try:
+                result = future.result()
+
+            except (pickle.PicklingError, BrokenProcessPool):
+                # process pool không dùng được → đọc file ngay trong thread
+                if isinstance(future.exception(), BrokenProcessPool):
+                    get_extract_pool.clear()
+
+                future = get_download_pool().submit(extract_worker, file["name"], data)
+                pending[future] = ("fallback", file, time.monotonic() + DRIVE_FILE_TIMEOUT, data)
+                continue
+
+            except Exception as e:
+                yield file, None, str(e)
+                continue
+
+            if stage == "download":
+                future = _submit_extract(file["name"], result)
+                pending[future] = ("extract", file, time.monotonic() + DRIVE_FILE_TIMEOUT, result)
+            else:
+                pages, elapsed = result
+                kind = os.path.splitext(file["name"])[1].lstrip(".").lower() or "file"
+                record_span(f"drive.extract_{kind}", elapsed, len(data))
+                yield file, pages, None
+
+        # ===== TIMEOUT =====
+        now = time.monotonic()
+        recycle = False
+
+        for future, (stage, file, deadline, _) in list(pending.items()):
+
+            if deadline <= now and not future.done():
+                future.cancel()
+                del pending[future]
+                recycle = recycle or stage == "extract"
+                yield file, None, f"Quá thời gian {DRIVE_FILE_TIMEOUT}s ({stage})"
+
+        if recycle:
+
+            recycle_extract_pool()
+
+            # các file khác đang đọc ở pool cũ → đọc lại ở pool mới
+            for future, (stage, file, _, data) in list(pending.items()):
+                if stage == "extract" and not future.done():
+                    del pending[future]
+                    future = _submit_extract(file["name"], data)
+                    pending[future] = ("extract", file, time.monotonic() + DRIVE_FILE_TIMEOUT, data)
+
+
+def sync_drive_folder(folder_id, force=False, progress=None):
+
+    state = _drive_sync_state()
+
+    with state["lock"]:
+
+        last_sync = state["last_sync"].get(folder_id, 0)
+
+        # đang có lần sync khác cho folder này → không chờ, dùng store hiện có
+        if folder_id in state["syncing"]:
+            return {"listed": None, "updated": 0, "removed": 0, "errors": [], "syncing": True}
+
+        if not force and time.time() - last_sync < DRIVE_SYNC_INTERVAL:
+            return {"listed": None, "updated": 0, "removed": 0, "errors": []}
+
+        state["syncing"].add(folder_id)
+
+    try:
+        service = connect_drive()
+        files = [
+            f for f in list_drive_files(service, folder_id)
+            if f["name"].lower().endswith(DRIVE_FILE_TYPES)
+        ]
+
+        conn = connect_drive_store()
+
+        try:
+
+            known = {
+                row[0]: (row[1], row[2])
+                for row in conn.execute(
+                    "SELECT file_id, modified_time, md5 FROM drive_files WHERE folder_id = ?",
+                    (folder_id,)
+                )
+            }
+
+            changed = [
+                f for f in files
+                if known.get(f["id"]) != (f.get("modifiedTime"), f.get("md5Checksum"))
+            ]
+
+            updated = 0
+            errors = []
+
+            for done, (file, pages, error) in enumerate(ingest_drive_files(service, changed), 1):
+
+                if progress:
+                    progress(done, len(changed), file["name"])
+
+                if error:
+                    errors.append((file["name"], error))
+                    continue
+
+                with conn:
+                    conn.execute(
+                        """
+                        INSERT OR REPLACE INTO drive_files
+                            (file_id, folder_id, name, modified_time, md5, synced_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """,
+                        (file["id"], folder_id, file["name"], file.get("modifiedTime"),
+                         file.get("md5Checksum"), datetime.utcnow().isoformat())
+                    )
+                    conn.execute("DELETE FROM drive_pages WHERE file_id = ?", (file["id"],))
+                    conn.execute("DELETE FROM drive_chunks WHERE file_id = ?", (file["id"],))
+                    conn.executemany(
+                        "INSERT INTO drive_pages (file_id, page, text) VALUES (?, ?, ?)",
+                        [
+                            (file["id"], page, text)
+                            for page, text in enumerate(pages or [], 1)
+                            if text
+                        ]
+                    )
+                    conn.executemany(
+                        "INSERT INTO drive_chunks (body, file_id, page, chunk, raw) VALUES (?, ?, ?, ?, ?)",
+                        [
+                            (fold_vietnamese(chunk), file["id"], page, n, chunk)
+                            for page, text in enumerate(pages or [], 1)
+                            for n, chunk in enumerate(chunk_text(text or ""))
+                        ]
+                    )
+
+                updated += 1
+
+            removed = set(known) - {f["id"] for f in files}
+
+            with conn:
+                conn.executemany(
+                    "DELETE FROM drive_files WHERE file_id = ?",
+                    [(file_id,) for file_id in removed]
+                )
+                conn.executemany(
+                    "DELETE FROM drive_pages WHERE file_id = ?",
+                    [(file_id,) for file_id in removed]
+                )
+                conn.executemany(
+                    "DELETE FROM drive_chunks WHERE file_id = ?",
+                    [(file_id,) for file_id in removed]
+                )
+
+        finally:
+            conn.close()
+
+        with state["lock"]:
+            state["last_sync"][folder_id] = time.time()
+
+    finally:
+        with state["lock"]:
+            state["syncing"].discard(folder_id)
+
+    return {
+        "listed": len(files),
+        "updated": updated,
+        "removed": len(removed),
+        "errors": errors
+    }
+
+
+def iter_drive_documents(folder_id):
+
+    conn = connect_drive_store()
+
+    try:
+        cursor = conn.execute(
+            """
+            SELECT f.file_id, f.name, p.page, p.text
+            FROM drive_files f
+            JOIN drive_pages p ON p.file_id = f.file_id
+            WHERE f.folder_id = ?
+            ORDER BY f.name, p.page
+            """,
+            (folder_id,)
+        )
+
+        for file_id, name, page, text in cursor:
+            yield {"file_id": file_id, "name": name, "page": page, "text": text}
+
+    finally:
+        conn.close()
+
+
+def prepare_drive_folder():
+
+    # ===== LẤY FOLDER ID TỪ SESSION =====
+    drive_link = st.session_state.get("drive_folder", "")
+
+    if not drive_link:
+        st.warning("⚠️ Chưa cấu hình Google Drive Folder trong Settings.")
+        return None
+
+    folder_id = extract_drive_id(drive_link)
+
+    try:
+
+        bar = st.progress(0.0, text="Đang đồng bộ dữ liệu Drive...")
+
+        def report(done, total, file_name):
+            bar.progress(done / total, text=f"📄 {done}/{total} — {file_name}")
+
+        stats = sync_drive_folder(folder_id, progress=report)
+
+        bar.empty()
+
+        for file_name, error in stats["errors"]:
+            st.error(f"Lỗi đọc file {file_name}: {error}")
+
+        conn = connect_drive_store()
+
+        try:
+            count = conn.execute(
+                "SELECT COUNT(*) FROM drive_files WHERE folder_id = ?",
+                (folder_id,)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+
+        if count == 0 and stats.get("syncing"):
+            st.info("⏳ Đang đồng bộ Drive lần đầu, thử lại sau ít phút.")
+            return None
+
+        if count == 0:
+            st.warning("⚠️ Folder có nhưng không có file hoặc chưa share quyền.")
+            return None
+
+        return folder_id
+
+    except Exception as e:
+        st.error(f"Lỗi kết nối Drive: {e}")
+        return None
+
+
+def load_drive_tour_data():
+
+    folder_id = prepare_drive_folder()
+
+    if folder_id is None:
+        return None
+
+    return iter_drive_documents(folder_id)
+
+
+def build_match_query(query):
+
+    tokens = re.findall(r"\w+", fold_vietnamese(query))
+
+    if not tokens:
+        return None
+
+    terms = [f'"{t}"' for t in dict.fromkeys(tokens)]
+
+    # cụm từ đầy đủ được cộng thêm điểm so với từng từ riêng lẻ
+    if len(tokens) > 1:
+        terms.insert(0, '"' + " ".join(tokens) + '"')
+
+    return " OR ".join(terms)
+
+
+def search_drive_passages(folder_id, query, top_k=DRIVE_SEARCH_TOP_K):
+
+    match = build_match_query(query)
+
+    if match is None:
+        return []
+
+    conn = connect_drive_store()
+
+    try:
+        rows = conn.execute(
+            """
+            SELECT c.file_id, f.name, c.page, c.chunk, c.raw, bm25(drive_chunks) AS score
+            FROM drive_chunks c
+            JOIN drive_files f ON f.file_id = c.file_id
+            WHERE drive_chunks MATCH ? AND f.folder_id = ?
+            ORDER BY score
+            LIMIT ?
+            """,
+            (match, folder_id, top_k)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    return [
+        {
+            "file_id": file_id,
+            "name": name,
+            "page": page,
+            "chunk": chunk,
+            "text": raw,
+            "score": -score
+        }
+        for file_id, name, page, chunk, raw, score in rows
+    ]
+
+
+def format_passages(passages):
+
+    # giữ thứ tự trong file để lịch trình các ngày đọc liền mạch
+    ordered = sorted(passages, key=lambda p: (p["name"], p["page"], p["chunk"]))
+
+    return "\n\n".join(
+        f"[{p['name']} — trang {p['page']}]\n{p['text']}"
+        for p in ordered
+    )
+
+# =============================
+# AI SEARCH TOUR FROM DRIVE DATA
+# =============================
+def search_relevant_text(documents, query, window=8000):
+
+    # documents: chuỗi text hoặc iterator các dict {"text": ...} (đọc lần lượt)
+    if isinstance(documents, str):
+        documents = [{"text": documents}]
+
+    documents = iter(documents)
+    query = query.lower()
+
+    head = None                     # window ký tự đầu, dùng khi không tìm thấy
+    before = collections.deque()    # các trang ngay trước trang đang xét
+    before_len = 0
+
+    for doc in documents:
+
+        text = doc["text"]
+        idx = text.lower().find(query)
+
+        if idx == -1:
+
+            if head is None:
+                head = text[:window]
+            elif len(head) < window:
+                head = (head + "\n" + text)[:window]
+
+            before.append(text)
+            before_len += len(text) + 1
+
+            while before and before_len - len(before[0]) - 1 >= window:
+                before_len -= len(before.popleft()) + 1
+
+            continue
+
+        # ===== TÌM THẤY: GHÉP TRƯỚC / SAU TỪ KHÓA =====
+        parts = list(before) + [text]
+        pos = before_len + idx
+        after_len = len(text) - idx
+
+        for doc in documents:
+
+            if after_len >= window:
+                break
+
+            parts.append(doc["text"])
+            after_len += len(doc["text"]) + 1
+
+        context = "\n".join(parts)
+
+        return context[max(0, pos - window):pos + window]
+
+    return head or ""
+
+
+def build_drive_search_prompt(query):
+
+    folder_id = prepare_drive_folder()
+
+    if folder_id is None:
+        return None, "❌ Không có dữ liệu Drive. Vui lòng kiểm tra Folder ID hoặc quyền chia sẻ."
+
+    # =============================
+    # TÌM ĐOẠN LIÊN QUAN NHẤT (BM25)
+    # =============================
+    passages = search_drive_passages(folder_id, query)
+    render = format_passages
+
+    if not passages:
+        relevant = search_relevant_text(iter_drive_documents(folder_id), query, window=9000)
+        passages = [relevant] if relevant else []
+        render = None
+
+    if not passages:
+        return None, "❌ Không có dữ liệu Drive. Vui lòng kiểm tra Folder ID hoặc quyền chia sẻ."
+
+    # =============================
+    # PROMPT CHUẨN PRO
+    # =============================
+    template = """
+Bạn là chuyên gia sản phẩm Vietravel.
+
+NHIỆM VỤ:
+Trích xuất CHÍNH XÁC thông tin tour từ dữ liệu được cung cấp.
+
+=============================
+QUY TẮC BẮT BUỘC
+=============================
+
+1. CHỈ sử dụng dữ liệu có trong tài liệu
+2. KHÔNG được tự thêm thông tin ngoài dữ liệu
+3. Nếu không thấy thông tin thì ghi: Đang cập nhật
+4. Phải hiển thị ĐẦY ĐỦ tất cả các ngày trong lịch trình
+5. Nếu tour 7 ngày phải có Ngày 1 → Ngày 7
+6. Không được bỏ sót ngày cuối
+7. Không được tóm tắt quá ngắn
+8. Ưu tiên dữ liệu gần từ khóa tìm kiếm: "{query}"
+9. Viết văn phong tư vấn chuyên nghiệp gửi khách hàng
+10. Nội dung phải dài và đầy đủ
+
+=============================
+DỮ LIỆU TOUR
+=============================
+
+{context}
+
+=============================
+KHÁCH HỎI
+=============================
+
+{query}
+
+=============================
+XUẤT KẾT QUẢ THEO FORMAT
+=============================
+
+📍 Tên tour:
+📍 Mã tour:
+📍 Thời gian:
+📍 Giá:
+📍 Ngày khởi hành:
+
+📍 Điểm nổi bật:
+
+📍 LỊCH TRÌNH CHI TIẾT:
+
+Ngày 1:
+Ngày 2:
+Ngày 3:
+Ngày 4:
+(Nếu còn ngày phải liệt kê đầy đủ đến ngày cuối)
+
+=============================
+
+Viết nội dung rõ ràng dễ copy gửi Zalo cho khách.
+Không được rút gọn.
+"""
+
+    prompt, _ = build_prompt(template, passages, render=render, query=query)
+
+    return prompt, None
+
+
+# =====================================================
+# TOUR SUGGEST
+# =====================================================
+
+STOP_WORDS = [
+    "tư", "vấn", "giúp", "tour", "muốn", "đi", "em", "anh",
+    "chị", "bao", "nhiêu", "tiền", "tháng", "ngân", "sách"
+]
+
+
+def clean_words(text):
+    words = re.findall(r'\w+', text.lower())
+    return [w for w in words if w not in STOP_WORDS and len(w) > 2]
+
+
+SUGGEST_STOP_WORDS = frozenset([
+    "anh", "chị", "em", "mình", "tôi",
+    "muốn", "đi", "du", "lịch", "tour",
+    "tháng", "ngày", "bao", "nhiêu",
+    "tiền", "ngân", "sách", "khoảng",
+    "tầm", "giúp", "với", "ạ", "ơi",
+    # từ hay gặp trong tin chat (có dấu / không dấu); bỏ qua các từ trùng
+    # tên địa danh khi không dấu như "gia" (Gia Lai), "hoi" (Hội An), "can" (Cần Thơ)
+    "khách", "khach", "cho", "xin", "chào", "chao", "hỏi", "giá",
+    "được", "duoc", "không", "khong", "nhé", "nhe", "nha", "vậy", "vay",
+    "thế", "người", "nguoi", "mấy", "muon", "lich", "thang", "ngay",
+    "tien", "nhieu", "sach", "khoang", "giup", "minh", "toi", "voi"
+])
+
+TOUR_NAME_COLUMN = "Tour (Tên tour)"
+
+
+def extract_keywords(message):
+
+    # giữ nguyên dấu: keyword có dấu chỉ khớp tên tour cùng dấu (xem _keyword_hits)
+    words = re.findall(r'\w+', unicodedata.normalize("NFC", message.lower()))
+
+    keywords = [
+        w for w in words
+        if w not in SUGGEST_STOP_WORDS and len(w) > 2 and not w.isdigit()
+    ]
+
+    return list(dict.fromkeys(keywords))
+
+
+# =====================================================
+# TOUR MATCHER
+# =====================================================
+# Build một lần cho mỗi version của tour sheet, dùng chung mọi session.
+# Tên tour được tách từ thành inverted index: từ → (dòng, vị trí).
+# Keyword khớp từ bắt đầu bằng nó, so trên bản bỏ dấu ("han" → Hàn Quốc,
+# không khớp Phan Thiết / Thanh Hóa như so chuỗi con trước đây); keyword có
+# dấu thì phải đúng dấu. Vocab bỏ dấu được sort sẵn nên tra prefix bằng bisect.
+
+def build_tour_matcher(df):
+
+    names = (
+        df[TOUR_NAME_COLUMN].astype(str).map(lambda s: unicodedata.normalize("NFC", s.lower()))
+        if TOUR_NAME_COLUMN in df.columns
+        else pd.Series([""] * len(df))
+    )
+
+    postings = {}
+
+    for row, name in enumerate(names):
+
+        seen = set()
+
+        for m in re.finditer(r"\w+", name):
+
+            token = m.group()
+
+            if token not in seen:
+                seen.add(token)
+                postings.setdefault(token, []).append((row, m.start()))
+
+    # từ bỏ dấu → các cách viết có dấu trong tên tour
+    variants = {}
+
+    for token in postings:
+        variants.setdefault(fold_vietnamese(token), []).append(token)
+
+    return {
+        "df": df,
+        "folded_vocab": sorted(variants),
+        "variants": variants,
+        "postings": {
+            token: np.asarray(hits, dtype=np.int64).reshape(-1, 2)
+            for token, hits in postings.items()
+        },
+        # kết quả theo bộ keyword: cùng một tin nhắn khách được gợi ý lại ở mỗi rerun
+        "results": {},
+    }
+
+
+@st.cache_resource(ttl=SHEET_CACHE_TTL, max_entries=4, show_spinner=False)
+def get_tour_matcher(url, version):
+    return build_tour_matcher(load_typed_sheet(url, TOUR_SNAPSHOT_SCHEMA))
+
+
+def _keyword_hits(matcher, keyword):
+
+    # trả về mảng (dòng, vị trí, partial): partial = 1 nếu chỉ khớp đầu từ
+    folded = fold_vietnamese(keyword)
+    accented = keyword != folded
+    vocab = matcher["folded_vocab"]
+
+    hits = []
+
+    for i in range(bisect.bisect_left(vocab, folded), len(vocab)):
+
+        if not vocab[i].startswith(folded):
+            break
+
+        for token in matcher["variants"][vocab[i]]:
+
+            plain = token == vocab[i]
+
+            # keyword có dấu: từ phải cùng dấu, trừ tên tour viết không dấu
+            if accented and not plain and not token.startswith(keyword):
+                continue
+
+            exact = token == keyword if accented and not plain else vocab[i] == folded
+            postings = matcher["postings"][token]
+            partial = np.full((len(postings), 1), 0 if exact else 1, dtype=np.int64)
+
+            hits.append(np.hstack([postings, partial]))
+
+    if not hits:
+        return np.empty((0, 3), dtype=np.int64)
+
+    # khớp đúng một từ: postings đã là một dòng một lần, theo thứ tự dòng
+    if len(hits) == 1:
+        return hits[0]
+
+    hits = np.concatenate(hits)
+
+    # một dòng chỉ tính một lần cho mỗi keyword (khớp trọn từ trước, rồi vị trí sớm nhất)
+    hits = hits[np.lexsort((hits[:, 1], hits[:, 2], hits[:, 0]))]
+    first = np.ones(len(hits), dtype=bool)
+    first[1:] = hits[1:, 0] != hits[:-1, 0]
+
+    return hits[first]
+
+
+def match_tours(matcher, keywords, top_k=SUGGEST_TOP_K):
+
+    hits = [_keyword_hits(matcher, kw) for kw in keywords]
+    hits = [h for h in hits if len(h)]
+
+    if not hits:
+        return pd.DataFrame()
+
+    if len(hits) == 1:
+        rows, count, position, partial = hits[0][:, 0], 1, hits[0][:, 1], hits[0][:, 2]
+    else:
+        # mỗi keyword có nhiều nhất một hit / dòng → cộng dồn trên mảng theo dòng
+        n = len(matcher["df"])
+        count = np.zeros(n, dtype=np.int64)
+        partial = np.zeros(n, dtype=np.int64)
+        position = np.full(n, np.iinfo(np.int32).max, dtype=np.int64)
+
+        for h in hits:
+            count[h[:, 0]] += 1
+            partial[h[:, 0]] += h[:, 2]
+            keyword_position = np.full(n, np.iinfo(np.int32).max, dtype=np.int64)
+            keyword_position[h[:, 0]] = h[:, 1]
+            np.minimum(position, keyword_position, out=position)
+
+        rows = np.flatnonzero(count)
+        count, partial, position = count[rows], partial[rows], position[rows]
+
+    # nhiều keyword khớp hơn trước, rồi ít keyword chỉ khớp đầu từ hơn, rồi
+    # keyword xuất hiện sớm hơn trong tên, rồi thứ tự dòng — gộp thành một
+    # khoá số để chỉ chọn top_k bằng argpartition
+    n = len(matcher["df"])
+    width = (int(position.max()) + 1) * n
+    key = ((len(keywords) - count) * (len(keywords) + 1) + partial) * width + position * n + rows
+
+    if len(key) > top_k:
+        top = np.argpartition(key, top_k - 1)[:top_k]
+    else:
+        top = np.arange(len(key))
+
+    top = top[np.argsort(key[top])]
+
+    return matcher["df"].iloc[rows[top]]
+
+
+def suggest_tour(message):
+
+    keywords = extract_keywords(message)
+
+    if not keywords:
+        return pd.DataFrame()
+
+    url = st.session_state.tour_sheet_url
+
+    try:
+        matcher = get_tour_matcher(url, get_data_version(url))
+    except:
+        return pd.DataFrame()
+
+    # dict dùng chung mọi session: session khác có thể clear() giữa chừng,
+    # nên chỉ trả về kết quả đang giữ trong biến local
+    results = matcher["results"]
+    key = tuple(keywords)
+    found = results.get(key)
+
+    if found is None:
+        found = match_tours(matcher, keywords)
+
+        if len(results) >= SUGGEST_CACHE_SIZE:
+            results.clear()
+        results[key] = found
+
+    return found
+
+
+# =====================================================
+# DASHBOARD AGGREGATES
+# =====================================================
+# Số đơn / doanh thu theo ngày, tour, kênh được giữ sẵn trong process và
+# cộng / trừ dần khi đẩy đơn mới, xoá hoặc sửa đơn, nên mở dashboard không
+# phải đọc và groupby lại toàn bộ lịch sử đơn.
+# Sửa tay trực tiếp trên Google Sheet được cập nhật ở lần tính lại định kỳ
+# (DASHBOARD_AGG_MAX_AGE) hoặc khi bấm "Tính lại".
+
+DASHBOARD_DIMENSIONS = {"day": "Ngày", "tour": "Tour", "channel": "Kênh"}
+
+
+@st.cache_resource
+def _dashboard_aggregates():
+    # appending: số lần append_rows đang chạy theo url (xem begin_order_append)
+    return {"lock": threading.Lock(), "stores": {}, "appending": {}}
+
+
+def order_contributions(df):
+
+    # {(chiều, khoá): (số đơn, doanh thu)} của một nhóm đơn
+    if df.empty:
+        return {}
+
+    # giá không đọc được (khoảng giá, "Liên hệ") không tính vào doanh thu
+    if price_value_column("Giá") in df.columns:
+        revenue = df[price_value_column("Giá")].fillna(0).round().astype("int64")
+    elif "Giá" in df.columns:
+        revenue = parse_price(df["Giá"]).fillna(0).round().astype("int64")
+    else:
+        revenue = pd.Series(0, index=df.index, dtype="int64")
+
+    contributions = {("all", ""): (len(df), int(revenue.sum()))}
+
+    for dim, column in DASHBOARD_DIMENSIONS.items():
+
+        if column not in df.columns:
+            continue
+
+        if dim == "day":
+            keys = pd.to_datetime(df[column], errors="coerce").dt.strftime("%Y-%m-%d")
+        elif isinstance(df[column].dtype, pd.CategoricalDtype):
+            keys = df[column]
+        else:
+            keys = df[column].astype(str)
+
+        grouped = revenue.groupby(keys, observed=True).agg(["count", "sum"])
+
+        for key, count, total in grouped.itertuples():
+            contributions[(dim, key)] = (int(count), int(total))
+
+    return contributions
+
+
+def _apply_contributions(totals, contributions, sign):
+
+    for (dim, key), (count, revenue) in contributions.items():
+
+        cells = totals.setdefault(dim, {})
+        count_now, revenue_now = cells.get(key, (0, 0))
+        count_now += sign * count
+
+        if count_now > 0:
+            cells[key] = (count_now, revenue_now + sign * revenue)
+        else:
+            cells.pop(key, None)
+
+
+def apply_order_delta(url, df, sign):
+
+    aggregates = _dashboard_aggregates()
+    contributions = order_contributions(df)
+
+    with aggregates["lock"]:
+        store = aggregates["stores"].get(url)
+        if store:
+            _apply_contributions(store["totals"], contributions, sign)
+
+
+def begin_order_append(url):
+
+    # gọi TRƯỚC append_rows: lần tính lại nào chạy xen vào lúc này có thể đã
+    # đọc được các dòng mới nên không được lưu, tránh cộng delta hai lần
+    aggregates = _dashboard_aggregates()
+
+    with aggregates["lock"]:
+        aggregates["appending"][url] = aggregates["appending"].get(url, 0) + 1
+
+
+def add_appended_orders(url, header, rows):
+
+    # gọi từ thread đẩy đơn sau append_rows (rows = None nếu append lỗi);
+    # chưa có tổng hợp thì lần mở dashboard sau tự tính
+    aggregates = _dashboard_aggregates()
+    contributions = {}
+
+    try:
+        if rows:
+            contributions = order_contributions(pd.DataFrame([dict(zip(header, row)) for row in rows]))
+    except Exception:
+        contributions = None
+
+    with aggregates["lock"]:
+
+        # tăng version trong lock: bản tính lại đang đọc dở (có thể đã thấy
+        # các dòng mới) sẽ bị bỏ, bản tính sau lúc này thì đã gồm các dòng đó
+        bump_data_version(url)
+
+        appending = aggregates["appending"]
+        appending[url] = appending.get(url, 1) - 1
+        if appending[url] <= 0:
+            appending.pop(url)
+
+        if url not in aggregates["stores"]:
+            return
+
+        if contributions is None:
+            aggregates["stores"].pop(url)
+        else:
+            _apply_contributions(aggregates["stores"][url]["totals"], contributions, 1)
+
+
+def drop_dashboard_aggregates(url):
+
+    aggregates = _dashboard_aggregates()
+
+    with aggregates["lock"]:
+        aggregates["stores"].pop(url, None)
+
+
+def rebuild_dashboard_aggregates(url):
+
+    aggregates = _dashboard_aggregates()
+    version = get_data_version(url)
+
+    store = {"built_at": time.time(), "totals": {}}
+    _apply_contributions(store["totals"], order_contributions(load_typed_sheet(url, ORDER_SNAPSHOT_SCHEMA)), 1)
+
+    with aggregates["lock"]:
+        # sheet vừa đổi / đang append đơn trong lúc đọc → không lưu, lần sau tính lại
+        if get_data_version(url) == version and not aggregates["appending"].get(url):
+            aggregates["stores"][url] = store
+
+    return store
+
+
+def dashboard_aggregates(url, refresh=False):
+
+    aggregates = _dashboard_aggregates()
+    store = aggregates["stores"].get(url)
+
+    if refresh or not store or time.time() - store["built_at"] > DASHBOARD_AGG_MAX_AGE:
+        store = rebuild_dashboard_aggregates(url)
+
+    with aggregates["lock"]:
+        return store["built_at"], {dim: dict(cells) for dim, cells in store["totals"].items()}
+
+
+# =====================================================
+# DASHBOARD
+# =====================================================
+
+@perf_timed
+def render_dashboard():
+
+    st.title("📊 Dashboard")
+
+    url = order_source()
+
+    if not url:
+        st.warning("Chưa có dữ liệu")
+        return
+
+    try:
+        built_at, totals = dashboard_aggregates(
+            url,
+            refresh=st.session_state.pop("dashboard_refresh", False)
+        )
+    except Exception as e:
+        st.error(f"Không tải được Google Sheet: {e}")
+        return
+
+    total_customers, total_revenue = totals.get("all", {}).get("", (0, 0))
+
+    if not total_customers:
+        st.warning("Chưa có dữ liệu")
+        return
+
+    # ===== TODAY (GIỜ VIỆT NAM) =====
+    from datetime import datetime, timedelta
+
+    vietnam_now = datetime.utcnow() + timedelta(hours=7)
+    today = vietnam_now.date()
+
+    # ===== METRICS =====
+    today_customers, today_revenue = totals.get("day", {}).get(today.isoformat(), (0, 0))
+
+    col1, col2, col3, col4 = st.columns(4)
+
+    col1.metric("Khách hôm nay", today_customers)
+    col2.metric("Doanh thu hôm nay", f"{today_revenue:,.0f} đ")
+    col3.metric("Tổng khách", total_customers)
+    col4.metric("Tổng doanh thu", f"{total_revenue:,.0f} đ")
+
+    col_info, col_refresh = st.columns([4, 1])
+    col_info.caption(f"Số liệu tổng hợp lúc {datetime.fromtimestamp(built_at):%H:%M:%S}, cập nhật theo từng đơn")
+
+    if col_refresh.button("🔄 Tính lại"):
+        st.session_state.dashboard_refresh = True
+        st.rerun()
+
+    st.divider()
+
+    import plotly.express as px
+
+    # ===== DOANH THU THEO TOUR =====
+    if "tour" in totals:
+
+        route_df = pd.DataFrame(
+            [(tour, count, revenue) for tour, (count, revenue) in totals["tour"].items()],
+            columns=["Tour", "Tên", "Giá"]
+        )
+
+        fig1 = px.bar(
+            route_df,
+            x="Tour",
+            y="Giá",
+            color="Tour",
+            title="Doanh thu theo Tour"
+        )
+
+        st.plotly_chart(fig1, use_container_width=True)
+
+    # ===== DOANH THU THEO NGÀY =====
+    if "day" in totals:
+
+        daily = pd.DataFrame(
+            sorted((day, revenue) for day, (count, revenue) in totals["day"].items()),
+            columns=["Ngày", "Giá"]
+        )
+        daily["Ngày"] = pd.to_datetime(daily["Ngày"])
+
+        fig2 = px.line(
+            daily,
+            x="Ngày",
+            y="Giá",
+            markers=True,
+            title="Doanh thu theo ngày"
+        )
+
+        st.plotly_chart(fig2, use_container_width=True)
+
+# =====================================================
+# CUSTOMER INBOX (SQLITE)
+# =====================================================
+# Hộp thư khách dùng chung cho mọi sale (mọi session / process).
+# chat_messages.id tăng dần (AUTOINCREMENT, không dùng lại) nên là con trỏ
+# cho feed: mỗi session chỉ hỏi "tin có id > cursor" thay vì tải lại tất cả.
+# Nhận khách / đổi trạng thái cũng ghi một tin "system" → cùng đi qua feed.
+# Mở cuộc chat chỉ tải CHAT_WINDOW tin mới nhất, tin cũ hơn tải thêm theo
+# trang khi sale bấm xem; tin mới được nối thêm từ feed.
+
+def connect_inbox():
+
+    conn = sqlite3.connect(INBOX_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS customers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            channel TEXT NOT NULL DEFAULT '',
+            status TEXT NOT NULL DEFAULT 'Đang theo dõi',
+            claimed_by TEXT,
+            claimed_at REAL,
+            created_at REAL NOT NULL,
+            last_message_id INTEGER NOT NULL DEFAULT 0,
+            last_message TEXT NOT NULL DEFAULT '',
+            last_customer_message TEXT NOT NULL DEFAULT '',
+            last_at REAL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            customer_id INTEGER NOT NULL REFERENCES customers(id),
+            role TEXT NOT NULL,
+            author TEXT NOT NULL DEFAULT '',
+            content TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_customer ON chat_messages(customer_id, id)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_customers_claimed ON customers(claimed_by)")
+
+    return conn
+
+
+def _insert_message(conn, customer_id, role, content, author=""):
+
+    now = time.time()
+
+    message_id = conn.execute(
+        "INSERT INTO chat_messages (customer_id, role, author, content, created_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (customer_id, role, author, content, now)
+    ).lastrowid
+
+    conn.execute(
+        "UPDATE customers SET last_message_id = ?, last_at = ?, "
+        "last_message = CASE WHEN ? != 'system' THEN ? ELSE last_message END, "
+        "last_customer_message = CASE WHEN ? = 'customer' THEN ? ELSE last_customer_message END "
+        "WHERE id = ?",
+        (message_id, now, role, content, role, content, customer_id)
+    )
+
+    return message_id
+
+
+def _seed_inbox(conn):
+
+    # dữ liệu mẫu cho kho mới, chỉ khi bật INBOX_SEED_ENV — inbox.db là hộp thư
+    # thật dùng chung; BEGIN IMMEDIATE → nhiều process không seed trùng
+    conn.execute("BEGIN IMMEDIATE")
+
+    if conn.execute("SELECT COUNT(*) FROM customers").fetchone()[0] == 0:
+        for name, channel, message in INBOX_SEED:
+            customer_id = conn.execute(
+                "INSERT INTO customers (name, channel, created_at) VALUES (?, ?, ?)",
+                (name, channel, time.time())
+            ).lastrowid
+            _insert_message(conn, customer_id, "customer", message)
+
+    conn.commit()
+
+
+def add_customer(name, message, channel=""):
+
+    try:
+        conn = connect_inbox()
+        try:
+            with conn:
+                customer_id = conn.execute(
+                    "INSERT INTO customers (name, channel, created_at) VALUES (?, ?, ?)",
+                    (name, channel, time.time())
+                ).lastrowid
+                _insert_message(conn, customer_id, "customer", message)
+        finally:
+            conn.close()
+    except Exception as e:
+        st.error(e)
+        return None
+
+    return customer_id
+
+
+def post_message(customer_id, role, content, author=""):
+
+    try:
+        conn = connect_inbox()
+        try:
+            with conn:
+                return _insert_message(conn, customer_id, role, content, author)
+        finally:
+            conn.close()
+    except Exception as e:
+        st.error(e)
+        return None
+
+
+def claim_customer(customer_id, rep):
+
+    # chỉ nhận được khách chưa ai nhận (hoặc đã là của mình)
+    try:
+        conn = connect_inbox()
+        try:
+            with conn:
+                claimed = conn.execute(
+                    "UPDATE customers SET claimed_by = ?, claimed_at = ? "
+                    "WHERE id = ? AND claimed_by IS NULL",
+                    (rep, time.time(), customer_id)
+                ).rowcount
+                if claimed:
+                    _insert_message(conn, customer_id, "system", f"{rep} đã nhận khách", rep)
+                else:
+                    claimed = conn.execute(
+                        "SELECT COUNT(*) FROM customers WHERE id = ? AND claimed_by = ?",
+                        (customer_id, rep)
+                    ).fetchone()[0]
+        finally:
+            conn.close()
+    except Exception as e:
+        st.error(e)
+        return False
+
+    return bool(claimed)
+
+
+def release_customer(customer_id, rep):
+
+    try:
+        conn = connect_inbox()
+        try:
+            with conn:
+                released = conn.execute(
+                    "UPDATE customers SET claimed_by = NULL, claimed_at = NULL "
+                    "WHERE id = ? AND claimed_by = ?",
+                    (customer_id, rep)
+                ).rowcount
+                if released:
+                    _insert_message(conn, customer_id, "system", f"{rep} đã trả khách về hộp thư chung", rep)
+        finally:
+            conn.close()
+    except Exception as e:
+        st.error(e)
+        return False
+
+    return bool(released)
+
+
+def set_customer_status(customer_id, status, rep=""):
+
+    try:
+        conn = connect_inbox()
+        try:
+            with conn:
+                changed = conn.execute(
+                    "UPDATE customers SET status = ? WHERE id = ? AND status != ?",
+                    (status, customer_id, status)
+                ).rowcount
+                if changed:
+                    _insert_message(conn, customer_id, "system", f"Trạng thái: {status}", rep)
+        finally:
+            conn.close()
+    except Exception as e:
+        st.error(e)
+        return False
+
+    return True
+
+
+def load_inbox():
+
+    conn = connect_inbox()
+
+    try:
+        if os.environ.get(INBOX_SEED_ENV) == "1":
+            _seed_inbox(conn)
 
-    # ================= MID =================
-    with col_mid:
+        # đọc cursor trước: tin đến sau đó sẽ đi qua feed, không bị sót
+        cursor = conn.execute("SELECT COALESCE(MAX(id), 0) FROM chat_messages").fetchone()[0]
+        customers = {row["id"]: dict(row) for row in conn.execute("SELECT * FROM customers")}
+    finally:
+        conn.close()
 
-        cust = st.session_state.selected_customer
+    return cursor, customers
 
-        if cust:
 
-            st.subheader(f"Chat với {cust['name']}")
+def inbox_feed(cursor, limit=INBOX_FEED_BATCH):
 
-            # ===== INIT CHAT STATE =====
-            if "chat_messages" not in st.session_state:
-                st.session_state.chat_messages = [
-                    {"role": "customer", "content": cust["msg"]}
-                ]
+    conn = connect_inbox()
 
-            # ===== CHAT BOX =====
-            chat_html = '<div class="chat-box"><div class="chat-area">'
+    try:
+        messages = [
+            dict(row) for row in conn.execute(
+                "SELECT * FROM chat_messages WHERE id > ? ORDER BY id LIMIT ?",
+                (cursor, limit)
+            )
+        ]
 
-            for msg in st.session_state.chat_messages:
+        changed = sorted({m["customer_id"] for m in messages})
 
-                if msg["role"] == "customer":
-                    chat_html += f'<div class="msg">👤 {msg["content"]}</div>'
-                else:
-                    chat_html += f'<div class="msg">🧑‍💼 {msg["content"]}</div>'
+        customers = [
+            dict(row) for row in conn.execute(
+                f"SELECT * FROM customers WHERE id IN ({', '.join('?' * len(changed))})",
+                changed
+            )
+        ] if changed else []
+    finally:
+        conn.close()
 
-            chat_html += "</div></div>"
+    return messages, customers
 
-            st.markdown(chat_html, unsafe_allow_html=True)
 
-            # ===== INPUT CHAT =====
-            col_input, col_send = st.columns([4, 1])
+def load_thread(customer_id, before, limit):
 
-            with col_input:
-                user_input = st.text_input(
-                    "Nhập tin nhắn",
-                    key="chat_input",
-                    label_visibility="collapsed",
-                    placeholder="Nhắn trả lời khách..."
-                )
+    # `limit` tin ngay trước id `before`, trả về theo thứ tự cũ → mới
+    conn = connect_inbox()
+
+    try:
+        rows = conn.execute(
+            "SELECT * FROM chat_messages WHERE customer_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (customer_id, before, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    return [dict(row) for row in reversed(rows)]
+
+
+def inbox_state():
+
+    if "inbox" not in st.session_state:
+        cursor, customers = load_inbox()
+        st.session_state.inbox = {"cursor": cursor, "customers": customers, "threads": {}}
+
+    return st.session_state.inbox
+
+
+def sync_inbox():
+
+    # kéo các tin mới từ cursor; trả về True nếu có thay đổi
+    state = inbox_state()
+    changed = False
+
+    while True:
+
+        messages, customers = inbox_feed(state["cursor"])
+
+        for customer in customers:
+            state["customers"][customer["id"]] = customer
+
+        for message in messages:
+            thread = state["threads"].get(message["customer_id"])
+            if thread is not None:
+                thread["messages"].append(message)
+            state["cursor"] = message["id"]
+
+        changed = changed or bool(messages)
+
+        if len(messages) < INBOX_FEED_BATCH:
+            return changed
+
+
+def customer_thread(customer_id):
+
+    state = inbox_state()
+
+    if customer_id not in state["threads"]:
+        messages = load_thread(customer_id, state["cursor"] + 1, CHAT_WINDOW)
+        state["threads"][customer_id] = {"messages": messages, "complete": len(messages) < CHAT_WINDOW}
+
+    return state["threads"][customer_id]
+
+
+def load_older_messages(customer_id):
+
+    thread = customer_thread(customer_id)
+
+    if thread["complete"]:
+        return
+
+    before = thread["messages"][0]["id"] if thread["messages"] else inbox_state()["cursor"] + 1
+    older = load_thread(customer_id, before, CHAT_PAGE)
+
+    thread["messages"][:0] = older
+    thread["complete"] = len(older) < CHAT_PAGE
+
+
+def inbox_customers(view="Tất cả", rep=""):
+
+    customers = inbox_state()["customers"].values()
+
+    if view == "Chưa nhận":
+        customers = [c for c in customers if not c["claimed_by"]]
+    elif view == "Của tôi":
+        customers = [c for c in customers if rep and c["claimed_by"] == rep]
+
+    return sorted(customers, key=lambda c: -c["last_message_id"])
+
+
+def format_message_time(ts):
+    return datetime.fromtimestamp(ts).strftime("%H:%M") if ts else ""
+
+
+def send_sale_message(customer_id, content, rep):
+
+    # sale trả lời khách chưa ai nhận thì nhận luôn; khách của sale khác thì không.
+    # Có thể chạy trong callback của fragment nên chỉ ghi lại thông báo, khung
+    # chat hiển thị ở lần chạy sau
+    if not claim_customer(customer_id, rep):
+        st.session_state.chat_notice = "Khách đang do sale khác xử lý"
+        return False
+
+    return post_message(customer_id, "sale", content, rep) is not None
+
+# =====================================================
+# SALES CENTER
+# =====================================================
+
+def reply_prompt(message):
+    return build_company_prompt(f"Khách nói: {message}. Hãy trả lời tư vấn tour chuyên nghiệp.")
+
+
+def objection_prompt(message):
+    return f"""
+Khách nói: {message}
+Đưa ra 3 cách xử lý chuyên nghiệp để thuyết phục khách.
+"""
+
+
+def compare_prompt(tour1, tour2):
+    return build_company_prompt(f"So sánh 2 tour {tour1} và {tour2} của công ty Vietravel.")
+
+
+CHAT_ROLE_ICONS = {"customer": "👤", "sale": "🧑‍💼", "system": "ℹ️"}
+CUSTOMER_STATUSES = ["Đang theo dõi", "Đã chốt đơn", "Không chốt"]
+
+
+@st.fragment(run_every=INBOX_POLL_INTERVAL)
+def render_inbox_list():
+
+    sync_inbox()
+
+    view = st.radio(
+        "Hộp thư",
+        ["Tất cả", "Chưa nhận", "Của tôi"],
+        horizontal=True,
+        key="inbox_view",
+        label_visibility="collapsed"
+    )
+
+    for cust in inbox_customers(view, st.session_state.rep_name):
+
+        owner = f" · 🙋 {cust['claimed_by']}" if cust["claimed_by"] else ""
+
+        if st.button(f"{cust['name']} - {format_message_time(cust['last_at'])}{owner}", key=f"customer_{cust['id']}"):
+            st.session_state.selected_customer = cust["id"]
+            st.session_state.objection_reply = None
+            st.session_state.chat_shown = CHAT_WINDOW
+            st.rerun()
+
+    with st.expander("➕ Thêm khách"):
+
+        with st.form("new_customer", clear_on_submit=True):
+
+            name = st.text_input("Tên khách")
+            channel = st.selectbox("Kênh", ["Zalo", "Facebook", "Online", "Chi nhánh"])
+            message = st.text_area("Tin nhắn của khách")
+
+            if st.form_submit_button("Thêm") and name and message:
+                st.session_state.selected_customer = add_customer(name, message, channel)
+                st.rerun()
+
+
+def chat_message_html(msg):
+    content = html.escape(msg["content"]).replace("\n", "<br>")
+    return f'<div class="msg">{CHAT_ROLE_ICONS.get(msg["role"], "")} {content}</div>'
+
+
+def show_older_messages(customer_id):
+
+    st.session_state.chat_shown += CHAT_PAGE
+
+    # chỉ đọc DB khi các tin đã tải không đủ cho trang mới
+    if len(customer_thread(customer_id)["messages"]) < st.session_state.chat_shown:
+        load_older_messages(customer_id)
+
+
+def send_chat_input(customer_id, role):
+
+    text = st.session_state.chat_input.strip()
+
+    if not text:
+        return
+
+    if role == "sale":
+        sent = send_sale_message(customer_id, text, st.session_state.rep_name)
+    else:
+        sent = post_message(customer_id, "customer", text) is not None
+
+    if sent:
+        st.session_state.chat_input = ""
+
+
+def render_chat(customer_id):
+
+    # phần lịch sử (tối đa chat_shown tin) chỉ gửi khi chạy lại cả trang;
+    # fragment bên dưới chỉ gửi tin đến sau đó + ô nhập, nên gửi / nhận một
+    # tin không phải gửi lại cả cuộc chat
+    thread = customer_thread(customer_id)
+    shown = thread["messages"][-st.session_state.chat_shown:]
+
+    with st.container(height=CHAT_BOX_HEIGHT, border=True, autoscroll=True):
+
+        if len(thread["messages"]) > len(shown) or not thread["complete"]:
+            st.button("⬆️ Xem tin cũ hơn", key="chat_older", on_click=show_older_messages, args=(customer_id,))
+
+        if shown:
+            st.markdown("".join(chat_message_html(m) for m in shown), unsafe_allow_html=True)
+
+        render_chat_tail(customer_id, shown[-1]["id"] if shown else 0)
+
+
+@st.fragment(run_every=INBOX_POLL_INTERVAL)
+def render_chat_tail(customer_id, rendered_upto):
+
+    sync_inbox()
+
+    messages = customer_thread(customer_id)["messages"]
+    start = len(messages)
+
+    while start and messages[start - 1]["id"] > rendered_upto:
+        start -= 1
+
+    # đuôi dài quá một cửa sổ → chạy lại cả trang để dồn vào phần lịch sử
+    if len(messages) - start > CHAT_WINDOW:
+        st.rerun()
+
+    if st.session_state.get("chat_notice"):
+        st.warning(st.session_state.pop("chat_notice"))
+
+    # gợi ý của AI chỉ vào ô nhập làm bản nháp; sale sửa rồi mới bấm Gửi.
+    # Gán trước khi vẽ ô nhập vì Streamlit không cho sửa widget đã vẽ
+    if "chat_draft" in st.session_state:
+        st.session_state.chat_input = st.session_state.pop("chat_draft")
+
+    for msg in messages[start:]:
+        st.markdown(chat_message_html(msg), unsafe_allow_html=True)
+
+    col_input, col_send, col_log = st.columns([3, 1, 1])
+
+    with col_input:
+        st.text_area(
+            "Nhập tin nhắn",
+            key="chat_input",
+            label_visibility="collapsed",
+            placeholder="Nhắn trả lời khách..."
+        )
+
+    with col_send:
+        st.button(
+            "Gửi",
+            use_container_width=True,
+            disabled=not st.session_state.rep_name,
+            on_click=send_chat_input,
+            args=(customer_id, "sale")
+        )
+
+    with col_log:
+        # tin khách gửi qua Zalo / Facebook được sale chép vào hộp thư
+        st.button(
+            "📥 Tin khách",
+            use_container_width=True,
+            on_click=send_chat_input,
+            args=(customer_id, "customer")
+        )
+
+
+@perf_timed
+def render_sales_center():
+
+    col_left, col_mid, col_right = st.columns([1, 2, 1])
+
+    rep = st.session_state.rep_name
+
+    # ================= LEFT =================
+    with col_left:
+
+        st.subheader("Khách hàng")
+
+        render_inbox_list()
+
+    # ================= MID =================
+    with col_mid:
+
+        cust = inbox_state()["customers"].get(st.session_state.selected_customer)
+
+        if cust:
+
+            st.subheader(f"Chat với {cust['name']}")
+
+            # ===== NHẬN KHÁCH =====
+            if not rep:
+                st.caption("Nhập tên sale ở thanh bên để nhận khách và trả lời")
 
-            with col_send:
-                if st.button("Gửi", use_container_width=True):
+            elif cust["claimed_by"] == rep:
+                if st.button("↩️ Trả khách về hộp thư chung"):
+                    release_customer(cust["id"], rep)
+                    sync_inbox()
+                    st.rerun()
 
-                    if user_input:
+            elif cust["claimed_by"]:
+                st.caption(f"🙋 Đang do {cust['claimed_by']} xử lý")
 
-                        st.session_state.chat_messages.append(
-                            {"role": "sale", "content": user_input}
-                        )
+            elif st.button("🙋 Nhận khách"):
+                if not claim_customer(cust["id"], rep):
+                    st.warning("Khách vừa được sale khác nhận")
+                sync_inbox()
+                st.rerun()
 
-                        st.rerun()
+            # ===== CHAT BOX =====
+            render_chat(cust["id"])
 
             st.divider()
 
             # ===== TOUR SUGGEST =====
             st.subheader("🎯 Tour phù hợp")
 
-            suggest_df = suggest_tour(cust["msg"])
+            suggest_df = suggest_tour(cust["last_customer_message"])
 
             if suggest_df.empty:
                 st.info("Không tìm thấy tour")
             else:
-                st.dataframe(suggest_df, use_container_width=True)
+                st.dataframe(
+                    suggest_df.drop(columns=[price_value_column("Giá")], errors="ignore"),
+                    use_container_width=True
+                )
 
             # ===== AI REPLY =====
             st.subheader("🤖 AI gợi ý trả lời")
 
-            if st.button("Gợi ý trả lời khách"):
+            if st.button("Gợi ý trả lời khách", disabled=not rep):
 
-                prompt = f"Khách nói: {cust['msg']}. Hãy trả lời tư vấn tour chuyên nghiệp."
+                errors = []
+                reply = stream_answer(reply_prompt(cust["last_customer_message"]), errors)
 
-                reply = ask_company_ai(prompt)
-
-                st.session_state.chat_messages.append(
-                    {"role": "sale", "content": reply}
-                )
-
-                st.rerun()
+                # lỗi thì để nguyên thông báo vừa hiện, không đưa vào ô nhập
+                if reply and not errors:
+                    st.session_state.chat_draft = reply
+                    st.rerun()
 
             # ===== AI OBJECTION =====
             st.subheader("🧠 Xử lý từ chối")
 
             if st.button("Gợi ý xử lý từ chối"):
 
-                prompt = f"""
-Khách nói: {cust['msg']}
-Đưa ra 3 cách xử lý chuyên nghiệp để thuyết phục khách.
-"""
-                reply = ask_chatgpt(prompt)
+                st.session_state.objection_reply = ask_chatgpt(objection_prompt(cust["last_customer_message"]))
+
+            if st.session_state.get("objection_reply"):
+                st.info(st.session_state.objection_reply)
+
+            # ===== CHẠY SONG SONG =====
+            if st.button("⚡ Chạy tất cả AI cùng lúc", disabled=not rep):
+
+                tour1 = st.session_state.get("compare_tour1", "")
+                tour2 = st.session_state.get("compare_tour2", "")
+
+                prompts = [reply_prompt(cust["last_customer_message"]), objection_prompt(cust["last_customer_message"])]
+
+                if tour1 and tour2:
+                    prompts.append(compare_prompt(tour1, tour2))
 
-                st.info(reply)
+                with st.spinner("AI đang xử lý..."):
+                    results = ask_chatgpt_many(prompts)
+
+                reply, error = results[0]
+
+                if error:
+                    st.session_state.chat_notice = f"AI chưa gợi ý được câu trả lời: {error}"
+                else:
+                    st.session_state.chat_draft = reply
+
+                st.session_state.objection_reply = results[1][0] or results[1][1]
+
+                if len(results) > 2:
+                    st.session_state.chat_history.append(("Bạn", f"So sánh: {tour1} vs {tour2}"))
+                    st.session_state.chat_history.append(("AI", results[2][0] or results[2][1]))
+
+                st.rerun()
 
             # ===== STATUS =====
+            # key theo trạng thái đang lưu → sale khác đổi thì ô chọn cập nhật theo
             status = st.selectbox(
                 "Trạng thái",
-                ["Đang theo dõi", "Đã chốt đơn", "Không chốt"]
+                CUSTOMER_STATUSES,
+                index=CUSTOMER_STATUSES.index(cust["status"]) if cust["status"] in CUSTOMER_STATUSES else 0,
+                key=f"status_{cust['id']}_{cust['status']}"
             )
 
+            if status != cust["status"] and set_customer_status(cust["id"], status, rep):
+                sync_inbox()
+
             if status == "Đã chốt đơn":
 
                 with st.form("deal"):
@@ -829,7 +4359,7 @@ Khách nói: {cust['msg']}
                     tour = st.text_input("Tour")
                     price = st.text_input("Giá")
                     note = st.text_area("Note")
-                    sale = st.text_input("Sale")
+                    sale = st.text_input("Sale", rep)
 
                     channel = st.selectbox(
                         "Kênh",
@@ -851,7 +4381,7 @@ Khách nói: {cust['msg']}
                         ])
 
                         if saved:
-                            st.success("✅ Đã lưu Google Sheet")
+                            st.success("✅ Đã ghi nhận đơn — đang đồng bộ lên Google Sheet")
 
     # ================= RIGHT =================
     with col_right:
@@ -864,105 +4394,296 @@ Khách nói: {cust['msg']}
 
             res = ask_company_ai(user_q)
 
-            st.session_state.chat_history.append(("Bạn", user_q))
-            st.session_state.chat_history.append(("AI", res))
+            st.session_state.chat_history.append(("Bạn", user_q))
+            st.session_state.chat_history.append(("AI", res))
+
+        st.subheader("📊 So sánh 2 tour")
+
+        tour1 = st.text_input("Tour 1", key="compare_tour1")
+        tour2 = st.text_input("Tour 2", key="compare_tour2")
+
+        if st.button("So sánh tour"):
+
+            res = stream_answer(compare_prompt(tour1, tour2))
+
+            st.session_state.chat_history.append(("Bạn", f"So sánh: {tour1} vs {tour2}"))
+            st.session_state.chat_history.append(("AI", res))
+
+        st.divider()
+
+        st.subheader("📂 AI Tra cứu Tour (Drive)")
+
+        drive_query = st.text_input(
+            "Nhập tên tour cần tìm",
+            placeholder="Ví dụ: Nhật Bản, Hàn Quốc, Úc..."
+        )
+
+        if st.button("🔍 Tìm Tour Drive"):
+
+            if not drive_query:
+                st.warning("Nhập tên tour")
+            else:
+
+                with st.spinner("AI đang đọc dữ liệu Drive..."):
+
+                    prompt, error = build_drive_search_prompt(drive_query)
+
+                result = error or stream_answer(prompt)
+
+                st.session_state.chat_history.append(("Bạn", f"Tìm tour Drive: {drive_query}"))
+                st.session_state.chat_history.append(("AI", result))
+
+                st.success("✅ Đã tìm thấy thông tin")
+
+                st.text_area(
+                    "Thông tin gửi khách",
+                    result,
+                    height=300
+                )
+
+                st.code(result, language="text")
+
+        st.subheader("💬 Lịch sử AI")
+
+        for role, msg in st.session_state.chat_history:
+            st.write(f"**{role}:** {msg}")
+# =====================================================
+# CUSTOMERS & ORDERS
+# =====================================================
+
+@perf_timed
+def render_customer_orders():
+
+    st.title("Customers & Orders")
+
+    st.subheader("Danh sách khách")
+
+    sync_inbox()
+
+    st.dataframe(pd.DataFrame([
+        {
+            "Khách": c["name"],
+            "Kênh": c["channel"],
+            "Trạng thái": c["status"],
+            "Sale": c["claimed_by"] or "",
+            "Tin mới nhất": c["last_message"],
+            "Lúc": format_message_time(c["last_at"]),
+        }
+        for c in inbox_customers()
+    ]), hide_index=True)
+
+    st.divider()
+
+    df = load_sheet()
+
+    st.subheader("Đơn đã chốt")
+
+    if order_storage() == "sqlite":
+
+        unsynced = unsynced_order_count() if st.session_state.sheet_url else 0
+
+        if unsynced:
+            st.caption(f"⏳ {unsynced} đơn đang chờ đồng bộ lên Google Sheet")
+
+            if get_order_syncer()["last_error"]:
+                st.warning(f"Lỗi đồng bộ gần nhất: {get_order_syncer()['last_error']}")
+
+    else:
+
+        pending = pending_orders(st.session_state.sheet_url)
+
+        if pending:
+            st.caption(f"⏳ {len(pending)} đơn đang chờ đồng bộ lên Google Sheet")
+
+            failed = [o for o in pending if o["last_error"]]
+            if failed:
+                st.warning(f"Lỗi đồng bộ gần nhất: {failed[-1]['last_error']}")
+
+    if df.empty:
+        st.info("Chưa có dữ liệu")
+        return
+
+    # ===== MÃ ĐƠN =====
+    if ORDER_ID_COLUMN not in df.columns or (df[ORDER_ID_COLUMN].astype(str) == "").any():
+
+        st.info("Một số đơn cũ chưa có mã đơn — cần gán mã để thao tác hàng loạt.")
+
+        if st.button("Gán mã cho đơn cũ"):
+            if backfill_order_ids():
+                st.rerun()
+
+    # ===== LỌC / SẮP XẾP =====
+    col_q, col_ch, col_sort, col_dir = st.columns([3, 2, 2, 1])
+
+    with col_q:
+        query = st.text_input("Tìm đơn", placeholder="Tên khách, tour, ghi chú...", key="orders_query")
+
+    with col_ch:
+        channels = st.multiselect(
+            "Kênh",
+            sorted(df["Kênh"].astype(str).unique()) if "Kênh" in df.columns else [],
+            key="orders_channels"
+        )
+
+    with col_sort:
+        sort_by = st.selectbox("Sắp xếp theo", list(df.columns), key="orders_sort")
+
+    with col_dir:
+        descending = st.toggle("Giảm dần", value=True, key="orders_desc")
+
+    view = sort_orders(filter_orders(df, query, channels), sort_by, not descending)
+
+    # ===== PHÂN TRANG =====
+    col_size, col_page, col_info = st.columns([1, 1, 2])
+
+    with col_size:
+        page_size = st.selectbox("Số dòng / trang", ORDER_PAGE_SIZES, key="orders_page_size")
+
+    pages = max(1, -(-len(view) // page_size))
+
+    with col_page:
+        page = st.number_input("Trang", min_value=1, max_value=pages, value=1, key="orders_page")
+
+    with col_info:
+        st.caption(f"{len(view)} / {len(df)} đơn — trang {page}/{pages}")
+
+    page_df = view.iloc[(page - 1) * page_size:page * page_size]
+
+    # selection của st.dataframe là vị trí dòng → key đổi theo trang / bộ lọc /
+    # sắp xếp / data version để lựa chọn cũ không trỏ sang đơn khác
+    view_key = json.dumps(
+        [page, page_size, query, sorted(channels), sort_by, descending, get_data_version(order_source())],
+        ensure_ascii=False
+    )
+    grid_key = "orders_grid_" + hashlib.sha1(view_key.encode("utf-8")).hexdigest()[:12]
+
+    # chỉ gửi trang đang xem xuống trình duyệt; chọn dòng để thao tác
+    event = st.dataframe(
+        page_df,
+        use_container_width=True,
+        hide_index=True,
+        on_select="rerun",
+        selection_mode="multi-row",
+        key=grid_key
+    )
+
+    if ORDER_ID_COLUMN not in df.columns:
+        return
 
-        st.subheader("📊 So sánh 2 tour")
+    # ===== THAO TÁC HÀNG LOẠT =====
+    orders = df[df[ORDER_ID_COLUMN].astype(str) != ""]
+    orders = orders.set_index(orders[ORDER_ID_COLUMN].astype(str))
+
+    # đổi vị trí sang mã đơn ngay, trước mọi thao tác ghi
+    selected = [
+        order_id
+        for order_id in dict.fromkeys(
+            str(page_df.iloc[i][ORDER_ID_COLUMN])
+            for i in event.selection.rows
+            if i < len(page_df)
+        )
+        if order_id in orders.index
+    ]
 
-        tour1 = st.text_input("Tour 1")
-        tour2 = st.text_input("Tour 2")
+    editable = [c for c in df.columns if c != ORDER_ID_COLUMN]
 
-        if st.button("So sánh tour"):
+    st.caption(f"Đã chọn {len(selected)} đơn")
 
-            prompt = f"So sánh 2 tour {tour1} và {tour2} của công ty Vietravel."
+    col_a, col_b, col_c, col_d = st.columns([2, 2, 1, 1])
 
-            res = ask_company_ai(prompt)
+    with col_a:
+        field = st.selectbox("Cột", editable, key="bulk_field")
 
-            st.session_state.chat_history.append(("Bạn", f"So sánh: {tour1} vs {tour2}"))
-            st.session_state.chat_history.append(("AI", res))
+    with col_b:
+        new_value = st.text_input("Giá trị mới", key="bulk_value")
 
-        st.divider()
+    with col_c:
+        if st.button("Cập nhật", disabled=not selected, use_container_width=True):
+            expected = {i: orders.at[i, field] for i in selected}
+            if update_orders(selected, field, new_value, expected):
+                st.success(f"Đã cập nhật {len(selected)} đơn")
+                st.rerun()
 
-        st.subheader("📂 AI Tra cứu Tour (Drive)")
+    with col_d:
+        if st.button("🗑 Xoá", disabled=not selected, use_container_width=True):
+            if delete_orders(selected):
+                st.success(f"Đã xóa {len(selected)} đơn")
+                st.rerun()
 
-        drive_query = st.text_input(
-            "Nhập tên tour cần tìm",
-            placeholder="Ví dụ: Nhật Bản, Hàn Quốc, Úc..."
-        )
 
-        if st.button("🔍 Tìm Tour Drive"):
+def filter_orders(df, query="", channels=()):
 
-            if not drive_query:
-                st.warning("Nhập tên tour")
-            else:
+    mask = pd.Series(True, index=df.index)
 
-                with st.spinner("AI đang đọc dữ liệu Drive..."):
+    if query:
+        text_cols = [c for c in ["Tên", "Tour", "Note", "Sale", ORDER_ID_COLUMN] if c in df.columns]
+        hay = df[text_cols].astype(str).agg(" ".join, axis=1).map(fold_vietnamese)
+        mask &= hay.str.contains(fold_vietnamese(query), regex=False)
 
-                    result = ai_search_tour_drive(drive_query)
+    if channels and "Kênh" in df.columns:
+        mask &= df["Kênh"].astype(str).isin(channels)
 
-                st.success("✅ Đã tìm thấy thông tin")
+    return df[mask]
 
-                st.text_area(
-                    "Thông tin gửi khách",
-                    result,
-                    height=300
-                )
 
-                st.code(result, language="text")
+def parse_vnd(value):
 
-        st.subheader("💬 Lịch sử AI")
+    if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+        return float(value)
 
-        for role, msg in st.session_state.chat_history:
-            st.write(f"**{role}:** {msg}")
-# =====================================================
-# CUSTOMERS & ORDERS
-# =====================================================
+    text = re.sub(r"\s+|vn[dđ]|[đ₫]", "", str(value).lower())
 
-def render_customer_orders():
+    # một số tiền duy nhất; khoảng giá ("12.990.000 - 15.990.000đ") hay chữ → NaN
+    if not re.fullmatch(r"\d+(?:[.,]\d+)*", text):
+        return np.nan
 
-    st.title("Customers & Orders")
+    groups = re.split(r"[.,]", text)
+    separators = re.findall(r"[.,]", text)
 
-    st.subheader("Danh sách khách")
-    st.dataframe(pd.DataFrame(st.session_state.customer_list))
+    if not separators:
+        return float(text)
 
-    st.divider()
+    # "12.990.000" / "12,990,000": chỉ có dấu tách hàng nghìn
+    if len(set(separators)) == 1 and len(groups[0]) <= 3 and all(len(g) == 3 for g in groups[1:]):
+        return float("".join(groups))
 
-    df = load_sheet()
+    # dấu cuối là dấu thập phân ("1200000.0", "1.200.000,5"), phần trước chỉ được tách nghìn
+    whole, decimals = groups[:-1], groups[-1]
+    thousands = separators[:-1]
 
-    st.subheader("Đơn đã chốt")
+    if set(thousands) - ({"."} if separators[-1] == "," else {","}) \
+            or (len(whole) > 1 and (len(whole[0]) > 3 or any(len(g) != 3 for g in whole[1:]))):
+        return np.nan
 
-    if df.empty:
-        st.info("Chưa có dữ liệu")
-        return
+    return float("".join(whole) + "." + decimals)
 
-    for idx, row in df.iterrows():
 
-        col1, col2, col3, col4, col5, col6 = st.columns([2,2,2,2,2,1])
+def parse_price(series):
 
-        with col1:
-            st.write(row.get('Ngày',''))
+    # parse theo giá trị khác nhau: cột giá lặp lại nhiều
+    values = series.astype(object)
+    parsed = {v: parse_vnd(v) for v in pd.unique(values)}
 
-        with col2:
-            st.write(row.get('Tên',''))
+    return values.map(parsed).astype("float64")
 
-        with col3:
-            st.write(row.get('Tour',''))
 
-        with col4:
-            st.write(row.get('Giá',''))
+def price_value_column(column):
+    return column + PRICE_VALUE_SUFFIX
 
-        with col5:
-            st.write(row.get('Kênh',''))
 
-        with col6:
+def sort_orders(df, column, ascending=True):
 
-            if st.button("❌", key=f"del_{idx}"):
+    if column not in df.columns:
+        return df
 
-                ok = delete_row(idx + 2)
+    if column == "Giá":
+        key = parse_price
+    elif column == "Ngày":
+        key = lambda s: pd.to_datetime(s, errors="coerce")
+    else:
+        key = lambda s: s.astype(str)
 
-                if ok:
-                    st.success("Đã xóa")
-                    st.rerun()
+    return df.sort_values(column, ascending=ascending, key=key, kind="stable")
 
 
 # =====================================================
@@ -976,6 +4697,7 @@ def render_customer_orders():
 # =====================================================
 # GUIDE CENTER
 # =====================================================
+@perf_timed
 def render_guide_center():
 
     st.title("📘 Cẩm nang")
@@ -1075,85 +4797,458 @@ def render_guide_center():
 # VISA AI
 # =====================================================
 
+VISA_DOCS = [
+    "THÔNG BÁO NHẬN QT NN.docx",
+    "CÁC LƯU Ý VISA NHẬP CẢNH VIỆT NAM CHO NGƯỜI NƯỚC NGOÀI.docx",
+]
+
+
+# parse 1 lần / process; mtime + size nằm trong key → sửa file là tự đọc lại
+@st.cache_resource(max_entries=8)
+def parse_docx_text(file_path, mtime, size):
+    return docx_text(file_path)
+
+
+def file_signature(file_path):
+    try:
+        stat = os.stat(file_path)
+        return (file_path, stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return (file_path, 0, 0)
+
+
 def read_docx(file_path):
     try:
-        doc = Document(file_path)
-        text = "\n".join([para.text for para in doc.paragraphs])
-        return text
+        return parse_docx_text(*file_signature(file_path))
     except:
         return ""
 
 
-visa_rule_1 = read_docx("THÔNG BÁO NHẬN QT NN.docx")
-visa_rule_2 = read_docx("CÁC LƯU Ý VISA NHẬP CẢNH VIỆT NAM CHO NGƯỜI NƯỚC NGOÀI.docx")
+# =====================================================
+# VISA RULE INDEX
+# =====================================================
+# Parser nằm ở visa_rules.py; ở đây chỉ cache index theo mtime / size của
+# 2 file visa. Tra cứu bằng dict → vài ms, AI chỉ dùng để viết lại câu trả lời.
+
+@st.cache_resource(max_entries=4)
+def build_visa_rule_index(signature):
+    return build_rule_index([
+        (os.path.splitext(os.path.basename(file_path))[0], read_docx(file_path))
+        for file_path, _, _ in signature
+    ])
+
+
+def visa_rule_index():
+    return build_visa_rule_index(tuple(file_signature(p) for p in VISA_DOCS))
+
+
+def lookup_visa_rules(nationality, visa_type=None, entry_port=None):
+    return find_visa_rules(visa_rule_index(), nationality, visa_type, entry_port)
+
+
+def visa_rules_frame(rules):
 
-visa_knowledge = visa_rule_1 + "\n" + visa_rule_2
+    frame = pd.DataFrame([
+        {
+            "Quy định": r["title"],
+            "Loại": r["visa_type"],
+            "Lưu trú tối đa (ngày)": r["stay_days"],
+            "Cửa khẩu": ", ".join(r["ports"]) or "Tất cả",
+            "Quốc tịch": ", ".join(r["groups"] + r["countries"]) or "Tất cả",
+        }
+        for r in rules
+    ], columns=["Quy định", "Loại", "Lưu trú tối đa (ngày)", "Cửa khẩu", "Quốc tịch"])
 
+    return frame.astype({"Lưu trú tối đa (ngày)": "Int64"})
 
+
+@perf_timed
 def visa_tab():
 
     st.title("🛂 Visa Information")
 
+    index = visa_rule_index()
+
     nationality = st.text_input("Quốc tịch")
-    destination = st.text_input("Điểm đến")
+    destination = st.text_input("Điểm đến", value="Việt Nam")
+
+    col1, col2 = st.columns(2)
+
+    visa_type = col1.selectbox("Loại visa", ["Tất cả"] + sorted(index["by_type"]))
+    entry_port = col2.selectbox("Cửa khẩu", ["Tự nhận từ điểm đến"] + sorted(p for p in index["by_port"] if p != "*"))
+
+    checked = st.button("Kiểm tra Visa")
+
+    if checked:
+        st.session_state.visa_query = (nationality, destination, visa_type, entry_port)
+
+    if "visa_query" not in st.session_state:
+        return
+
+    nationality, destination, visa_type, entry_port = st.session_state.visa_query
+
+    if entry_port == "Tự nhận từ điểm đến":
+        entry_port = next(iter(match_aliases(destination, VISA_ALIAS_TO_PORT)), None)
+
+    inbound = is_inbound_destination(destination)
+    rules = []
+
+    if inbound:
+
+        started = time.perf_counter()
+
+        with perf_span("visa.lookup"):
+            rules = lookup_visa_rules(nationality, None if visa_type == "Tất cả" else visa_type, entry_port)
+
+        exemptions = visa_exemptions(rules, entry_port)
+        nationalities = nationality_keys(nationality, index["aliases"])
+
+        if VISA_HOME_COUNTRY in nationalities:
+            st.success(f"✅ Khách quốc tịch {VISA_HOME_COUNTRY} nhập cảnh bằng hộ chiếu {VISA_HOME_COUNTRY}, không cần visa.")
+        elif exemptions:
+            best = max(exemptions, key=lambda r: r["stay_days"] or 0)
+            st.success(
+                f"✅ Khách {nationality} được miễn visa vào Việt Nam"
+                + (f", lưu trú tối đa {best['stay_days']} ngày" if best["stay_days"] else "")
+                + f" — theo «{best['title']}»"
+            )
+        elif not nationalities:
+            st.warning(f"⚠️ Chưa nhận diện được quốc tịch «{nationality}» trong quy định — xem các quy định chung bên dưới.")
+        else:
+            st.warning(f"⚠️ Khách {nationality} không thuộc diện miễn visa trong quy định → cần xin visa (xem bên dưới).")
+
+        st.dataframe(visa_rules_frame(rules), use_container_width=True, hide_index=True)
+
+        st.caption(f"Tra {len(rules)} / {len(index['rules'])} quy định trong {(time.perf_counter() - started) * 1000:.1f} ms")
+
+        for note in index["notes"]:
+            with st.expander(f"📌 {note['title']}"):
+                st.text(note["text"])
+
+    else:
+        st.info(f"Quy định nội bộ chỉ áp dụng cho nhập cảnh Việt Nam → AI tư vấn visa {destination} theo hiểu biết chung, cần đối chiếu lại với đại sứ quán / lãnh sự quán.")
+
+    # nhập cảnh Việt Nam: AI chỉ viết lại câu trả lời từ các quy định đã lọc
+    phrase = inbound and st.button("✍️ AI soạn câu trả lời cho khách")
+
+    if phrase:
 
-    if st.button("Kiểm tra Visa"):
+        prompt, _ = build_prompt("""
+Quy định liên quan:
+{context}
 
-        prompt = f"""
-Dữ liệu:
-{visa_knowledge}
+Khách quốc tịch {nationality} đi {destination}.
+
+Chỉ dựa vào quy định trên, tư vấn visa ngắn gọn cho khách.
+""", rules + index["notes"], nationality=nationality, destination=destination)
+
+        stream_answer(prompt)
+
+    # đi nước ngoài: file nội bộ không có quy định của nước đến → tư vấn mở
+    elif checked and not inbound:
 
+        prompt, _ = build_prompt("""
 Khách quốc tịch {nationality} đi {destination}.
 
 Tư vấn visa chi tiết.
-"""
+""", nationality=nationality, destination=destination)
 
-        result = ask_chatgpt(prompt)
-        st.write(result)
+        stream_answer(prompt)
 
 # =====================================================
 # COMPANY AI KNOWLEDGE BASE
 # =====================================================
 
-def load_company_knowledge():
+def load_company_chunks():
+
+    chunks = []
 
-    text = ""
+    # Visa — mỗi quy định trong index là một đoạn, lưu ý chung cắt theo độ dài
+    index = visa_rule_index()
 
-    # Visa docs
-    text += visa_knowledge + "\n"
+    for rule in index["rules"]:
+        chunks.append({"source": "Visa", "text": rule["text"]})
 
-    # Tour sheet
+    for note in index["notes"]:
+        for text in chunk_text(note["text"]):
+            chunks.append({"source": "Visa", "text": text})
+
+    # Tour sheet — mỗi dòng tour là một đoạn
     try:
         df = load_tour_sheet()
-        if not df.empty:
-            text += df.to_string()
+        for row in df.to_dict("records"):
+            chunks.append({
+                "source": "Tour",
+                "text": " | ".join(f"{col}: {val}" for col, val in row.items() if str(val).strip())
+            })
     except:
         pass
 
-    return text
+    return chunks
 
 
-def ask_company_ai(question):
+# =====================================================
+# KNOWLEDGE VECTOR INDEX
+# =====================================================
+# Embed từng đoạn dữ liệu công ty, lưu ma trận vector thành file .npy
+# và mở bằng memory-map. Backend embedding chọn qua config
+# "embedding_backend"; "hashing" chạy offline và cho kết quả cố định.
+
+def _hash_features(text):
+
+    tokens = re.findall(r"\w+", fold_vietnamese(text))
+
+    return tokens + [a + " " + b for a, b in zip(tokens, tokens[1:])]
+
+
+def embed_hashing(texts):
+
+    vectors = np.zeros((len(texts), KB_EMBED_DIM), dtype=np.float32)
+
+    for i, text in enumerate(texts):
+        for feature in _hash_features(text):
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            h = int.from_bytes(digest, "little")
+            vectors[i, h % KB_EMBED_DIM] += 1.0 if (h >> 63) & 1 else -1.0
+
+    vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def embed_openai(texts, batch_size=256):
+
+    client = get_openai_client(st.session_state.api_key)
+    vectors = []
+
+    for i in range(0, len(texts), batch_size):
+        response = call_with_limits(
+            "openai",
+            client.embeddings.create,
+            model="text-embedding-3-small",
+            input=texts[i:i + batch_size]
+        )
+        vectors.extend(item.embedding for item in response.data)
+
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+EMBEDDING_BACKENDS = {
+    "hashing": embed_hashing,
+    "openai": embed_openai,
+}
+
+
+def get_embedding_backend():
+    return config.get("embedding_backend", "hashing")
+
+
+def knowledge_fingerprint(backend, chunks):
+
+    h = hashlib.sha1(backend.encode("utf-8"))
+
+    for chunk in chunks:
+        h.update(chunk["text"].encode("utf-8"))
+        h.update(b"\0")
+
+    return h.hexdigest()
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def get_knowledge_index(backend, fingerprint, _chunks):
+
+    os.makedirs(KB_INDEX_DIR, exist_ok=True)
+
+    vectors_path = os.path.join(KB_INDEX_DIR, f"{fingerprint}.npy")
+    chunks_path = os.path.join(KB_INDEX_DIR, f"{fingerprint}.json")
 
-    knowledge = load_company_knowledge()
+    if not os.path.exists(vectors_path):
 
-    prompt = f"""
+        vectors = EMBEDDING_BACKENDS[backend]([c["text"] for c in _chunks])
+
+        with open(chunks_path, "w") as f:
+            json.dump(_chunks, f, ensure_ascii=False)
+
+        # ghi file tạm rồi rename để session khác không đọc file dở dang
+        tmp_path = vectors_path + ".tmp.npy"
+        np.save(tmp_path, vectors)
+        os.replace(tmp_path, vectors_path)
+
+        # xoá index cũ
+        for name in os.listdir(KB_INDEX_DIR):
+            if not name.startswith(fingerprint):
+                os.remove(os.path.join(KB_INDEX_DIR, name))
+
+    with open(chunks_path) as f:
+        chunks = json.load(f)
+
+    return {
+        "backend": backend,
+        "chunks": chunks,
+        "vectors": np.load(vectors_path, mmap_mode="r")
+    }
+
+
+@st.cache_resource
+def _knowledge_chunks():
+    return {}
+
+
+def load_knowledge_index():
+
+    backend = get_embedding_backend()
+    url = st.session_state.tour_sheet_url
+
+    # chỉ dựng lại các đoạn + fingerprint khi tour sheet đổi version, hết
+    # SHEET_CACHE_TTL (bắt kịp sửa tay trên sheet) hoặc file visa đổi
+    cache = _knowledge_chunks()
+    version = (get_data_version(url), tuple(file_signature(p) for p in VISA_DOCS))
+    entry = cache.get((backend, url))
+
+    if not entry or entry["version"] != version or time.time() - entry["at"] >= SHEET_CACHE_TTL:
+        chunks = load_company_chunks()
+        entry = {
+            "version": version,
+            "at": time.time(),
+            "fingerprint": knowledge_fingerprint(backend, chunks),
+            "chunks": chunks,
+        }
+        cache[(backend, url)] = entry
+
+    return get_knowledge_index(backend, entry["fingerprint"], entry["chunks"])
+
+
+def search_knowledge(index, queries, top_k=KB_TOP_K):
+
+    vectors = index["vectors"]
+
+    if len(vectors) == 0:
+        return [[] for _ in queries]
+
+    query_vectors = EMBEDDING_BACKENDS[index["backend"]](list(queries))
+
+    # cosine = dot product vì mọi vector đã được chuẩn hoá
+    scores = np.asarray(vectors @ query_vectors.T)
+    k = min(top_k, len(vectors))
+
+    results = []
+
+    for col in scores.T:
+        top = np.argpartition(-col, k - 1)[:k]
+        top = top[np.argsort(-col[top])]
+        results.append([(float(col[i]), index["chunks"][i]) for i in top])
+
+    return results
+
+
+# =====================================================
+# COMPANY AI
+# =====================================================
+
+def load_company_knowledge(question, top_k=KB_TOP_K):
+
+    try:
+        index = load_knowledge_index()
+        hits = search_knowledge(index, [question], top_k)[0]
+    except Exception:
+        return []
+
+    return [f"[{chunk['source']}] {chunk['text']}" for _, chunk in hits]
+
+
+def build_company_prompt(question):
+
+    knowledge = load_company_knowledge(question)
+
+    prompt, _ = build_prompt("""
 Bạn là chuyên gia sản phẩm Vietravel.
 
 Dữ liệu nội bộ công ty:
-{knowledge}
+{context}
 
 Câu hỏi:
 {question}
 
 Trả lời chính xác theo dữ liệu công ty.
-"""
+""", knowledge, question=question)
+
+    return prompt
+
+
+def ask_company_ai(question):
+    return ask_chatgpt(build_company_prompt(question))
+# =====================================================
+# PERFORMANCE (ADMIN)
+# =====================================================
+
+def admin_password():
+    try:
+        return st.secrets.get("admin_password", "")
+    except Exception:
+        return ""
+
+
+@perf_timed
+def render_performance():
+
+    st.title("⏱ Performance")
+
+    rows = perf_summary()
+
+    st.caption(
+        f"Số liệu từ {datetime.fromtimestamp(_perf_store()['since']):%d/%m %H:%M:%S}. "
+        f"p50 / p95 / p99 tính trên {PERF_SAMPLE_SIZE} lần gần nhất của mỗi thao tác."
+    )
+
+    if not rows:
+        st.info("Chưa có số liệu")
+        return
+
+    groups = sorted({row["op"].split(".")[0] for row in rows})
+    selected = st.multiselect("Nhóm", groups, default=groups)
+
+    table = pd.DataFrame([
+        {k: v for k, v in row.items() if k != "buckets"}
+        for row in rows
+        if row["op"].split(".")[0] in selected
+    ])
+
+    if not table.empty:
+        st.dataframe(
+            table.sort_values("total_s", ascending=False),
+            use_container_width=True,
+            hide_index=True
+        )
+
+    with _perf_store()["lock"]:
+        prompts = np.array(_perf_store()["prompts"]).reshape(-1, 3)
+
+    if len(prompts):
+        st.caption(
+            f"Prompt LLM ({len(prompts)} lần gần nhất): trung bình {prompts[:, 0].mean():.0f} token, "
+            f"p95 {np.percentile(prompts[:, 0], 95):.0f}, lớn nhất {prompts[:, 0].max()} / {PROMPT_TOKEN_BUDGET} — "
+            f"{int((prompts[:, 1] < prompts[:, 2]).sum())} lần phải bỏ bớt dữ liệu cho vừa ngân sách token."
+        )
+
+    col1, col2, col3 = st.columns(3)
+
+    col1.download_button("⬇️ Prometheus", perf_prometheus(rows), file_name="metrics.prom", mime="text/plain")
+    col2.download_button("⬇️ JSON lines", perf_jsonl(rows), file_name="metrics.jsonl", mime="application/x-ndjson")
+
+    if col3.button("Xoá số liệu"):
+        reset_perf_metrics()
+        st.rerun()
+
 
-    return ask_chatgpt(prompt)
 # =====================================================
 # SETTINGS
 # =====================================================
 
+@perf_timed
 def render_settings():
 
     st.title("Settings")
@@ -1169,6 +5264,7 @@ def render_settings():
         st.session_state.api_key = key
 
         save_config({
+            **config,
             "sheet_url": st.session_state.sheet_url,
             "tour_sheet_url": st.session_state.tour_sheet_url,
             "guide_sheet_url": st.session_state.guide_sheet_url,
@@ -1216,6 +5312,7 @@ def render_settings():
         st.session_state.drive_folder = drive_link
 
         save_config({
+            **config,
             "sheet_url": sheet_link,
             "tour_sheet_url": tour_link,
             "guide_sheet_url": guide_link,
@@ -1224,16 +5321,156 @@ def render_settings():
         })
 
         st.success("Đã lưu vĩnh viễn")
+
+    st.divider()
+
+    # ===============================
+    # NƠI LƯU ĐƠN
+    # ===============================
+
+    st.subheader("🗄 Nơi lưu đơn")
+
+    storage_labels = {
+        "sheets": "Google Sheet",
+        "sqlite": "SQLite trên máy chủ (đồng bộ lên Google Sheet)"
+    }
+
+    # config.json dùng chung: đổi ở đây là đổi cho mọi sale nên chỉ admin được đổi
+    storage = st.selectbox(
+        "Lưu đơn vào",
+        list(storage_labels),
+        index=list(storage_labels).index(order_storage()),
+        format_func=storage_labels.get,
+        disabled=not st.session_state.is_admin,
+        help=None if st.session_state.is_admin else "Chỉ admin đổi được nơi lưu đơn."
+    )
+
+    if storage != order_storage() and st.session_state.is_admin:
+
+        save_config({**config, "order_storage": storage})
+
+        # bỏ cache / tổng hợp dashboard của cả hai nơi lưu để mọi session đọc lại
+        for source in (st.session_state.sheet_url, LOCAL_ORDER_SOURCE):
+            if source:
+                invalidate_sheet_cache(source)
+                drop_dashboard_aggregates(source)
+
+        st.rerun()
+
+    if storage == "sqlite":
+
+        st.caption(
+            f"Đơn đọc / ghi tại {ORDER_DB}. Có Link Sheet Orders thì đơn mới, "
+            "đơn sửa và đơn xoá được đồng bộ lên sheet sau vài giây."
+        )
+
+        if st.button("📥 Nhập đơn từ Google Sheet"):
+
+            imported = import_sheet_orders()
+            st.success(f"Đã nhập {imported} đơn")
+
+    st.divider()
+
+    # ===============================
+    # CACHE CÂU TRẢ LỜI AI
+    # ===============================
+
+    st.subheader("🤖 Cache câu trả lời AI")
+
+    cache_enabled = st.checkbox(
+        "Dùng lại câu trả lời cho câu hỏi giống nhau",
+        value=st.session_state.llm_cache_enabled
+    )
+
+    if cache_enabled != st.session_state.llm_cache_enabled:
+
+        st.session_state.llm_cache_enabled = cache_enabled
+
+        save_config({**config, "llm_cache_enabled": cache_enabled})
+
+    try:
+        stats = llm_cache_stats()
+    except sqlite3.Error:
+        stats = {"hits": 0, "misses": 0, "entries": 0}
+
+    total = stats["hits"] + stats["misses"]
+
+    col1, col2, col3 = st.columns(3)
+
+    col1.metric("Hit", stats["hits"])
+    col2.metric("Miss", stats["misses"])
+    col3.metric("Tỉ lệ hit", f"{stats['hits'] / total:.0%}" if total else "—")
+
+    st.caption(f"{stats['entries']} câu trả lời đang lưu")
+
+    if st.button("Xoá cache AI"):
+        clear_llm_cache()
+        st.success("Đã xoá cache")
+
+    st.divider()
+
+    # ===============================
+    # GIỚI HẠN GỌI API
+    # ===============================
+
+    st.subheader("🚦 Giới hạn gọi API")
+
+    st.dataframe(
+        pd.DataFrame(rate_limit_metrics()).rename(columns={
+            "calls": "Số lần gọi",
+            "retries": "Thử lại",
+            "errors": "Lỗi",
+            "wait_avg": "Chờ TB (s)",
+            "wait_max": "Chờ lâu nhất (s)",
+            "queue": "Đang chờ",
+            "queue_peak": "Hàng đợi cao nhất",
+            "in_flight": "Đang chạy",
+        }).drop(columns=["wait_total"]),
+        use_container_width=True,
+        hide_index=True
+    )
 # =====================================================
 # SIDEBAR
 # =====================================================
 
+get_order_flusher()
+get_order_syncer()["sheet_url"] = st.session_state.sheet_url if order_storage() == "sqlite" else ""
+
 st.sidebar.image(LOGO_URL, width=150)
 
-menu = st.sidebar.radio(
-    "MENU",
-    ["Dashboard", "Sales Center", "Customers & Orders", "Guide Center", "Visa Info", "Settings"]
-)
+if "is_admin" not in st.session_state:
+    st.session_state.is_admin = False
+
+pages = ["Dashboard", "Sales Center", "Customers & Orders", "Guide Center", "Visa Info", "Settings"]
+
+if st.session_state.is_admin:
+    pages.append("Performance")
+
+menu = st.sidebar.radio("MENU", pages)
+
+st.sidebar.text_input("👤 Tên sale", key="rep_name")
+
+with st.sidebar.expander("🔐 Admin"):
+
+    if st.session_state.is_admin:
+
+        if st.button("Thoát admin"):
+            st.session_state.is_admin = False
+            st.rerun()
+
+    elif not admin_password():
+        st.caption("Chưa cấu hình admin_password trong secrets.")
+
+    else:
+
+        password = st.text_input("Mật khẩu admin", type="password", key="admin_password_input")
+
+        if st.button("Đăng nhập admin"):
+            if hmac.compare_digest(password.encode(), admin_password().encode()):
+                st.session_state.is_admin = True
+                st.rerun()
+            else:
+                st.error("Sai mật khẩu")
 
 
 # =====================================================
@@ -1258,6 +5495,9 @@ elif menu == "Visa Info":
 elif menu == "Settings":
     render_settings()
 
+elif menu == "Performance" and st.session_state.is_admin:
+    render_performance()
+
 
 
 
@@ -0,0 +1,368 @@
+# =====================================================
+# FAKE GOOGLE SHEETS / DRIVE / OPENAI
+# =====================================================
+# Thay thế trong process cho gspread, Drive v3 và OpenAI để đo hiệu năng
+# app.py không cần mạng. Chỉ cài đặt đúng phần API mà app.py đang gọi.
+
+import re
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import gspread.utils
+import httplib2
+
+
+# =============================
+# GOOGLE AUTH
+# =============================
+
+class FakeCredentials:
+
+    valid = True
+
+    def __init__(self):
+        self.expiry = datetime.utcnow() + timedelta(days=1)
+
+    def refresh(self, request):
+        self.expiry = datetime.utcnow() + timedelta(days=1)
+
+
+FAKE_SERVICE_ACCOUNT = {
+    "type": "service_account",
+    "project_id": "bench",
+    "client_email": "bench@bench.iam.gserviceaccount.com",
+}
+
+
+# =============================
+# GSPREAD
+# =============================
+
+def _numericise(value):
+
+    # giống get_all_records() mặc định: chuỗi số được đổi thành int / float
+    if isinstance(value, str) and re.fullmatch(r"-?\d+", value):
+        return int(value)
+
+    if isinstance(value, str) and re.fullmatch(r"-?\d*\.\d+", value):
+        return float(value)
+
+    return value
+
+
+class FakeWorksheet:
+
+    def __init__(self, spreadsheet, title, rows, sheet_id=0):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.rows = [list(r) for r in rows]
+        self.calls = []
+
+    def _log(self, name):
+        self.calls.append(name)
+
+    def _cell(self, row, col):
+        if row <= len(self.rows) and col <= len(self.rows[row - 1]):
+            return self.rows[row - 1][col - 1]
+        return ""
+
+    def _set(self, row, col, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        line = self.rows[row - 1]
+        line.extend([""] * (col - len(line)))
+        line[col - 1] = value
+
+    def get_all_records(self):
+        self._log("get_all_records")
+        if not self.rows:
+            return []
+        header = self.rows[0]
+        return [
+            {h: _numericise(r[i] if i < len(r) else "") for i, h in enumerate(header)}
+            for r in self.rows[1:]
+        ]
+
+    def get_all_values(self):
+        self._log("get_all_values")
+        return [list(r) for r in self.rows]
+
+    def row_values(self, row):
+        self._log("row_values")
+        values = list(self.rows[row - 1]) if row <= len(self.rows) else []
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def col_values(self, col):
+        self._log("col_values")
+        values = [self._cell(r, col) for r in range(1, len(self.rows) + 1)]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def update_cell(self, row, col, value):
+        self._log("update_cell")
+        self._set(row, col, value)
+
+    def update(self, values, range_name="A1", **kwargs):
+        self._log("update")
+        row, col = gspread.utils.a1_to_rowcol(range_name.split(":")[0])
+        for i, line in enumerate(values):
+            for j, value in enumerate(line):
+                self._set(row + i, col + j, value)
+
+    def batch_get(self, ranges):
+        self._log("batch_get")
+        return [[[self._cell(*gspread.utils.a1_to_rowcol(a1))]] for a1 in ranges]
+
+    def batch_update(self, data, **kwargs):
+        self._log("batch_update")
+        for item in data:
+            row, col = gspread.utils.a1_to_rowcol(item["range"].split(":")[0])
+            self._set(row, col, item["values"][0][0])
+
+    def append_rows(self, rows, **kwargs):
+        self._log("append_rows")
+        self.rows.extend(list(r) for r in rows)
+
+    def append_row(self, row, **kwargs):
+        self._log("append_row")
+        self.rows.append(list(row))
+
+    def delete_rows(self, start, end=None):
+        self._log("delete_rows")
+        del self.rows[start - 1:(end or start)]
+
+    def resize(self, rows=None, cols=None):
+        self._log("resize")
+        if rows is not None:
+            del self.rows[rows:]
+
+
+class FakeSpreadsheet:
+
+    def __init__(self, url, worksheets):
+        self.url = url
+        self._worksheets = [
+            FakeWorksheet(self, title, rows, sheet_id=i)
+            for i, (title, rows) in enumerate(worksheets.items())
+        ]
+
+    @property
+    def sheet1(self):
+        return self._worksheets[0]
+
+    def worksheet(self, title):
+        for ws in self._worksheets:
+            if ws.title == title:
+                return ws
+        raise gspread.exceptions.WorksheetNotFound(title)
+
+    def worksheets(self):
+        return list(self._worksheets)
+
+    def batch_update(self, body):
+        for request in body["requests"]:
+            rng = request["deleteDimension"]["range"]
+            ws = self._worksheets[rng["sheetId"]]
+            del ws.rows[rng["startIndex"]:rng["endIndex"]]
+        return {}
+
+
+class FakeGspreadClient:
+
+    def __init__(self):
+        self.spreadsheets = {}
+
+    def add(self, url, worksheets):
+        self.spreadsheets[url] = FakeSpreadsheet(url, worksheets)
+        return self.spreadsheets[url]
+
+    def open_by_url(self, url):
+        if url not in self.spreadsheets:
+            raise gspread.exceptions.SpreadsheetNotFound(url)
+        return self.spreadsheets[url]
+
+
+# =============================
+# DRIVE V3
+# =============================
+
+class FakeDrive:
+
+    # folders: {folder_id: [{"id", "name", "mimeType", "modifiedTime", "md5Checksum", "data"}]}
+    def __init__(self, latency=0.0):
+        self.folders = {}
+        self.blobs = {}
+        self.latency = latency
+
+    def add_folder(self, folder_id, files):
+        self.folders[folder_id] = [{k: v for k, v in f.items() if k != "data"} for f in files]
+        self.blobs.update({f["id"]: f["data"] for f in files})
+
+    def service(self):
+        return FakeDriveService(self)
+
+    def http(self, *args, **kwargs):
+        return FakeDriveHttp(self)
+
+
+class _FakeRequest:
+
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self, http=None, num_retries=0):
+        return self._result
+
+
+class FakeDriveFiles:
+
+    def __init__(self, drive):
+        self._drive = drive
+
+    def list(self, q="", fields=None, pageSize=100, pageToken=None, **kwargs):
+        folder_id = re.search(r"'([^']+)' in parents", q).group(1)
+        files = self._drive.folders.get(folder_id, [])
+        start = int(pageToken or 0)
+        page = {"files": files[start:start + pageSize]}
+        if start + pageSize < len(files):
+            page["nextPageToken"] = str(start + pageSize)
+        return _FakeRequest(page)
+
+    def get_media(self, fileId, **kwargs):
+        return SimpleNamespace(uri=f"fake://drive/{fileId}", headers={}, http=None)
+
+
+class FakeDriveService:
+
+    def __init__(self, drive):
+        self._drive = drive
+
+    def files(self):
+        return FakeDriveFiles(self._drive)
+
+
+class FakeDriveHttp:
+
+    def __init__(self, drive):
+        self._drive = drive
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        if self._drive.latency:
+            time.sleep(self._drive.latency)
+        data = self._drive.blobs[uri.rsplit("/", 1)[1]]
+        return httplib2.Response({"status": "200", "content-length": str(len(data))}), data
+
+
+# =============================
+# OPENAI
+# =============================
+
+class FakeOpenAIState:
+
+    def __init__(self, latency=0.0, answer="Gợi ý tour: Nhật Bản mùa thu 6N5Đ."):
+        self.latency = latency
+        self.answer = answer
+        self.calls = 0
+
+
+def _completion(state, messages):
+    state.calls += 1
+    return state.answer + f" ({len(messages[-1]['content'])} ký tự)"
+
+
+class _FakeCompletions:
+
+    def __init__(self, state):
+        self._state = state
+
+    def create(self, model, messages, stream=False, **kwargs):
+
+        if self._state.latency:
+            time.sleep(self._state.latency)
+
+        answer = _completion(self._state, messages)
+
+        if stream:
+            return iter(
+                SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word + " "))])
+                for word in answer.split()
+            )
+
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=answer))],
+            usage=SimpleNamespace(prompt_tokens=0, completion_tokens=0)
+        )
+
+
+class _FakeAsyncCompletions(_FakeCompletions):
+
+    async def create(self, model, messages, stream=False, **kwargs):
+
+        import asyncio
+
+        if self._state.latency:
+            await asyncio.sleep(self._state.latency)
+
+        answer = _completion(self._state, messages)
+
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=answer))])
+
+
+class _FakeEmbeddings:
+
+    def __init__(self, state, dim=256):
+        self._state = state
+        self._dim = dim
+
+    def create(self, model, input, **kwargs):
+        data = []
+        for text in input:
+            vector = [0.0] * self._dim
+            for token in text.split():
+                vector[hash(token) % self._dim] += 1.0
+            data.append(SimpleNamespace(embedding=vector))
+        return SimpleNamespace(data=data)
+
+
+def make_openai_classes(state):
+
+    class FakeOpenAI:
+        def __init__(self, *args, **kwargs):
+            self.chat = SimpleNamespace(completions=_FakeCompletions(state))
+            self.embeddings = _FakeEmbeddings(state)
+
+    class FakeAsyncOpenAI:
+        def __init__(self, *args, **kwargs):
+            self.chat = SimpleNamespace(completions=_FakeAsyncCompletions(state))
+
+    return FakeOpenAI, FakeAsyncOpenAI
+
+
+# =============================
+# PATCH
+# =============================
+
+def patch_services(gspread_client, drive, openai_state):
+
+    # vá ở tầng thư viện để cả `import app` lẫn AppTest (chạy lại script) đều dùng fake
+    fake_openai, fake_async_openai = make_openai_classes(openai_state)
+
+    stack = ExitStack()
+    stack.enter_context(mock.patch(
+        "google.oauth2.service_account.Credentials.from_service_account_info",
+        return_value=FakeCredentials()
+    ))
+    stack.enter_context(mock.patch("gspread.authorize", return_value=gspread_client))
+    stack.enter_context(mock.patch("googleapiclient.discovery.build", side_effect=lambda *a, **k: drive.service()))
+    stack.enter_context(mock.patch("google_auth_httplib2.AuthorizedHttp", side_effect=drive.http))
+    stack.enter_context(mock.patch("openai.OpenAI", fake_openai))
+    stack.enter_context(mock.patch("openai.AsyncOpenAI", fake_async_openai))
+
+    return stack
@@ -0,0 +1,199 @@
+# =====================================================
+# SYNTHETIC DATA
+# =====================================================
+# Sinh dữ liệu giả có cấu trúc giống dữ liệu thật: catalog tour, lịch sử
+# đơn và folder Drive gồm file PDF / DOCX nhiều trang. Có seed cố định
+# để các lần chạy benchmark so sánh được với nhau.
+
+import hashlib
+import io
+import random
+import unicodedata
+from datetime import date, timedelta
+
+from docx import Document
+
+
+DESTINATIONS = [
+    "Nhật Bản", "Hàn Quốc", "Đài Loan", "Thái Lan", "Singapore", "Malaysia",
+    "Trung Quốc", "Úc", "New Zealand", "Pháp", "Ý", "Thụy Sĩ", "Đức",
+    "Mỹ", "Canada", "Dubai", "Thổ Nhĩ Kỳ", "Ai Cập", "Maldives", "Bali",
+    "Hà Nội", "Đà Nẵng", "Phú Quốc", "Sapa", "Hạ Long", "Nha Trang",
+]
+
+THEMES = [
+    "mùa thu lá đỏ", "ngắm hoa anh đào", "trượt tuyết", "nghỉ dưỡng biển",
+    "khám phá ẩm thực", "văn hóa lịch sử", "gia đình", "trăng mật",
+    "mua sắm", "thiên nhiên hoang dã", "lễ hội cuối năm", "city tour",
+]
+
+CHANNELS = ["Online", "Facebook", "Zalo", "Chi nhánh"]
+SALES = ["An", "Bình", "Chi", "Dũng", "Hà", "Khoa", "Linh", "Minh", "Nam", "Trang"]
+NAMES = ["Nguyễn", "Trần", "Lê", "Phạm", "Hoàng", "Huỳnh", "Võ", "Đặng", "Bùi", "Đỗ"]
+
+TOUR_HEADER = ["Tour (Tên tour)", "Giá", "Số ngày", "Khởi hành", "Điểm nổi bật"]
+ORDER_HEADER = ["Ngày", "Tên", "Tour", "Giá", "Note", "Kênh", "Sale", "ID"]
+
+
+def tour_name(rng):
+    days = rng.randint(3, 12)
+    return f"Tour {rng.choice(DESTINATIONS)} {rng.choice(THEMES)} {days}N{days - 1}Đ", days
+
+
+def make_tour_catalog(n, seed=1):
+
+    rng = random.Random(seed)
+    rows = [TOUR_HEADER]
+
+    for i in range(n):
+        name, days = tour_name(rng)
+        rows.append([
+            f"{name} #{i}",
+            f"{rng.randint(5, 150) * 1_000_000:,}đ",
+            str(days),
+            (date(2026, 1, 1) + timedelta(days=rng.randint(0, 364))).isoformat(),
+            ", ".join(rng.sample(THEMES, 2)),
+        ])
+
+    return rows
+
+
+def make_orders(n, seed=2, days=365):
+
+    rng = random.Random(seed)
+    start = date(2026, 1, 1)
+    rows = [ORDER_HEADER]
+
+    for i in range(n):
+        name, _ = tour_name(rng)
+        rows.append([
+            (start + timedelta(days=rng.randint(0, days - 1))).isoformat(),
+            f"{rng.choice(NAMES)} {rng.choice(SALES)}",
+            name,
+            f"{rng.randint(5, 150) * 1_000_000:,}đ",
+            rng.choice(["", "", "cọc 30%", "khách quen", "đi 2 người"]),
+            rng.choice(CHANNELS),
+            rng.choice(SALES),
+            f"DH{i:012X}",
+        ])
+
+    return rows
+
+
+def itinerary_pages(rng, tour, pages, words_per_page=350):
+
+    vocabulary = [w for phrase in THEMES + DESTINATIONS for w in phrase.split()]
+    out = []
+
+    for page in range(pages):
+        lines = [f"{tour} - Ngày {page + 1}"]
+        lines += [
+            " ".join(rng.choice(vocabulary) for _ in range(14))
+            for _ in range(words_per_page // 14)
+        ]
+        out.append("\n".join(lines))
+
+    return out
+
+
+def _ascii(text):
+    # font chuẩn của PDF không có dấu tiếng Việt
+    folded = unicodedata.normalize("NFD", text.replace("đ", "d").replace("Đ", "D"))
+    return "".join(c for c in folded if not unicodedata.combining(c)).encode("ascii", "ignore").decode()
+
+
+def make_pdf(pages):
+
+    # PDF tối giản (Helvetica, mỗi trang một content stream) để PyPDF2 đọc được text
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+
+    for text in pages:
+        lines = [
+            _ascii(line).replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+            for line in text.split("\n")
+        ]
+        stream = "BT /F1 9 Tf 11 TL 36 806 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+        stream = stream.encode("latin-1")
+
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects))
+        )
+        kids.append(len(objects))
+
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids)
+    )
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    out.writelines(b"%010d 00000 n \n" % offset for offset in offsets)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+    return out.getvalue()
+
+
+def make_docx(pages):
+
+    doc = Document()
+
+    for text in pages:
+        for line in text.split("\n"):
+            doc.add_paragraph(line)
+
+    out = io.BytesIO()
+    doc.save(out)
+
+    return out.getvalue()
+
+
+def make_drive_folder(n_files, pages_per_file=5, seed=3):
+
+    rng = random.Random(seed)
+    files = []
+
+    for i in range(n_files):
+
+        tour, _ = tour_name(rng)
+        pages = itinerary_pages(rng, tour, pages_per_file)
+
+        if i % 2:
+            name, mime, data = f"{tour} #{i}.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document", make_docx(pages)
+        else:
+            name, mime, data = f"{tour} #{i}.pdf", "application/pdf", make_pdf(pages)
+
+        files.append({
+            "id": f"file{i:06d}",
+            "name": name,
+            "mimeType": mime,
+            "modifiedTime": "2026-01-01T00:00:00.000Z",
+            "md5Checksum": hashlib.md5(data).hexdigest(),
+            "data": data,
+        })
+
+    return files
+
+
+def make_documents(n_pages, seed=4):
+
+    # tài liệu dạng {"text": ...} như iter_drive_documents trả về
+    rng = random.Random(seed)
+
+    return [
+        {"file_id": f"file{i // 10}", "name": f"doc{i // 10}", "page": i % 10 + 1, "text": text}
+        for i, text in enumerate(itinerary_pages(rng, "Tour", n_pages))
+    ]
@@ -0,0 +1,424 @@
+# =====================================================
+# BENCHMARK SUITE
+# =====================================================
+# Đo các đường nóng của app.py với Google Sheets / Drive / OpenAI giả
+# (benchmarks/fakes.py) và dữ liệu sinh ngẫu nhiên (benchmarks/generators.py),
+# không cần mạng hay tài khoản Google.
+#
+#   python benchmarks/run.py                          # chạy mặc định
+#   python benchmarks/run.py --full                   # thêm catalog 1M tour
+#   python benchmarks/run.py --only suggest,dashboard
+#   python benchmarks/run.py --out new.json --compare baseline.json
+#
+# Kết quả ghi ra JSON; --compare so median với file cũ và trả exit code 1
+# nếu có mục chậm hơn ngưỡng --threshold.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from fakes import FAKE_SERVICE_ACCOUNT, FakeDrive, FakeGspreadClient, FakeOpenAIState, patch_services
+from generators import make_documents, make_drive_folder, make_orders, make_tour_catalog
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILE = os.path.join(ROOT, "app.py")
+
+SHEET_URL = "https://docs.google.com/spreadsheets/d/bench-{kind}-{n}/edit"
+DRIVE_URL = "https://drive.google.com/drive/folders/{folder_id}"
+
+GROUPS = ["suggest", "search", "drive", "dashboard", "llm", "pages"]
+PAGES = ["Dashboard", "Sales Center", "Customers & Orders", "Settings"]
+
+SUGGEST_MESSAGES = [
+    "Khách muốn đi Nhật Bản mùa thu lá đỏ khoảng 6 ngày",
+    "Gia đình 4 người hỏi tour Hàn Quốc trượt tuyết",
+    "Tìm tour nghỉ dưỡng biển Phú Quốc cho trăng mật",
+]
+
+
+# =============================
+# ĐO THỜI GIAN
+# =============================
+
+def measure(fn, repeat, setup=None):
+
+    times = []
+    result = None
+
+    for _ in range(repeat):
+
+        if setup:
+            setup()
+
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "runs": repeat,
+        "min_ms": round(min(times), 3),
+        "median_ms": round(statistics.median(times), 3),
+        "mean_ms": round(statistics.fmean(times), 3),
+        "max_ms": round(max(times), 3),
+    }, result
+
+
+def sizes(text):
+    return [int(s) for s in text.split(",") if s]
+
+
+# =============================
+# MÔI TRƯỜNG
+# =============================
+
+def prepare_workdir(orders_url):
+
+    # app.py ghi cache / SQLite / config vào thư mục hiện tại → chạy trong thư mục tạm
+    workdir = tempfile.mkdtemp(prefix="bench-")
+
+    for name in os.listdir(ROOT):
+        if name.endswith(".docx"):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+
+    os.makedirs(os.path.join(workdir, ".streamlit"))
+
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w") as f:
+        f.write("[gcp_service_account]\n")
+        f.writelines(f'{k} = "{v}"\n' for k, v in FAKE_SERVICE_ACCOUNT.items())
+
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump({
+            "sheet_url": orders_url,
+            "tour_sheet_url": "",
+            "guide_sheet_url": "",
+            "api_key": "sk-bench",
+            "order_storage": "sheets",
+        }, f)
+
+    # hộp thư trong thư mục tạm: seed khách mẫu để đo trang Sales Center có dữ liệu
+    os.environ["SALES_HUB_SEED_INBOX"] = "1"
+
+    os.chdir(workdir)
+
+    return workdir
+
+
+def import_app():
+
+    # import ở bare mode: phần UI của script chạy một lần, sau đó gọi thẳng hàm
+    logging.disable(logging.WARNING)
+    sys.path.insert(0, ROOT)
+
+    import app
+
+    return app
+
+
+# =============================
+# BENCHMARKS
+# =============================
+
+def bench_suggest(app, client, args, results):
+
+    for n in sizes(args.tours):
+
+        url = SHEET_URL.format(kind="tours", n=n)
+        client.add(url, {"Tours": make_tour_catalog(n)})
+        app.st.session_state.tour_sheet_url = url
+
+        message = SUGGEST_MESSAGES[0]
+        repeat = args.repeat if n < 100_000 else max(1, args.repeat // 5)
+
+        # cold: sheet vừa đổi version → đọc lại, tạo snapshot, dựng index
+        stats, found = measure(
+            lambda: app.suggest_tour(message),
+            repeat,
+            setup=lambda: app.bump_data_version(url)
+        )
+        results[f"suggest_tour.cold[tours={n}]"] = {**stats, "rows": len(found)}
+
+        stats, found = measure(
+            lambda: [app.suggest_tour(m) for m in SUGGEST_MESSAGES],
+            args.repeat
+        )
+        results[f"suggest_tour.warm[tours={n},messages={len(SUGGEST_MESSAGES)}]"] = {**stats, "rows": sum(map(len, found))}
+
+
+def bench_search(app, args, results):
+
+    for n in sizes(args.pages):
+
+        documents = make_documents(n)
+        documents.append({"file_id": "last", "name": "last", "page": 1, "text": "Điểm hẹn cuối hành trình"})
+
+        for label, query in [("hit_last", "điểm hẹn cuối"), ("miss", "không có trong tài liệu")]:
+
+            stats, text = measure(
+                lambda: app.search_relevant_text(iter(documents), query),
+                args.repeat
+            )
+            results[f"search_relevant_text.{label}[pages={n}]"] = {**stats, "chars": len(text)}
+
+
+def bench_drive(app, drive, args, results):
+
+    for n in sizes(args.drive_files):
+
+        files = make_drive_folder(n)
+        runs = {"count": 0}
+
+        def fresh_folder():
+            # folder mới mỗi lần → ingest toàn bộ (tải, trích text, chunk, index)
+            runs["count"] += 1
+            folder_id = f"bench{n}x{runs['count']}"
+            drive.add_folder(folder_id, [{**f, "id": f"{folder_id}-{f['id']}"} for f in files])
+            app.st.session_state.drive_folder = DRIVE_URL.format(folder_id=folder_id)
+
+        def load():
+            documents = app.load_drive_tour_data()
+            return sum(1 for _ in documents) if documents is not None else 0
+
+        stats, pages = measure(load, max(1, args.repeat // 2), setup=fresh_folder)
+        results[f"load_drive_tour_data.cold[files={n}]"] = {**stats, "pages": pages}
+
+        folder_id = f"bench{n}x{runs['count']}"
+
+        # resync: hết DRIVE_SYNC_INTERVAL, liệt kê lại nhưng không file nào đổi
+        stats, pages = measure(
+            load,
+            args.repeat,
+            setup=lambda: app._drive_sync_state()["last_sync"].pop(folder_id, None)
+        )
+        results[f"load_drive_tour_data.resync[files={n}]"] = {**stats, "pages": pages}
+
+        stats, pages = measure(load, args.repeat)
+        results[f"load_drive_tour_data.warm[files={n}]"] = {**stats, "pages": pages}
+
+
+def bench_dashboard(app, client, args, results):
+
+    for n in sizes(args.orders):
+
+        url = SHEET_URL.format(kind="orders", n=n)
+        rows = make_orders(n)
+        client.add(url, {"Orders": rows})
+        app.st.session_state.sheet_url = url
+
+        repeat = args.repeat if n < 100_000 else max(1, args.repeat // 5)
+
+        stats, store = measure(
+            lambda: app.rebuild_dashboard_aggregates(url),
+            repeat,
+            setup=lambda: app.bump_data_version(url)
+        )
+        results[f"dashboard.rebuild[orders={n}]"] = {**stats, "days": len(store["totals"].get("day", {}))}
+
+        stats, _ = measure(lambda: app.dashboard_aggregates(url), args.repeat)
+        results[f"dashboard.read[orders={n}]"] = stats
+
+        order = app.pd.DataFrame([dict(zip(rows[0], rows[1]))])
+
+        stats, _ = measure(
+            lambda: (app.apply_order_delta(url, order, 1), app.apply_order_delta(url, order, -1)),
+            args.repeat * 20
+        )
+        results[f"dashboard.delta[orders={n}]"] = stats
+
+
+def bench_llm(app, openai_state, args, results):
+
+    app.st.session_state.api_key = "sk-bench"
+    app.st.session_state.llm_cache_enabled = True
+
+    prompt = app.build_company_prompt("Tour Nhật Bản mùa thu giá bao nhiêu?")
+
+    stats, _ = measure(lambda: app.ask_chatgpt(prompt, use_cache=False), args.repeat)
+    results[f"ask_chatgpt.uncached[latency={openai_state.latency}s]"] = stats
+
+    app.ask_chatgpt(prompt)
+
+    stats, _ = measure(lambda: app.ask_chatgpt(prompt), args.repeat)
+    results["ask_chatgpt.cached"] = stats
+
+    prompts = [f"{prompt}\nCâu hỏi phụ {i}" for i in range(10)]
+
+    stats, _ = measure(lambda: app.ask_chatgpt_many(prompts), args.repeat)
+    results[f"ask_chatgpt_many[prompts=10,latency={openai_state.latency}s]"] = stats
+
+
+def bench_pages(client, args, results):
+
+    from streamlit.testing.v1 import AppTest
+
+    n = args.page_orders
+    orders_url = SHEET_URL.format(kind="orders", n=n)
+    tours_url = SHEET_URL.format(kind="tours", n=1000)
+
+    if orders_url not in client.spreadsheets:
+        client.add(orders_url, {"Orders": make_orders(n)})
+
+    if tours_url not in client.spreadsheets:
+        client.add(tours_url, {"Tours": make_tour_catalog(1000)})
+
+    for page in PAGES:
+
+        at = AppTest.from_file(APP_FILE, default_timeout=300)
+        at.secrets["gcp_service_account"] = FAKE_SERVICE_ACCOUNT
+        at.session_state["sheet_url"] = orders_url
+        at.session_state["tour_sheet_url"] = tours_url
+
+        at.run()
+        at.sidebar.radio[0].set_value(page).run()
+
+        stats, _ = measure(at.run, args.repeat)
+        results[f"page_rerun[{page},orders={n}]"] = {
+            **stats,
+            "exceptions": [e.value for e in at.exception],
+        }
+
+
+# =============================
+# SO SÁNH
+# =============================
+
+def compare(current, baseline, threshold):
+
+    regressions = []
+
+    print(f"\n{'benchmark':70} {'baseline':>12} {'current':>12} {'ratio':>7}")
+
+    for name, stats in current["results"].items():
+
+        old = baseline["results"].get(name)
+
+        if not old:
+            continue
+
+        ratio = stats["median_ms"] / old["median_ms"] if old["median_ms"] else 1.0
+        flag = ""
+
+        # bỏ qua chênh lệch dưới 1ms (nhiễu đo)
+        if ratio > threshold and stats["median_ms"] - old["median_ms"] > 1:
+            regressions.append(name)
+            flag = "  ⚠ chậm hơn"
+
+        print(f"{name:70} {old['median_ms']:>10.2f}ms {stats['median_ms']:>10.2f}ms {ratio:>6.2f}x{flag}")
+
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# =============================
+# MAIN
+# =============================
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark app.py với Sheets / Drive / OpenAI giả")
+    parser.add_argument("--only", default=",".join(GROUPS), help=f"nhóm cần chạy: {', '.join(GROUPS)}")
+    parser.add_argument("--tours", default="1000,10000,100000", help="số dòng catalog tour")
+    parser.add_argument("--full", action="store_true", help="thêm catalog 1.000.000 tour")
+    parser.add_argument("--orders", default="1000,10000,100000", help="số đơn cho dashboard")
+    parser.add_argument("--pages", default="100,1000,10000", help="số trang tài liệu cho search_relevant_text")
+    parser.add_argument("--drive-files", default="10,50", help="số file PDF / DOCX trong folder Drive")
+    parser.add_argument("--page-orders", type=int, default=10000, help="số đơn khi đo rerun cả trang")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--openai-latency", type=float, default=0.0, help="giây trễ giả lập mỗi lần gọi OpenAI")
+    parser.add_argument("--drive-latency", type=float, default=0.0, help="giây trễ giả lập mỗi lần tải file Drive")
+    parser.add_argument("--out", default=os.path.join(os.getcwd(), "bench_results.json"))
+    parser.add_argument("--compare", help="file JSON kết quả cũ để so sánh")
+    parser.add_argument("--threshold", type=float, default=1.25, help="tỉ lệ median coi là chậm đi")
+    args = parser.parse_args()
+
+    if args.full:
+        args.tours += ",1000000"
+
+    out = os.path.abspath(args.out)
+    baseline_file = os.path.abspath(args.compare) if args.compare else None
+    groups = [g for g in args.only.split(",") if g]
+
+    client = FakeGspreadClient()
+    drive = FakeDrive(latency=args.drive_latency)
+    openai_state = FakeOpenAIState(latency=args.openai_latency)
+
+    orders_url = SHEET_URL.format(kind="orders", n=args.page_orders)
+    client.add(orders_url, {"Orders": make_orders(args.page_orders)})
+
+    workdir = prepare_workdir(orders_url)
+    results = {}
+
+    try:
+        with patch_services(client, drive, openai_state):
+
+            app = import_app()
+
+            benches = {
+                "suggest": lambda: bench_suggest(app, client, args, results),
+                "search": lambda: bench_search(app, args, results),
+                "drive": lambda: bench_drive(app, drive, args, results),
+                "dashboard": lambda: bench_dashboard(app, client, args, results),
+                "llm": lambda: bench_llm(app, openai_state, args, results),
+                "pages": lambda: bench_pages(client, args, results),
+            }
+
+            for group in groups:
+                started = time.perf_counter()
+                benches[group]()
+                print(f"✓ {group} ({time.perf_counter() - started:.1f}s)", file=sys.stderr)
+
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for name, stats in results.items():
+        print(f"{name:70} {stats['median_ms']:>10.2f}ms")
+
+    print(f"\nĐã ghi {out}")
+
+    if baseline_file:
+
+        with open(baseline_file, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+        regressions = compare(report, baseline, args.threshold)
+
+        if regressions:
+            print(f"\n{len(regressions)} benchmark chậm hơn ngưỡng {args.threshold}x")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# =====================================================
+# ĐỌC FILE TOUR (PDF / DOCX / TXT)
+# =====================================================
+# Tách khỏi app.py để process con của pool đọc file (spawn / forkserver)
+# import được mà không phải chạy lại cả app Streamlit.
+
+import io
+import os
+import time
+
+
+def register_worker(pids):
+    # initializer của pool: báo pid về process chính để dừng được khi treo
+    pids.put(os.getpid())
+
+
+def read_pdf_pages_from_bytes(file_bytes):
+
+    from PyPDF2 import PdfReader
+
+    pdf = PdfReader(file_bytes)
+
+    return [page.extract_text() or "" for page in pdf.pages]
+
+
+def read_docx_from_bytes(file_bytes):
+
+    from docx import Document
+
+    doc = Document(file_bytes)
+
+    text = []
+    for p in doc.paragraphs:
+        text.append(p.text)
+
+    return "\n".join(text)
+
+
+def extract_file_pages(file_name, fh):
+
+    file_name = file_name.lower()
+
+    if file_name.endswith(".pdf"):
+        return read_pdf_pages_from_bytes(fh)
+
+    if file_name.endswith(".docx"):
+        return [read_docx_from_bytes(fh)]
+
+    if file_name.endswith(".txt"):
+        return [fh.read().decode("utf-8")]
+
+    return None
+
+
+def extract_worker(file_name, data):
+
+    # chạy trong process con: trả thời gian đọc về để ghi metrics ở process chính
+    started = time.perf_counter()
+    pages = extract_file_pages(file_name, io.BytesIO(data))
+
+    return pages, time.perf_counter() - started
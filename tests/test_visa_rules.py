@@ -0,0 +1,97 @@
+import glob
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from visa_rules import (  # noqa: E402
+    build_rule_index, docx_text, find_visa_rules, nationality_keys, parse_visa_rules, visa_exemptions
+)
+
+
+@pytest.fixture(scope="module")
+def index():
+
+    # 2 file visa đi kèm repo (tên file dạng NFD nên tìm bằng glob)
+    paths = sorted(glob.glob(os.path.join(ROOT, "*.docx")))
+    assert len(paths) == 2
+
+    return build_rule_index([(os.path.basename(p), docx_text(p)) for p in paths])
+
+
+def exemption_days(index, nationality, entry_port=None):
+    rules = visa_exemptions(find_visa_rules(index, nationality, entry_port=entry_port), entry_port)
+    return max((r["stay_days"] or 0 for r in rules), default=None)
+
+
+@pytest.mark.parametrize("nationality", ["Nhật Bản", "Japan", "Pháp", "France", "Đức", "Germany", "Anh", "UK"])
+def test_unilateral_exemption_45_days(index, nationality):
+    assert exemption_days(index, nationality) == 45
+
+
+def test_asean_exemption_30_days(index):
+
+    rule = next(r for r in index["rules"] if r["title"].startswith("Miễn thị thực song phương"))
+
+    assert "Thái Lan" in rule["countries"]
+    assert rule["groups"] == ["ASEAN"]
+    assert rule["stay_days"] == 30
+
+    assert nationality_keys("Thái Lan", index["aliases"]) == {"Thái Lan", "ASEAN"}
+    assert exemption_days(index, "Thailand") == 30
+
+
+def test_phu_quoc_port_rule(index):
+
+    rule = next(r for r in index["rules"] if r["ports"] == ["Phú Quốc"])
+
+    assert rule["visa_type"] == "Miễn visa"
+    assert rule["stay_days"] == 30
+    assert not rule["countries"] and not rule["groups"]
+
+    # mọi quốc tịch được miễn khi nhập cảnh thẳng Phú Quốc, nơi khác thì không
+    assert exemption_days(index, "Canada", entry_port="Phú Quốc") == 30
+    assert exemption_days(index, "Canada") is None
+
+
+def test_visa_type_table_rows(index):
+
+    tourist = next(r for r in index["rules"] if r["id"].endswith("#4.DL"))
+
+    assert tourist["visa_type"] == "Visa dán"
+    assert tourist["stay_days"] == 90
+
+
+@pytest.mark.parametrize("nationality, expected", [
+    ("Canada", {"Canada"}),
+    ("Việt Nam", {"Việt Nam"}),
+    ("Mỹ", {"Mỹ"}),
+])
+def test_nationality_recognition(index, nationality, expected):
+    assert nationality_keys(nationality, index["aliases"]) == expected
+
+
+def test_country_names_come_from_documents():
+
+    text = "\n".join([
+        "1. Miễn thị thực",
+        "1.1 Miễn thị thực thử nghiệm (15 ngày)",
+        "Áp dụng cho một số quốc tịch (Chile, Bờ Biển Ngà, Nhật…)",
+        "Thời gian lưu trú: tối đa 15 ngày",
+        "2. Visa cấp tại cửa khẩu",
+        "Áp dụng: Nhập cảnh bằng đường hàng không",
+    ])
+
+    index = build_rule_index([("test", text)])
+    rule = index["rules"][0]
+
+    assert rule["countries"] == ["Bờ Biển Ngà", "Chile", "Nhật Bản"]
+    assert nationality_keys("khách Bờ Biển Ngà", index["aliases"]) == {"Bờ Biển Ngà"}
+    assert "nhap canh bang duong hang khong" not in index["aliases"]
+
+    # không truyền tên lấy từ file → chỉ nhận tên có sẵn trong VISA_COUNTRY_ALIASES
+    rules, _ = parse_visa_rules(text, "test")
+    assert rules[0]["countries"] == ["Nhật Bản"]
@@ -0,0 +1,406 @@
+# =====================================================
+# QUY ĐỊNH VISA (PARSE FILE → INDEX)
+# =====================================================
+# Tách khỏi app.py để test / benchmark gọi thẳng parser với 2 file visa mà
+# không phải chạy app Streamlit. app.py cache kết quả theo mtime của file.
+#
+# Ingest file visa thành bảng quy định có cấu trúc: mỗi mục đánh số
+# ("1.1 Miễn thị thực đơn phương (45 ngày)") / mỗi dòng bảng loại visa là
+# một quy định với quốc tịch, loại visa, số ngày lưu trú, cửa khẩu.
+# Phần không đánh số (thông báo nội bộ) giữ làm "lưu ý chung".
+
+import re
+import unicodedata
+
+
+def fold_vietnamese(text):
+
+    text = text.lower().replace("đ", "d")
+    text = unicodedata.normalize("NFD", text)
+
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+# Từ điển quốc tịch cho index quy định visa: tên đã bỏ dấu (fold_vietnamese)
+# → tên chuẩn. Nhóm nước (ASEAN, Bắc Âu) được tra theo thành viên.
+# Tên nước mới xuất hiện trong danh sách quốc tịch của file được thêm vào
+# lúc dựng index (document_country_aliases), không cần sửa bảng này.
+VISA_COUNTRY_ALIASES = {
+    "Nhật Bản": ["nhat", "nhat ban", "japan", "japanese"],
+    "Hàn Quốc": ["han", "han quoc", "korea", "south korea", "korean"],
+    "Pháp": ["phap", "france", "french"],
+    "Đức": ["duc", "germany", "german"],
+    "Anh": ["anh", "uk", "united kingdom", "england", "british"],
+    "Ý": ["y", "italy", "italian"],
+    "Tây Ban Nha": ["tay ban nha", "spain", "spanish"],
+    "Nga": ["nga", "russia", "russian"],
+    "Đan Mạch": ["dan mach", "denmark", "danish"],
+    "Thụy Điển": ["thuy dien", "sweden", "swedish"],
+    "Na Uy": ["na uy", "norway", "norwegian"],
+    "Phần Lan": ["phan lan", "finland", "finnish"],
+    "Thái Lan": ["thai lan", "thailand", "thai"],
+    "Singapore": ["singapore", "sing"],
+    "Malaysia": ["malaysia", "ma lai"],
+    "Indonesia": ["indonesia", "indo"],
+    "Campuchia": ["campuchia", "cambodia", "cambodian"],
+    "Lào": ["lao", "laos"],
+    "Philippines": ["philippines", "philippin", "phi lip pin", "filipino"],
+    "Myanmar": ["myanmar", "mien dien", "burma"],
+    "Brunei": ["brunei"],
+    "Mỹ": ["my", "hoa ky", "usa", "us", "united states", "america", "american"],
+    "Úc": ["uc", "australia", "australian"],
+    "Trung Quốc": ["trung quoc", "china", "chinese"],
+    "Đài Loan": ["dai loan", "taiwan", "taiwanese"],
+    "Ấn Độ": ["an do", "india", "indian"],
+    "Canada": ["canada", "ca na da", "canadian"],
+    "New Zealand": ["new zealand", "niu di lan", "kiwi"],
+    "Hà Lan": ["ha lan", "netherlands", "holland", "dutch"],
+    "Bỉ": ["bi", "belgium", "belgian"],
+    "Thụy Sĩ": ["thuy si", "switzerland", "swiss"],
+    "Áo": ["ao", "austria", "austrian"],
+    "Bồ Đào Nha": ["bo dao nha", "portugal", "portuguese"],
+    "Ba Lan": ["ba lan", "poland", "polish"],
+    "Ireland": ["ireland", "ai len", "irish"],
+    "Hồng Kông": ["hong kong", "hongkong"],
+    "Việt Nam": ["viet nam", "vietnam", "vietnamese", "vn"],
+}
+VISA_COUNTRY_GROUPS = {
+    "ASEAN": ["Thái Lan", "Singapore", "Malaysia", "Indonesia", "Campuchia", "Lào", "Philippines", "Myanmar", "Brunei"],
+    "Scandinavia": ["Đan Mạch", "Thụy Điển", "Na Uy", "Phần Lan"],
+}
+VISA_GROUP_ALIASES = {"ASEAN": ["asean", "dong nam a"], "Scandinavia": ["scandinavia", "bac au"]}
+
+# (nhãn, từ khoá đã bỏ dấu) — xét theo thứ tự, tiêu đề mục trước rồi mới tới mục cha
+VISA_TYPES = [
+    ("Miễn visa", ["mien thi thuc", "mien visa", "hiep dinh"]),
+    ("Thẻ APEC", ["apec"]),
+    ("E-Visa", ["e-visa", "evisa", "visa dien tu"]),
+    ("Visa cửa khẩu", ["cua khau", "visa on arrival"]),
+    ("Visa dán", ["dai su quan", "traditional"]),
+    ("Thẻ tạm trú", ["tam tru"]),
+]
+VISA_EXEMPT_TYPE = "Miễn visa"
+VISA_HOME_COUNTRY = "Việt Nam"     # công dân Việt Nam không cần visa nhập cảnh
+VISA_ENTRY_PORTS = {"Phú Quốc": ["phu quoc"], "Đường hàng không": ["hang khong", "san bay"]}
+VISA_INBOUND_KEYWORDS = ["viet nam", "vietnam", "vn", "ha noi", "sai gon", "ho chi minh", "da nang", "nha trang", "hoi an", "ha long", "da lat"]
+
+DURATION_DAYS = {"ngay": 1, "thang": 30, "nam": 365}
+
+
+def _alias_lookup(groups):
+    return {alias: name for name, aliases in groups.items() for alias in aliases}
+
+
+VISA_ALIAS_TO_COUNTRY = _alias_lookup(VISA_COUNTRY_ALIASES)
+VISA_ALIAS_TO_GROUP = _alias_lookup(VISA_GROUP_ALIASES)
+VISA_ALIAS_TO_PORT = _alias_lookup(VISA_ENTRY_PORTS)
+
+
+def docx_text(file_path):
+
+    from docx import Document
+    from docx.table import Table
+
+    lines = []
+
+    # giữ đúng thứ tự đoạn văn / bảng; mỗi dòng bảng thành "| ô | ô |"
+    for block in Document(file_path).iter_inner_content():
+        if isinstance(block, Table):
+            for row in block.rows:
+                lines.append("| " + " | ".join(" ".join(cell.text.split()) for cell in row.cells) + " |")
+        else:
+            lines.append(block.text)
+
+    return "\n".join(lines)
+
+
+def match_aliases(text, aliases):
+
+    folded = " " + re.sub(r"[^a-z0-9]+", " ", fold_vietnamese(text)) + " "
+    names = set()
+
+    # tên dài khớp trước rồi xoá khỏi chuỗi: "Bờ Biển Ngà" không còn khớp "nga" (Nga)
+    for alias in sorted(aliases, key=len, reverse=True):
+        if f" {alias} " in folded:
+            names.add(aliases[alias])
+            folded = folded.replace(f" {alias} ", " | ")
+
+    return names
+
+
+def parse_duration_days(lines):
+
+    best = None
+
+    for line in lines:
+        for low, high, unit in re.findall(r"(\d+)(?:\s*[–-]\s*(\d+))?\s*(ngay|thang|nam)\b", fold_vietnamese(line)):
+            days = int(high or low) * DURATION_DAYS[unit]
+            best = max(best or 0, days)
+
+    return best
+
+
+def classify_visa_type(*titles):
+
+    for title in titles:
+        folded = fold_vietnamese(title)
+        for label, keywords in VISA_TYPES:
+            if any(k in folded for k in keywords):
+                return label
+
+    return titles[0]
+
+
+def alias_key(text):
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", fold_vietnamese(text)).split())
+
+
+def nationality_list(line):
+
+    # (nhóm ở đầu dòng, các tên trong danh sách) hoặc None nếu không phải dòng quốc tịch;
+    # "Tất cả quốc tịch" → (None, [])
+    head, sep, tail = line.partition(":")
+
+    # "Áp dụng cho một số quốc tịch (Nhật, Hàn, ...)" / "ASEAN: Thái Lan, Singapore, ..."
+    if fold_vietnamese(head).startswith("ap dung"):
+        if "tat ca quoc tich" in fold_vietnamese(line):
+            return None, []
+        inner = re.search(r"\((.*)\)", line)
+        groups, items = set(), (inner.group(1) if inner else tail).split(",")
+    elif sep and match_aliases(head, VISA_ALIAS_TO_GROUP):
+        groups, items = match_aliases(head, VISA_ALIAS_TO_GROUP), tail.split(",")
+    else:
+        return None
+
+    return groups, [i.strip(" .…") for i in items if i.strip(" .…")]
+
+
+def document_country_aliases(texts):
+
+    aliases = dict(VISA_ALIAS_TO_COUNTRY)
+
+    for text in texts:
+        for line in text.split("\n"):
+
+            parsed = nationality_list(line.strip())
+
+            for item in parsed[1] if parsed else []:
+
+                key = alias_key(item)
+
+                # chỉ nhận tên riêng ngắn ("Canada", "Tây Ban Nha"), bỏ qua câu
+                # như "Áp dụng: Nhập cảnh bằng đường hàng không"
+                words = item.split()
+                if key and key not in aliases and key not in VISA_ALIAS_TO_GROUP \
+                        and len(words) <= 4 and all(w[0].isupper() for w in words):
+                    aliases[key] = item
+
+    return aliases
+
+
+def _rule_nationalities(lines, aliases):
+
+    countries, groups = set(), set()
+
+    for line in lines:
+
+        parsed = nationality_list(line)
+
+        if parsed is None:
+            continue
+
+        head_groups, items = parsed
+
+        if head_groups is None:
+            return set(), set()
+
+        groups |= head_groups
+
+        for key in map(alias_key, items):
+            countries |= {aliases[key]} if key in aliases else set()
+            groups |= {VISA_ALIAS_TO_GROUP[key]} if key in VISA_ALIAS_TO_GROUP else set()
+
+    return countries, groups
+
+
+def _rule_ports(title, lines):
+
+    conditions = [title] + [l for l in lines if re.match(r"(ap dung|dieu kien)", fold_vietnamese(l))]
+
+    return sorted({
+        port for port, keywords in VISA_ENTRY_PORTS.items()
+        for line in conditions if any(k in fold_vietnamese(line) for k in keywords)
+    })
+
+
+def make_visa_rule(source, number, title, parent, group, lines, aliases):
+
+    countries, groups = _rule_nationalities(lines, aliases)
+
+    # ưu tiên dòng nói về lưu trú; không có thì lấy từ tiêu đề rồi toàn mục
+    stay_lines = [l for l in lines if "luu tru" in fold_vietnamese(l)]
+    stay_days = parse_duration_days(stay_lines) or parse_duration_days([title]) or parse_duration_days(lines)
+
+    heading = " › ".join(h for h in (group, parent, title) if h)
+
+    return {
+        "id": f"{source}#{number}",
+        "source": source,
+        "title": title,
+        "visa_type": classify_visa_type(title, parent or title),
+        "countries": sorted(countries),
+        "groups": sorted(groups),
+        "stay_days": stay_days,
+        "ports": _rule_ports(title, lines),
+        "text": "\n".join([heading] + lines),
+    }
+
+
+def parse_visa_rules(text, source, aliases=None):
+
+    aliases = aliases or VISA_ALIAS_TO_COUNTRY
+    rules, notes = [], []
+    group = parent = None
+    section = None      # (số mục, tiêu đề, các dòng)
+    preamble = []
+    header = None       # header của bảng đang đọc
+
+    def close():
+        if section and section[2]:
+            number, title, lines = section
+            rules.append(make_visa_rule(source, number, title, parent if "." in number else None, group, lines, aliases))
+
+    for raw in text.split("\n"):
+
+        line = raw.strip()
+
+        if not line:
+            continue
+
+        if line.startswith("|"):
+
+            cells = [c.strip() for c in line.strip("|").split("|")]
+
+            if header is None:
+                header = cells
+                continue
+
+            # mỗi dòng bảng loại visa ("DL | Du lịch | 15–90 ngày") là một quy định con
+            code, name = cells[0], cells[1] if len(cells) > 1 else cells[0]
+            lines = [f"{h}: {c}" for h, c in zip(header, cells)]
+            rules.append(make_visa_rule(
+                source, f"{section[0] if section else ''}.{code}", f"{name} ({code})",
+                section[1] if section else None, group, lines, aliases
+            ))
+            continue
+
+        header = None
+
+        if re.match(r"^[IVX]+\.\s", line):
+            close()
+            section = None
+            group = line.split(".", 1)[1].strip()
+            continue
+
+        heading = re.match(r"^(\d+(?:\.\d+)*)\.?\s+(.+)$", line)
+
+        if heading and heading.group(2)[0].isupper():
+            close()
+            number, title = heading.groups()
+            if "." not in number:
+                parent = title
+            section = (number, title, [])
+            continue
+
+        (section[2] if section else preamble).append(line)
+
+    close()
+
+    if preamble:
+        notes.append({"id": f"{source}#0", "source": source, "title": " ".join(preamble[:2]), "text": "\n".join(preamble)})
+
+    return rules, notes
+
+
+def build_rule_index(documents):
+
+    # documents: [(tên nguồn, text)]
+    aliases = document_country_aliases(text for _, text in documents)
+    rules, notes = [], []
+
+    for source, text in documents:
+        file_rules, file_notes = parse_visa_rules(text, source, aliases)
+        rules += file_rules
+        notes += file_notes
+
+    by_nationality, by_type, by_port = {}, {}, {}
+
+    for i, rule in enumerate(rules):
+
+        # không ghi quốc tịch → áp dụng cho mọi quốc tịch ("*")
+        for key in rule["countries"] + rule["groups"] or ["*"]:
+            by_nationality.setdefault(key, []).append(i)
+
+        by_type.setdefault(rule["visa_type"], []).append(i)
+
+        for port in rule["ports"] or ["*"]:
+            by_port.setdefault(port, []).append(i)
+
+    return {
+        "rules": rules,
+        "notes": notes,
+        "aliases": aliases,
+        "by_nationality": by_nationality,
+        "by_type": by_type,
+        "by_port": by_port,
+    }
+
+
+def nationality_keys(nationality, aliases=None):
+
+    countries = match_aliases(nationality, aliases or VISA_ALIAS_TO_COUNTRY)
+    groups = match_aliases(nationality, VISA_ALIAS_TO_GROUP)
+
+    for group, members in VISA_COUNTRY_GROUPS.items():
+        if countries & set(members):
+            groups.add(group)
+
+    return countries | groups
+
+
+def find_visa_rules(index, nationality, visa_type=None, entry_port=None):
+
+    ids = set(index["by_nationality"].get("*", []))
+
+    for key in nationality_keys(nationality, index["aliases"]):
+        ids |= set(index["by_nationality"].get(key, []))
+
+    if visa_type:
+        ids &= set(index["by_type"].get(visa_type, []))
+
+    # quy định gắn cửa khẩu khác bị loại; quy định không gắn cửa khẩu luôn giữ
+    if entry_port:
+        ids &= set(index["by_port"].get(entry_port, [])) | set(index["by_port"].get("*", []))
+
+    rules = [index["rules"][i] for i in ids]
+
+    # quy định riêng cho quốc tịch lên trước, rồi tới thời gian lưu trú dài hơn
+    rules.sort(key=lambda r: (not (r["countries"] or r["groups"]), -(r["stay_days"] or 0), r["id"]))
+
+    return rules
+
+
+def visa_exemptions(rules, entry_port=None):
+    return [
+        r for r in rules
+        if r["visa_type"] == VISA_EXEMPT_TYPE
+        and ((r["countries"] or r["groups"]) and (not r["ports"] or entry_port in r["ports"])
+             or (entry_port and entry_port in r["ports"]))
+    ]
+
+
+def is_inbound_destination(destination):
+    folded = " " + re.sub(r"[^a-z0-9]+", " ", fold_vietnamese(destination)) + " "
+    return not destination.strip() or any(
+        f" {k} " in folded for k in VISA_INBOUND_KEYWORDS + sum(VISA_ENTRY_PORTS.values(), [])
+    )